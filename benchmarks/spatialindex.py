@@ -0,0 +1,87 @@
+"""
+Compares the spatial index backends of network.Net on the same network.
+
+Usage:
+    python spatialindex.py NETFILE [--queries N] [--radius R] [--noise M] [--cellsize C]
+
+NETFILE is a SUMO .net.xml or a snapshot written by Net.save. Query points are
+GPS-like: a random position on a random edge plus gaussian noise. For every
+backend the script reports build time, single-query latency, batch throughput
+and the false-positive rate (candidate edges of the filter stage that fail
+the exact distance check).
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sources"))
+import network
+import spatialindex
+
+
+def loadNet(path):
+    if path.endswith(".xml") or path.endswith(".xml.gz"):
+        import sumolib
+        net = network.Net(compact=True)
+        net.importFromSumoNet(sumolib.net.readNet(path, withInternal=False))
+        return net
+    return network.Net.load(path)
+
+
+def queryPoints(net, n, noise, seed=0):
+    rnd = np.random.default_rng(seed)
+    seg = rnd.integers(0, len(net._segStart), n)
+    t = rnd.random(n)[:, None]
+    a = net._shapeCoords[net._segStart[seg]]
+    b = net._shapeCoords[net._segEnd[seg]]
+    p = a + t * (b - a) + rnd.normal(0, noise, (n, 2))
+    return p[:, 0], p[:, 1]
+
+
+def bench(index, xs, ys, r):
+    points = list(zip(xs.tolist(), ys.tolist()))
+    hits = 0
+    start = time.perf_counter()
+    for x, y in points:
+        hits += len(index.query(x, y, r)[0])
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index.queryBatch(xs, ys, r)
+    batch = time.perf_counter() - start
+
+    # counted outside the timed loops
+    candidates = sum(len(index.candidates(x, y, r)) for x, y in points)
+    return single, batch, candidates, hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("net")
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--radius", type=float, default=100.0)
+    parser.add_argument("--noise", type=float, default=20.0)
+    parser.add_argument("--cellsize", type=float, default=None, help="grid cell size, defaults to the radius")
+    args = parser.parse_args()
+
+    net = loadNet(args.net)
+    xs, ys = queryPoints(net, args.queries, args.noise)
+    n = args.queries
+    print(f"{len(net._edgeidlist)} edges, {len(net._segStart)} segments, {n} queries, radius {args.radius} m")
+
+    for name in spatialindex.BACKENDS:
+        start = time.perf_counter()
+        index = spatialindex.createSpatialIndex(net, name, cellsize=args.cellsize or args.radius)
+        build = time.perf_counter() - start
+        single, batch, candidates, hits = bench(index, xs, ys, args.radius)
+        fp = 1 - hits / candidates if candidates else 0.0
+        print(f"{name:<8} build {build:7.3f} s   single {1e6 * single / n:7.1f} us/query "
+              f"({n / single:8.0f} q/s)   batch {1e6 * batch / n:6.1f} us/query ({n / batch:8.0f} q/s)   "
+              f"candidate edges {candidates / n:5.2f}/query   false positives {100 * fp:5.1f} %")
+
+
+if __name__ == "__main__":
+    main()
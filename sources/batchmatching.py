@@ -0,0 +1,168 @@
+"""
+Batch map matching over a process pool.
+
+match_batch fans many trajectories out over worker processes. The network is
+stored once as a snapshot (or a tile directory) and every worker opens it
+with Net.load(mmap=True) / TiledNet, so the workers share the read-only pages
+of one file instead of each importing the network. Results are yielded as
+they finish; a trajectory that cannot be matched or raises is reported in its
+result and does not stop the batch.
+
+Example:
+
+    for result in match_batch("data/network.nrt", gps, processes=8):
+        if result.status == "ok":
+            result.matchdf.to_csv(f"out/{result.id}.csv", index=False)
+        else:
+            print(result.id, result.status, result.error)
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import traceback
+from collections import namedtuple
+
+import pandas as pd
+
+import network
+import tilednet
+from cleandata import compressStops, expandStops
+from mapmatching import MapMatcher
+
+# status is "ok", "failed" (no match found), "timeout" (MAX_RUNNING_TIME
+# reached, matchdf holds the matched prefix) or "error" (an exception, error
+# holds its traceback). stats is MatchStats.as_dict() when the matcher has
+# INSTRUMENT set. restarts counts the restarts of the backtrack engine
+# (MatchContext.restarts); matchdf then joins separately matched parts.
+BatchResult = namedtuple("BatchResult", ["id", "status", "matchdf", "error", "elapsed", "stats", "restarts"],
+                         defaults=(None, 0))
+
+# state of a worker process, set by _initWorker
+_worker = {}
+
+
+def _checkNetkwargs(path, netkwargs):
+    if os.path.isdir(path) and netkwargs.get("querycache") is not None:
+        raise ValueError("querycache is not supported on a tile directory (TiledNet), only on a Net snapshot")
+
+
+def openNet(path, **netkwargs):
+    """
+    Opens a snapshot written by Net.save, or a tile directory written by tilednet.writeTiles.
+
+    netkwargs go to Net.load or TiledNet; a TiledNet does not support querycache.
+    """
+    _checkNetkwargs(path, netkwargs)
+    if os.path.isdir(path):
+        return tilednet.TiledNet(path, **netkwargs)
+    return network.Net.load(path, **netkwargs)
+
+
+def _initWorker(path, netkwargs, matcherkwargs, preprocess, compress_stops=False):
+    _worker.clear()
+    _worker.update(matcherkwargs=matcherkwargs, preprocess=preprocess, compress_stops=compress_stops)
+    try:
+        _worker["net"] = openNet(path, **netkwargs)
+    except Exception:
+        # reported with every task instead of killing (and respawning) the worker
+        _worker["error"] = traceback.format_exc()
+
+
+def _matchOne(item):
+    key, df = item
+    start = time.perf_counter()
+    if "error" in _worker:
+        return BatchResult(key, "error", None, _worker["error"], 0.0)
+    try:
+        net = _worker["net"]
+        if _worker["preprocess"] is not None:
+            df = _worker["preprocess"](df, net)
+        matcher = MapMatcher(net, **_worker["matcherkwargs"])
+        if _worker["compress_stops"]:
+            compressed = compressStops(df)
+            context = matcher.match_trajectory(compressed)
+            context.matchdf = expandStops(context.matchdf, compressed, df)
+        else:
+            context = matcher.match_trajectory(df)
+        error = {"ok": None, "failed": "no match found",
+                 "timeout": f"stopped after {context.steps} steps, {context.backtracks} backtracks"}[context.status]
+        stats = context.stats.as_dict() if context.stats is not None else None
+        return BatchResult(key, context.status, context.matchdf, error, time.perf_counter() - start, stats,
+                           context.restarts)
+    except Exception:
+        return BatchResult(key, "error", None, traceback.format_exc(), time.perf_counter() - start)
+
+
+def _items(trajectories, idcolumn):
+    """(id, DataFrame) pairs of the supported inputs."""
+    if isinstance(trajectories, pd.DataFrame):
+        for key, df in trajectories.groupby(idcolumn, sort=False):
+            # match() walks the rows by position
+            yield key, df.reset_index(drop=True)
+    elif isinstance(trajectories, dict):
+        yield from trajectories.items()
+    else:
+        for i, item in enumerate(trajectories):
+            yield item if isinstance(item, tuple) else (i, item)
+
+
+def match_batch(net, trajectories, processes=None, idcolumn="id", preprocess=None,
+                netkwargs=None, chunksize=1, start_method=None, compress_stops=False, **matcherkwargs):
+    """
+    Matches many trajectories in parallel and yields the results as they finish.
+
+    Args:
+        net (network.Net or str): the network, or the path of a snapshot
+            (Net.save) or tile directory (tilednet.writeTiles). A Net object is
+            written to a temporary snapshot that the workers memory-map; the
+            workers open the tile directory of a TiledNet object.
+        trajectories: a DataFrame with one trajectory per value of idcolumn,
+            a dict id -> DataFrame, or an iterable of DataFrames or
+            (id, DataFrame) pairs. Each trajectory is what MapMatcher.match
+            expects, unless preprocess prepares it.
+        processes (int): worker processes, defaults to os.cpu_count(); 1 runs
+            in this process.
+        idcolumn (str): trajectory id column of a DataFrame input.
+        preprocess (callable, optional): module-level function (df, net) -> df
+            run in the worker before matching, e.g. cleaning and interpolation.
+        netkwargs (dict, optional): keyword arguments of Net.load / TiledNet.
+        chunksize (int): trajectories sent to a worker at once.
+        start_method (str, optional): multiprocessing start method.
+        compress_stops (bool): match every stop run once (cleandata.compressStops)
+            and restore it in the result (cleandata.expandStops); needs a
+            stopindex column.
+        **matcherkwargs: MapMatcher parameters.
+
+    Yields:
+        BatchResult: (id, status, matchdf, error, elapsed, stats, restarts) per
+        trajectory, in completion order.
+    """
+    netkwargs = dict(netkwargs or {})
+    tmpdir = None
+    if isinstance(net, tilednet.TiledNet):
+        path = net.path
+    elif isinstance(net, network.Net):
+        tmpdir = tempfile.mkdtemp(prefix="nrtbatch")
+        path = os.path.join(tmpdir, "net.nrt")
+        net.save(path)
+    else:
+        path = net
+    # fail here rather than once per trajectory in the workers
+    _checkNetkwargs(path, netkwargs)
+    initargs = (path, netkwargs, matcherkwargs, preprocess, compress_stops)
+    try:
+        if processes == 1:
+            _initWorker(*initargs)
+            for item in _items(trajectories, idcolumn):
+                yield _matchOne(item)
+            return
+        context = multiprocessing.get_context(start_method)
+        with context.Pool(processes, initializer=_initWorker, initargs=initargs) as pool:
+            yield from pool.imap_unordered(_matchOne, _items(trajectories, idcolumn), chunksize=chunksize)
+    finally:
+        if processes == 1:
+            _worker.clear()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
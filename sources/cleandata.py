@@ -24,15 +24,17 @@ def cleaningData(obs, net,id=0, MINSPEED_FOR_BEARING=1, MAX_SPEED_FOR_OUTLIER=10
         return 0
     obs = obs.sort_values("timestamp")
     obs = obs.groupby("timestamp").last().reset_index()
+    # convert all points at once
+    xs, ys = net.convertLonLat2XYArray(obs["lon"].to_numpy(), obs["lat"].to_numpy())
     output = []
     row_current = obs.iloc[0]
-    point_current = net.convertLonLat2XY(row_current["lon"],row_current["lat"])
+    point_current = (xs[0], ys[0])
     timestamp_current = row_current["timestamp"]
     stopsnumber = 1
 
     for index in range(1,len(obs)):
         row_next = obs.iloc[index]
-        point_next = net.convertLonLat2XY(row_next["lon"],row_next["lat"])
+        point_next = (xs[index], ys[index])
         timestamp_next  = row_next["timestamp"]
         dist = distance2d(point_current, point_next)
         speed_current_estimated = dist/(timestamp_next-timestamp_current)
@@ -103,6 +105,68 @@ def xystop_point_editing(df):
     return df
 
 
+def compressStops(df):
+    """
+    Collapses every stop run (consecutive points with the same stopindex > 0)
+    into its first point, so a long stop is matched once instead of once per
+    second. The point keeps the first timestamp of the run and gets speed 0.
+
+    Args:
+        df (pandas.DataFrame): trajectory with a 'stopindex' column, e.g. from
+            cleaningData or interpolateTrajectory.
+
+    Returns:
+        pandas.DataFrame: the points to match, with the columns of df plus
+        'firstrow' and 'rowcount', the positions in df each point stands for.
+        expandStops uses them to restore the stops after matching.
+    """
+    stops = df["stopindex"].to_numpy()
+    start = np.ones(len(df), dtype=bool)
+    start[1:] = (stops[1:] != stops[:-1]) | (stops[1:] <= 0)
+    first = np.flatnonzero(start)
+    compressed = df.iloc[first].reset_index(drop=True)
+    compressed["firstrow"] = first
+    compressed["rowcount"] = np.diff(np.append(first, len(df)))
+    compressed.loc[compressed["stopindex"] > 0, "speed"] = 0
+    return compressed
+
+
+def expandStops(matchdf, compressed, df):
+    """
+    Restores the stop runs of compressStops in a point matching result.
+
+    Every matched stop point is repeated for all the points of its run, with
+    their timestamps and samples and speed 0, so the stop times of
+    MapMatcher.save_routematch stay right.
+
+    Args:
+        matchdf (pandas.DataFrame): matchdf of the compressed trajectory.
+        compressed (pandas.DataFrame): the result of compressStops.
+        df (pandas.DataFrame): the trajectory passed to compressStops.
+
+    Returns:
+        pandas.DataFrame: matchdf with one row per point of df, 'index'
+        refers to the positions in df.
+    """
+    if matchdf is None or len(matchdf) == 0:
+        return matchdf
+    position = matchdf["index"].to_numpy()
+    rows = compressed["rowcount"].to_numpy()[position]
+    first = compressed["firstrow"].to_numpy()[position]
+    # position in df of every output row: the first row of its run plus its rank in the run
+    original = np.repeat(first - (np.cumsum(rows) - rows), rows) + np.arange(int(rows.sum()))
+    expanded = matchdf.loc[matchdf.index.repeat(rows)].reset_index(drop=True)
+    expanded["index"] = original
+    expanded["timestamp"] = df["timestamp"].to_numpy()[original]
+    expanded["x_sample"] = df["x"].to_numpy()[original]
+    expanded["y_sample"] = df["y"].to_numpy()[original]
+    expanded["bearing"] = df["bearing"].to_numpy()[original]
+    if "type" in df.columns:
+        expanded["type"] = df["type"].to_numpy()[original]
+    expanded["speed"] = np.where(df["stopindex"].to_numpy()[original] > 0, 0, df["speed"].to_numpy()[original])
+    return expanded
+
+
 def removeOutlier(obs, MAX_SPEED_FOR_OUTLIER = 50):
     
     output = []
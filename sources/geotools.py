@@ -18,13 +18,11 @@ def calculateUTMZone(min_lon, max_lon, min_lat, max_lat):
     return utm_zone
 
 def dfPoint2LonLat(df, net):
-    df["lon"] = df.apply(lambda row: net.convertXY2LonLat(row["x"], row['y'])[0], axis=1)
-    df["lat"] = df.apply(lambda row: net.convertXY2LonLat(row["x"], row['y'])[1], axis=1)
+    df["lon"], df["lat"] = net.convertXY2LonLatArray(df["x"].to_numpy(), df["y"].to_numpy())
     return df.drop(columns=["x","y"])
 
 def dfLonLat2XY(df, net):
-    df["x"] = df.apply(lambda row: net.convertLonLat2XY(row["lon"], row['lat'])[0], axis=1)
-    df["y"] = df.apply(lambda row: net.convertLonLat2XY(row["lon"], row['lat'])[1], axis=1)
+    df["x"], df["y"] = net.convertLonLat2XYArray(df["lon"].to_numpy(), df["lat"].to_numpy())
     return df.drop(columns=["lon","lat"])
 
 def distance2d(point1, point2):
@@ -56,6 +54,31 @@ def distancePointToPolygon(point, polygon):
          mindist = np.min(mindist, distancePointToLine(point, polygon[i]))
     return mindist
 
+def pointsToSegmentsDistance(px, py, ax, ay, bx, by):
+    """
+    Vectorized distance from points to line segments (element-wise).
+
+    Args:
+        px, py (numpy.ndarray): point coordinates.
+        ax, ay, bx, by (numpy.ndarray): segment start and end coordinates.
+
+    Returns:
+        tuple: (distance, t) arrays, where t in [0, 1] is the position of the
+        closest point on the segment (0 for zero-length segments).
+
+    """
+    dx = bx - ax
+    dy = by - ay
+    dd = dx * dx + dy * dy
+    u = (px - ax) * dx + (py - ay) * dy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.where(dd > 0, u / dd, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    qx = ax + t * dx - px
+    qy = ay + t * dy - py
+    return np.sqrt(qx * qx + qy * qy), t
+
+
 def lineOffsetWithMinimumDistanceToPoint(point, line_start_point, line_end_point):
     """Return the offset from line (line_start, line_end) and distance from the point to that point
     where the distance to point is minimal"""
@@ -1,13 +1,337 @@
 #import networkx as nx
-#import numpy as np
+import heapq
+import threading
+import weakref
+from collections import Counter, OrderedDict
+from types import MappingProxyType
+import numpy as np
 import pandas as pd
 import time
 
 import network
+import tilednet
 from network import combineShapesSumo,getGeoShape
 from geotools import distance2d,offsetBearing,polyLength,road_distance, polygonOffsetWithMinimumDistanceToPoint
 
 
+# point columns used by the matching steps
+GPS_COLUMNS = ("x", "y", "timestamp", "speed", "bearing", "type")
+
+
+def gps_points(sample_gps):
+    """
+    Converts a trajectory to the list of point dicts the matching steps index.
+
+    Args:
+        sample_gps: DataFrame, dict of column arrays (NumPy arrays or lists) or
+            NumPy structured array with the GPS_COLUMNS.
+
+    Returns:
+        list: One dict per point, or None if the input type is not supported.
+
+    """
+    if isinstance(sample_gps, pd.DataFrame):
+        columns = [sample_gps[name].tolist() for name in GPS_COLUMNS]
+    elif isinstance(sample_gps, np.ndarray) and sample_gps.dtype.names is not None:
+        columns = [sample_gps[name].tolist() for name in GPS_COLUMNS]
+    elif isinstance(sample_gps, dict):
+        columns = [np.asarray(sample_gps[name]).tolist() for name in GPS_COLUMNS]
+    else:
+        return None
+    return [dict(zip(GPS_COLUMNS, values)) for values in zip(*columns)]
+
+
+def chunk_windows(timestamps, window, overlap, stops=None):
+    """
+    Splits a trajectory into overlapping time windows.
+
+    The cuts are placed every `window` seconds. If there is a stop within
+    `overlap` seconds before a cut, the cut moves to the last point of that
+    stop.
+
+    Args:
+        timestamps (array): Ascending timestamps of the points in seconds.
+        window (float): Length of a window in seconds, without the overlaps.
+        overlap (float): Seconds added before and after every window.
+        stops (array, optional): stopindex of the points, > 0 at stops.
+
+    Returns:
+        list: (start, cut, nextcut, end) per window. The window matches
+        the points [start, end) and owns the points [cut, nextcut).
+
+    """
+    timestamps = np.asarray(timestamps, dtype=float)
+    n = len(timestamps)
+    cuts = [0]
+    while n > 0:
+        cut = int(np.searchsorted(timestamps, timestamps[cuts[-1]] + window))
+        if cut >= n:
+            break
+        if stops is not None:
+            low = max(cuts[-1] + 1, int(np.searchsorted(timestamps, timestamps[cut] - overlap)))
+            atstop = np.flatnonzero(np.asarray(stops[low:cut]) > 0)
+            if len(atstop) > 0:
+                cut = low + int(atstop[-1])
+        cuts.append(max(cut, cuts[-1] + 1))
+    cuts.append(n)
+    return [(int(np.searchsorted(timestamps, timestamps[cut] - overlap)), cut, nextcut,
+             int(np.searchsorted(timestamps, timestamps[nextcut - 1] + overlap, side="right")))
+            for cut, nextcut in zip(cuts[:-1], cuts[1:])]
+
+
+class ProjectionCache:
+    """
+    Bounded cache of candidate projections within one trajectory.
+
+    A backtrack re-evaluates points against the candidates it already tried;
+    the projection of a point on a combined shape is kept under
+    (point index, edge, from_edge, edge_reverse, from_reverse) as
+    (offset, x, y, length, bearing). At most maxsize projections are kept,
+    the least recently used one is dropped first.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+
+    def put(self, key, value):
+        self._items[key] = value
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+
+    def clear(self):
+        self._items.clear()
+
+
+class TransitionTable:
+    """
+    Edges reachable from an edge, the candidates of a CHANGE decision.
+
+    get(edge, reverse) returns the immutable pair (edges, reversedict): the
+    next edges in a fixed order and their reverse flags, built once per
+    (edge, reverse) with the MAP_ONE_WAY_FIX and U_TURN_ON_ONEWAY rules of
+    outgoinglist. The path filter of LOOP=False is applied by the caller.
+    Tables are shared by all matchers of a network, see transition_table.
+
+    With maxsize the table keeps at most maxsize entries, the least recently
+    used one is dropped first. The entries hold edge handles, which on a
+    TiledNet refer to their tiles, so an unbounded table would keep evicted
+    tiles alive.
+    """
+
+    def __init__(self, MAP_ONE_WAY_FIX=True, U_TURN_ON_ONEWAY=False, maxsize=None):
+        self.MAP_ONE_WAY_FIX = MAP_ONE_WAY_FIX
+        self.U_TURN_ON_ONEWAY = U_TURN_ON_ONEWAY
+        self.maxsize = maxsize
+        self._table = dict() if maxsize is None else OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, edge, reverse):
+        key = (edge, reverse)
+        if self.maxsize is None:
+            entry = self._table.get(key)
+            if entry is None:
+                entry = self._table[key] = self._build(edge, reverse)
+            return entry
+        with self._lock:
+            entry = self._table.get(key)
+            if entry is not None:
+                self._table.move_to_end(key)
+                return entry
+        entry = self._build(edge, reverse)
+        with self._lock:
+            self._table[key] = entry
+            if len(self._table) > self.maxsize:
+                self._table.popitem(last=False)
+        return entry
+
+
+    def __len__(self):
+        return len(self._table)
+
+
+    def _build(self, edge, reverse):
+        if self.MAP_ONE_WAY_FIX:
+            node = edge.getFromNode() if reverse==True else edge.getToNode()
+            out = list(node.getOutgoing()) + list(node.getIncoming())
+            if (not self.U_TURN_ON_ONEWAY) and (edge in out):
+                out.remove(edge)
+            reversedict = {edge:True for edge in node.getIncoming()}
+            reversedict.update({edge:False for edge in node.getOutgoing()})
+        else:
+            out = list(edge.getToNode().getOutgoing())
+            reversedict = {edge:False for edge in out}
+        return tuple(dict.fromkeys(out)), MappingProxyType(reversedict)
+
+
+# net -> {(MAP_ONE_WAY_FIX, U_TURN_ON_ONEWAY): TransitionTable}
+_transition_tables = weakref.WeakKeyDictionary()
+
+# entries of the transition table of a TiledNet; a Net holds all its edges anyway
+TILED_TRANSITION_TABLE_SIZE = 65536
+
+
+def transition_table(net, MAP_ONE_WAY_FIX=True, U_TURN_ON_ONEWAY=False):
+    """
+    The TransitionTable of a network for the given rules, created once.
+    The table of a TiledNet is bounded to TILED_TRANSITION_TABLE_SIZE entries.
+    """
+    tables = _transition_tables.setdefault(net, dict())
+    key = (bool(MAP_ONE_WAY_FIX), bool(U_TURN_ON_ONEWAY))
+    table = tables.get(key)
+    if table is None:
+        maxsize = TILED_TRANSITION_TABLE_SIZE if isinstance(net, tilednet.TiledNet) else None
+        table = tables[key] = TransitionTable(*key, maxsize=maxsize)
+    return table
+
+
+class MatchStats:
+    """
+    Counters, phase timers and trace events of matching.
+
+    A matcher with INSTRUMENT=True gives every trajectory (MatchContext.stats)
+    or MatchSession its own MatchStats. Without it the matching steps only
+    test the stats for None.
+
+    counters:
+        points: points matched, including the re-matches after a backtrack.
+        candidates: candidate edges scored.
+        pruned: candidates whose exact scoring was skipped by their lower
+            bound (PRUNE_CANDIDATES), included in candidates.
+        backtracks: rejected matches that resumed from an earlier decision.
+        max_backtrack_depth: most points rewound by one backtrack.
+        stay, change, nodecision: decisions of the result rows, counted from
+            the final matchdf (count_decisions), so one per output row in
+            every engine.
+
+    timers holds the seconds spent per phase: "candidates" (edges of a point),
+    "scoring" (score_candidates) and "update" (decision list and path).
+
+    sink, if given, is called as sink(event, fields) for trace events:
+    "start" and "change" (a new edge on the path), "backtrack", "restart"
+    (a match, viterbi chain or MatchSession started over), "timeout" and "failed".
+    """
+
+    COUNTERS = ("points", "candidates", "pruned", "backtracks", "max_backtrack_depth", "stay", "change", "nodecision")
+    PHASES = ("candidates", "scoring", "update")
+
+    def __init__(self, sink=None):
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.timers = dict.fromkeys(self.PHASES, 0.0)
+        self.sink = sink
+
+
+    def add_time(self, phase, start):
+        """Adds the time since start to a phase and returns the current time."""
+        now = time.perf_counter()
+        self.timers[phase] += now - start
+        return now
+
+
+    def event(self, name, **fields):
+        if self.sink is not None:
+            self.sink(name, fields)
+
+
+    def merge(self, other):
+        """Adds the counters and timers of another MatchStats, e.g. to sum up a batch."""
+        for name, value in other.counters.items():
+            if name == "max_backtrack_depth":
+                self.counters[name] = max(self.counters[name], value)
+            else:
+                self.counters[name] += value
+        for phase, value in other.timers.items():
+            self.timers[phase] += value
+        return self
+
+
+    def count_decisions(self, rows):
+        """Adds the decisions of result rows (matchdf records) to the stay, change and nodecision counters."""
+        for row in rows:
+            self.counters[row["decitsion"].lower()] += 1
+        return self
+
+
+    def as_dict(self):
+        """Flat dict of the counters and the timers (as time_<phase>) for metrics export."""
+        result = dict(self.counters)
+        result.update({"time_" + phase: value for phase, value in self.timers.items()})
+        return result
+
+
+class MatchContext:
+    """
+    Per-trajectory state of MapMatcher.match_trajectory and MatchSession.
+
+    The matcher only holds the configuration, the network and the shared
+    transition table, which are not changed by matching. Everything a match
+    updates lives in its context, so one matcher can match many trajectories
+    at once, e.g. from a thread pool.
+
+    Attributes:
+        decisionlist (list): Open decisions, the points backtracking can resume from.
+        matchedpoints (list): matchdf rows of the points matched so far.
+        path (list): Matched path, item: {"edge":, "reverse":, "length":}.
+        pathcount (Counter): Edge -> occurrences in path, for LOOP=False.
+        cache (ProjectionCache): Projection cache of the trajectory, or None.
+        status (str): "ok", "failed" or "timeout" once the match is done.
+        matchdf (pandas.DataFrame): Point matching result when status is "ok",
+            the matched prefix of the trajectory when it is "timeout".
+        elapsed (float): Running time of the match in seconds.
+        steps (int): Points matched, counting the ones matched again after a backtrack.
+        backtracks (int): Rejected matches that resumed from an earlier decision.
+        restarts (int): Times the backtrack engine started again after running
+            out of decisions (ADAPTIVE_RADIUS). matchdf and path then join
+            separately matched parts, the path is not connected between them.
+        stats (MatchStats): Instrumentation of the match, None unless INSTRUMENT is set.
+        windows (list): Contexts of the windows of match_chunked.
+    """
+
+    def __init__(self, index=0, edges=(), reversedict=None, path=None, cache=None, stats=None):
+        """
+        Args:
+            index (int): Index of the first point.
+            edges (set): Candidate edges of the first point.
+            reversedict (dict): Candidate edge -> reverse flag.
+            path (list): Matched path list to extend (optional).
+            cache (ProjectionCache): Projection cache of the trajectory (optional).
+            stats (MatchStats): Instrumentation of the trajectory (optional).
+
+        """
+        self.decisionlist = [{"index":index, "result":set(edges), "last_edge":None, "offset":None,
+                              "reversedict":reversedict if reversedict is not None else {}}]
+        self.matchedpoints = []
+        self.path = path if path is not None else []
+        self.pathcount = Counter(item["edge"] for item in self.path)
+        self.last_edge = None
+        self.last_offset = None
+        self.last_edge_reverse = None
+        self.lastpoint = None
+        self.index = index
+        self.cache = cache
+        self.status = None
+        self.matchdf = None
+        self.elapsed = 0.0
+        self.steps = 0
+        self.backtracks = 0
+        self.restarts = 0
+        self.stats = stats
+        self.windows = None
 
 
 class MapMatcher:
@@ -19,15 +343,33 @@ class MapMatcher:
                  LOOP=True,
                  MAX_SPEED=100,
                  DIFF_GPS_ERROR=10,
-                 MAX_RUNNING_TIME=5):
+                 MAX_RUNNING_TIME=5,
+                 ENGINE="backtrack",
+                 BEAM_WIDTH=10,
+                 PROJECTION_CACHE_SIZE=4096,
+                 INSTRUMENT=False,
+                 EVENT_SINK=None,
+                 ADAPTIVE_RADIUS=False,
+                 MIN_CANDIDATES=3,
+                 MAX_BEARING_ERROR=90,
+                 PRUNE_CANDIDATES=False):
         
         if not isinstance(net, network.Net):
             raise ValueError("network.Net expected")
+        if ENGINE not in ("backtrack", "viterbi", "sparse"):
+            raise ValueError(f"unknown matching engine {ENGINE!r}")
+        if ENGINE == "sparse" and isinstance(net, tilednet.TiledNet):
+            # routing.Router reads the packed adjacency and length arrays of a whole Net
+            raise ValueError("the sparse engine needs a network.Net, a TiledNet has no routing arrays")
             
         self.net = net
         self.radius = MAX_GPS_ERROR + MAX_MAP_ERROR
         self.matchdf = None
         self.routedf = None
+        self.status = None   # MatchContext.status of the last match
+        self.restarts = 0    # MatchContext.restarts of the last match
+        self.elapsed = None  # running time of the last match in seconds
+        self.stats = None    # MatchStats of the last match when INSTRUMENT is set
         
         self.MAX_GPS_ERROR = MAX_GPS_ERROR #meters
         self.MAX_MAP_ERROR = MAX_MAP_ERROR #meters
@@ -35,16 +377,33 @@ class MapMatcher:
         self.U_TURN_ON_ONEWAY = U_TURN_ON_ONEWAY
         self.LOOP = LOOP
         self.MAX_SPEED = MAX_SPEED #m/s
-        self.MAX_RUNNING_TIME = MAX_RUNNING_TIME  #s
+        self.MAX_RUNNING_TIME = MAX_RUNNING_TIME  #s, None or 0: no limit
         self.DIFF_GPS_ERROR = DIFF_GPS_ERROR #meters
-        self.path= []  # item: {"edge":,"reverese":,"length":}
+        self.path= []  # item: {"edge":,"reverese":,"length":}, path of the last match
         self.MINSPEED_BEARING = 1 #m/s
+        self.ENGINE = ENGINE
+        self.BEAM_WIDTH = BEAM_WIDTH
+        self.PROJECTION_CACHE_SIZE = PROJECTION_CACHE_SIZE
+        self.INSTRUMENT = INSTRUMENT or EVENT_SINK is not None
+        self.EVENT_SINK = EVENT_SINK  # callable(event, fields), see MatchStats
+        self.ADAPTIVE_RADIUS = ADAPTIVE_RADIUS  # grow the first point search, see first_point_matching
+        self.MIN_CANDIDATES = MIN_CANDIDATES
+        self.MAX_BEARING_ERROR = MAX_BEARING_ERROR #degrees
+        self.PRUNE_CANDIDATES = PRUNE_CANDIDATES  # see score_candidates_pruned
+        self.transitiontable = transition_table(net, MAP_ONE_WAY_FIX, U_TURN_ON_ONEWAY)
+        self.projectioncache = None  # ProjectionCache of the last match
         
         
     
     def reset(self):
         self.matchdf = None
         self.routedf = None
+        self.status = None
+        self.restarts = 0
+        self.elapsed = None
+        self.stats = None
+        self.path = []
+        self.projectioncache = None
         
         
      
@@ -74,15 +433,65 @@ class MapMatcher:
 
     
     
-    def first_point_matching(self,x,y):
-        
+    def first_point_matching(self,x,y,bearing=None,speed=None,adaptive=None):
+        """
+        Candidate edges of a point that starts (or restarts) a match.
+
+        With ADAPTIVE_RADIUS the search starts at an eighth of the radius and
+        doubles until MIN_CANDIDATES plausible edges are found. An edge is
+        plausible when its direction is within MAX_BEARING_ERROR degrees of
+        the bearing of a moving point (speed >= MINSPEED_BEARING); if no
+        edge agrees, all edges are plausible.
+
+        Args:
+            x, y (float): Point coordinates.
+            bearing (float, optional): Bearing of the point in degrees.
+            speed (float, optional): Speed of the point in m/s.
+            adaptive (bool, optional): Overrides ADAPTIVE_RADIUS, False for
+                all the edges within the full radius.
+
+        Returns:
+            tuple: (set of edges, dict edge -> reverse flag)
+        """
         #x, y = self.net.convertLonLat2XY(lon, lat)
         edges = self.net.getNeighboringEdges(x, y, self.radius)
+        adaptive = self.ADAPTIVE_RADIUS if adaptive is None else adaptive
+        if adaptive and len(edges) > self.MIN_CANDIDATES:
+            edges = self.adaptive_candidates(edges, x, y, bearing, speed)
         edges = [edge for edge,dist in edges]
         reversedict = {edge:False for edge in edges}
         return set(edges),reversedict
     
     
+    def adaptive_candidates(self, edges, x, y, bearing=None, speed=None):
+        """
+        The (edge, dist) pairs of the smallest search radius, doubling from
+        radius / 8, that holds MIN_CANDIDATES plausible edges.
+
+        The full radius is queried once; growing the radius filters that
+        result by distance, so it costs no extra index queries.
+        """
+        count = len(edges)
+        dist = np.array([d for edge, d in edges])
+        plausible = np.ones(count, dtype=bool)
+        if bearing is not None and speed is not None and speed >= self.MINSPEED_BEARING:
+            edgelist = [edge for edge, d in edges]
+            matchbearing = self.net.projectOnEdges(edgelist, x, y, [None] * count,
+                                                   [False] * count, [False] * count)[4]
+            distbearing = np.abs(bearing - matchbearing)
+            distbearing = np.minimum(distbearing, 360 - distbearing)
+            plausible = distbearing <= self.MAX_BEARING_ERROR
+            if not plausible.any():
+                plausible[:] = True
+        # the radius that holds MIN_CANDIDATES plausible edges, at least radius / 8
+        needed = np.sort(dist[plausible])[min(self.MIN_CANDIDATES, plausible.sum()) - 1]
+        r = self.radius / 8
+        while r < needed and r < self.radius:
+            r *= 2
+        keep = plausible & (dist <= r)
+        return [item for item, k in zip(edges, keep) if k]
+    
+    
     
     
     def cost_calculate(self, bearing_error, match_point_distance, air_distance_error, road_distance_error, reverse):
@@ -99,55 +508,53 @@ class MapMatcher:
             float: Cost value for the match point.
 
         """
-        cost = 0
-        if reverse == True:
-            cost+= 100000
-        cost+= 1*bearing_error + 30*match_point_distance  + 10*air_distance_error  +5*road_distance_error
-        return  cost
+        cost = 1*bearing_error + 30*match_point_distance  + 10*air_distance_error  +5*road_distance_error
+        # reverse may be an array of flags when all candidates are scored at once
+        return  cost + 100000*reverse
 
     
-    def outgoinglist(self, edge, reverse):
+    def outgoinglist(self, edge, reverse, path=None):
         """
         Retrieves a list of outgoing edge IDs from a given edge.
 
         Args:
             edge (SumoEdge): Current Sumo edge.
+            path (list): Matched path checked when LOOP is False (default: self.path).
 
         Returns:
             list: List of outgoing edge IDs.
 
         """
-        #out = list(edge.getOutgoing().keys())
-        if self.MAP_ONE_WAY_FIX: 
-            if reverse==True:
-                node = edge.getFromNode()
-            else:
-                node = edge.getToNode()
+        edges, reversedict = self.transitiontable.get(edge, reverse)
+        edges = set(edges)
+        if( not self.LOOP):
+            edges.difference_update(item["edge"] for item in (self.path if path is None else path))
+        return edges, dict(reversedict)
 
-            out = node.getOutgoing() + node.getIncoming()
-            if (not self.U_TURN_ON_ONEWAY) and (edge in out):
-                out.remove(edge)
-            
-            path = [item["edge"] for item in self.path]
-            
-            if( not self.LOOP):
-                for item in path:
-                    if item in out:
-                        out.remove(item)
-            reversedict={edge:True for edge in node.getIncoming()}
 
-            reversedict.update({edge:False for edge in node.getOutgoing()})
-        else:
-            node = edge.getToNode()
-            out = node.getOutgoing()
-            if( not self.LOOP):
-                for item in path:
-                    if item in out:
-                        out.remove(item)
-            reversedict={edge:False for edge in out}
+    def next_edges(self, context, edge, reverse):
+        """
+        outgoinglist for match_point: the set of next edges and the shared,
+        read-only reversedict, with the path filter from the context's path counter.
+        """
+        edges, reversedict = self.transitiontable.get(edge, reverse)
+        if self.LOOP:
+            return set(edges), reversedict
+        pathcount = context.pathcount
+        return {edge for edge in edges if edge not in pathcount}, reversedict
+
+
+    def _path_append(self, context, item):
+        context.path.append(item)
+        context.pathcount[item["edge"]] += 1
 
 
-        return set(out),reversedict
+    def _path_pop(self, context, position=-1):
+        edge = context.path.pop(position)["edge"]
+        pathcount = context.pathcount
+        pathcount[edge] -= 1
+        if pathcount[edge] <= 0:
+            del pathcount[edge]
 
 
         #print({edge:False for edge in tonode.getOutgoing()})
@@ -157,343 +564,1030 @@ class MapMatcher:
     
     
     
-    def match(self, sample_gps):
+    def score_candidates(self, row, edges, reverses, from_edges, from_reverses, last=None, index=None, cache=None):
+        """
+        Scores all candidate edges of a GPS point at once.
+
+        The point is projected on every candidate with Net.projectOnEdges and the
+        bearing, point distance, air-distance and road-distance errors are
+        computed as arrays for cost_calculate.
+
+        Args:
+            row (dict): GPS point.
+            edges (list): Candidate edges.
+            reverses (list): Reverse flag of each candidate.
+            from_edges (list): Edge before each candidate (or None).
+            from_reverses (list): Reverse flag of each edge before.
+            last (tuple or list): (edge, offset, edge_length, sample point,
+                matched point) of the previous match, None at the start of a
+                trajectory. A list gives the previous match of each candidate.
+            index (int): Index of the point, the key of cache.
+            cache (ProjectionCache): Projections already computed (optional).
+
+        Returns:
+            dict: Arrays offset, x, y, edge_length, matchbearing, dist, distbearing,
+            cost_air, matched_road_distance, rd and cost, and predict_distance.
+
+        """
+        x, y = row["x"], row["y"]
+        if cache is None:
+            offset, mx, my, edge_length, matchbearing = self.net.projectOnEdges(edges, x, y, from_edges,
+                                                                                reverses, from_reverses)
+        else:
+            offset, mx, my, edge_length, matchbearing = self.cached_projections(cache, index, x, y, edges,
+                                                                                from_edges, reverses, from_reverses)
+        dist = ((mx - x) ** 2 + (my - y) ** 2) ** 0.5
+        distbearing = np.abs(row["bearing"] - matchbearing)
+        distbearing = np.minimum(distbearing, 360 - distbearing)
+
+        if last is None:
+            # first match: the previous point is the point itself
+            cost_air = np.zeros(len(edges))
+            matched_road_distance = np.zeros(len(edges))
+        else:
+            if isinstance(last, tuple):
+                last = [last] * len(edges)
+            started = np.array([item is None for item in last], dtype=bool)
+            last = [item if item is not None else (None, 0.0, 0.0, (x,y), (x,y)) for item in last]
+            lastoffset = np.array([item[1] for item in last], dtype=float)
+            last_edge_length = np.array([item[2] for item in last], dtype=float)
+            air_sample_distance = np.array([distance2d(item[3], (x,y)) for item in last], dtype=float)
+            lastx = np.array([item[4][0] for item in last], dtype=float)
+            lasty = np.array([item[4][1] for item in last], dtype=float)
+            air_matched_distance = ((lastx - mx) ** 2 + (lasty - my) ** 2) ** 0.5
+            cost_air = np.where(started, 0.0, np.abs(air_sample_distance - air_matched_distance))
+            sameedge = np.array([edge == item[0] for edge, item in zip(edges, last)], dtype=bool)
+            matched_road_distance = np.where(started, 0.0,
+                                             np.where(sameedge, np.maximum(0, offset - lastoffset),
+                                                      (last_edge_length - lastoffset) + offset))
+
+        predict_distance = float(row["speed"]) * 1 # deltaTime
+        rd = np.abs(matched_road_distance - predict_distance)
+        cost = self.cost_calculate(distbearing, dist, cost_air, rd, np.asarray(reverses, dtype=bool))
+        return {"offset":offset, "x":mx, "y":my, "edge_length":edge_length, "matchbearing":matchbearing,
+                "dist":dist, "distbearing":distbearing, "cost_air":cost_air, "predict_distance":predict_distance,
+                "matched_road_distance":matched_road_distance, "rd":rd, "cost":cost}
+
+
+    def cost_lower_bound(self, row, edges, reverses, from_edges):
+        """
+        Lower bounds of cost_calculate for candidate edges, without projecting.
+
+        The matched point lies on the edge shape or on the segment
+        projectOnEdges prepends from the previous edge, so it is inside the
+        union of the bounding boxes of the edge and its previous edge. The
+        distance to that box bounds the point distance; the other errors
+        are at least 0.
+
+        Returns:
+            numpy.ndarray: One bound per candidate.
+        """
+        boxes = self.net.getBoundingBoxes(edges)
+        ks = [k for k, from_edge in enumerate(from_edges) if from_edge is not None]
+        if len(ks) > 0:
+            fromboxes = self.net.getBoundingBoxes([from_edges[k] for k in ks])
+            boxes[ks, :2] = np.minimum(boxes[ks, :2], fromboxes[:, :2])
+            boxes[ks, 2:] = np.maximum(boxes[ks, 2:], fromboxes[:, 2:])
+        x, y = row["x"], row["y"]
+        dx = np.maximum(np.maximum(boxes[:, 0] - x, x - boxes[:, 2]), 0.0)
+        dy = np.maximum(np.maximum(boxes[:, 1] - y, y - boxes[:, 3]), 0.0)
+        return self.cost_calculate(0, np.sqrt(dx * dx + dy * dy), 0, 0, np.asarray(reverses, dtype=bool))
+
+
+    def score_candidates_pruned(self, row, edges, reverses, from_edges, from_reverses, last=None, index=None,
+                                cache=None):
+        """
+        score_candidates for callers that only need the cheapest candidate.
+
+        The candidates whose cost_lower_bound is within the reverse penalty
+        of the smallest bound are scored first, in one batch. The others
+        cannot be the cheapest when their bound exceeds the best cost found
+        and are skipped; only the rest are scored in a second batch. So a
+        reversed candidate is usually not projected at all. The cheapest
+        candidate is the same as with score_candidates.
+
+        Returns:
+            tuple: (scores, kept). scores as score_candidates for the
+            candidates at the positions kept, a list in the order of edges.
+        """
+        count = len(edges)
+        if count < 2:
+            return self.score_candidates(row, edges, reverses, from_edges, from_reverses, last, index, cache), \
+                list(range(count))
+        bound = self.cost_lower_bound(row, edges, reverses, from_edges)
+        near = bound < bound.min() + self.cost_calculate(0, 0, 0, 0, True)
+        if near.all():
+            return self.score_candidates(row, edges, reverses, from_edges, from_reverses, last, index, cache), \
+                list(range(count))
+        lasts = last if isinstance(last, list) else [last] * count
+
+        def score(ks):
+            return self.score_candidates(row, [edges[k] for k in ks], [reverses[k] for k in ks],
+                                         [from_edges[k] for k in ks], [from_reverses[k] for k in ks],
+                                         None if last is None else [lasts[k] for k in ks], index, cache)
+
+        kept = np.flatnonzero(near).tolist()
+        scores = score(kept)
+        # a small tolerance keeps rounding of the bound from dropping a tie
+        rest = np.flatnonzero(~near & (bound <= scores["cost"].min() + 1e-6)).tolist()
+        if len(rest) > 0:
+            restscores = score(rest)
+            # back in the order of edges, so ties go to the same candidate as in score_candidates
+            kept = kept + rest
+            order = np.argsort(kept, kind="stable")
+            scores = {name: np.concatenate((value, restscores[name]))[order] if isinstance(value, np.ndarray)
+                      else value for name, value in scores.items()}
+            kept = [kept[k] for k in order.tolist()]
+        return scores, kept
+
+
+    def cached_projections(self, cache, index, x, y, edges, from_edges, reverses, from_reverses):
+        """Net.projectOnEdges of point index, projecting only the candidates missing from cache."""
+        keys = [(index, edge, from_edge, reverse, from_reverse)
+                for edge, from_edge, reverse, from_reverse in zip(edges, from_edges, reverses, from_reverses)]
+        values = [cache.get(key) for key in keys]
+        missing = [k for k, value in enumerate(values) if value is None]
+        if len(missing) > 0:
+            projected = self.net.projectOnEdges([edges[k] for k in missing], x, y, [from_edges[k] for k in missing],
+                                                [reverses[k] for k in missing], [from_reverses[k] for k in missing])
+            for k, value in zip(missing, zip(*[a.tolist() for a in projected])):
+                values[k] = value
+                cache.put(keys[k], value)
+        return tuple(np.array(column, dtype=float) for column in zip(*values))
+
+
+    def match_record(self, index, row, scores, k, edge, reverse, from_edge, from_reverse, decision):
+        """The matchdf row of candidate k of score_candidates."""
+        return {"index":index, "timestamp":row["timestamp"], "x":float(scores["x"][k]), "y":float(scores["y"][k]),
+                "bearing":row["bearing"], "rd":float(scores["rd"][k]), "dist":float(scores["dist"][k]),
+                "from_edge":from_edge.getID() if from_edge!=None else None,
+                "predict_distance":scores["predict_distance"], "speed":row["speed"],
+                "matched_road_distance":float(scores["matched_road_distance"][k]), "y_sample":row["y"],
+                "x_sample":row["x"], "cost_air":float(scores["cost_air"][k]), "decitsion":decision,
+                "matchbearing":float(scores["matchbearing"][k]), "edgeid":edge.getID(),
+                "offset":float(scores["offset"][k]), "distbearing":float(scores["distbearing"][k]),
+                "edge_length":float(scores["edge_length"][k]), "type":row["type"], "edge_reverse":reverse,
+                "from_edge_reverse":from_reverse}
+
+
+    def match(self, sample_gps, budget=None, window=None, overlap=120, executor=None):
         """
         Matches GPS observations to road network edges.
 
         Args:
-            observations (DataFrame): GPS observations DataFrame.
+            sample_gps: GPS observations as a DataFrame, a dict of column arrays
+                or a NumPy structured array with the columns x, y, timestamp,
+                speed, bearing and type (see gps_points).
+            budget (float): Time limit of this call in seconds (default: MAX_RUNNING_TIME),
+                per window when window is set.
+            window (float): Match in windows of this many seconds, see match_chunked.
+            overlap (float): Overlap of the windows in seconds.
+            executor (concurrent.futures.Executor): Matches the windows in parallel.
 
         Returns:
-            DataFrame: DataFrame containing the matched points.
+            int: 1 if successful (result in self.matchdf), 0 otherwise. After a
+            timeout self.status is "timeout" and self.matchdf holds the
+            matched prefix.
 
         """
         #sample_gps = self.reconstruct_observations(observations)
-        if not isinstance(sample_gps, pd.DataFrame):
-            return 0
-        sample_gps.to_csv("new_sample.csv",index=False)
-        
+        if window is not None:
+            return self._keep(self.match_chunked(sample_gps, window, overlap, executor, budget))
+        return self._keep(self.match_trajectory(sample_gps, budget))
+
+
+    def _keep(self, context):
+        """Stores the result of a match in the matcher, the return value of match."""
+        self.path = context.path
+        self.projectioncache = context.cache
+        self.status = context.status
+        self.restarts = context.restarts
+        self.elapsed = context.elapsed
+        self.matchdf = context.matchdf
+        self.stats = context.stats
+        return 1 if context.status == "ok" else 0
+
+
+    def match_trajectory(self, sample_gps, budget=None):
+        """
+        Matches GPS observations without changing the matcher.
+
+        All the state of the match is kept in the returned context, so the
+        same matcher can be used by several threads at once, e.g.
+        executor.map(matcher.match_trajectory, trajectories).
+
+        The time limit is checked before every point, also while
+        backtracking. When it is reached the match stops and keeps the points
+        matched so far.
+
+        Args:
+            sample_gps: GPS observations, as in match.
+            budget (float): Time limit in seconds, defaults to MAX_RUNNING_TIME.
+                None or 0 (for both) means no limit.
+
+        Returns:
+            MatchContext: status "ok" with the result in matchdf, "failed" if
+            no match was found or "timeout" with the matched prefix in matchdf
+            (None if no point was matched yet). elapsed, steps and backtracks
+            report the work done.
+
+        """
+        engine = self._engine()
+        return self._timed_match(engine, sample_gps, budget)
+
+
+    def _engine(self):
+        """The method of ENGINE, matching a list of points before a deadline."""
+        return {"backtrack":self._backtrack_match, "viterbi":self._viterbi_match,
+                "sparse":self._sparse_match}[self.ENGINE]
+
+
+    def _timed_match(self, engine, sample_gps, budget):
+        return self._timed_points(engine, gps_points(sample_gps), budget)
+
+
+    def _timed_points(self, engine, points, budget):
+        start = time.perf_counter()
+        budget = self.MAX_RUNNING_TIME if budget is None else budget
+        deadline = start + budget if budget else None
+        if points is None or len(points) == 0:
+            context = MatchContext(stats=self.new_stats())
+            context.status = "failed"
+        else:
+            context = engine(points, deadline)
+        if context.status != "failed" and len(context.matchedpoints) > 0:
+            context.matchdf = pd.DataFrame(context.matchedpoints)
+            if context.stats is not None:
+                context.stats.count_decisions(context.matchedpoints)
+        context.elapsed = time.perf_counter() - start
+        return context
+
+
+    def match_chunked(self, sample_gps, window=3600, overlap=120, executor=None, budget=None):
+        """
+        Matches a long trajectory in overlapping time windows.
+
+        The windows come from chunk_windows and are cut at stops where
+        possible (a stopindex column > 0). Each window is matched on its own
+        with match_trajectory, so the backtracking depth and the time limit
+        apply per window. Consecutive windows are joined in their overlap at
+        the point closest to the cut where both are on the same edge in the
+        same direction, so the joined path stays connected.
+
+        Args:
+            sample_gps: GPS observations, as in match, optionally with a
+                stopindex column.
+            window (float): Length of a window in seconds, without the overlaps.
+            overlap (float): Seconds matched before and after every window.
+            executor (concurrent.futures.Executor, optional): Executor, e.g. a
+                ThreadPoolExecutor, that matches the windows in parallel.
+            budget (float): Time limit per window in seconds, defaults to MAX_RUNNING_TIME.
+
+        Returns:
+            MatchContext: status "ok" if every window was matched, otherwise
+            "timeout" or "failed" of a window, with the points that were
+            matched in matchdf. path holds the edges of the joined rows,
+            windows the contexts of the windows.
+
+        """
+        start = time.perf_counter()
+        points = gps_points(sample_gps)
+        context = MatchContext(stats=self.new_stats())
+        context.windows = []
+        if points is None or len(points) == 0:
+            context.status = "failed"
+            return context
+        stops = None
+        if isinstance(sample_gps, dict) or isinstance(sample_gps, pd.DataFrame):
+            stops = np.asarray(sample_gps["stopindex"]) if "stopindex" in sample_gps else None
+        elif "stopindex" in sample_gps.dtype.names:
+            stops = sample_gps["stopindex"]
+        windows = chunk_windows([point["timestamp"] for point in points], window, overlap, stops)
+        engine = self._engine()
+        match_window = lambda bounds: self._timed_points(engine, points[bounds[0]:bounds[3]], budget)
+        results = executor.map(match_window, windows) if executor is not None else map(match_window, windows)
+
+        matchedpoints = context.matchedpoints
+        statuses = set()
+        for (first, cut, nextcut, end), result in zip(windows, results):
+            context.windows.append(result)
+            statuses.add(result.status)
+            context.steps += result.steps
+            context.backtracks += result.backtracks
+            context.restarts += result.restarts
+            if context.stats is not None and result.stats is not None:
+                context.stats.merge(result.stats)
+            if result.status == "failed":
+                continue
+            rows = [dict(row, index=row["index"] + first) for row in result.matchedpoints]
+            self._join_window(matchedpoints, rows, cut)
+        if context.stats is not None:
+            # the windows counted their overlaps too: count the joined rows instead
+            for name in ("stay", "change", "nodecision"):
+                context.stats.counters[name] = 0
+            context.stats.count_decisions(matchedpoints)
+        context.status = "ok" if statuses == {"ok"} else ("failed" if "failed" in statuses else "timeout")
+        if len(matchedpoints) > 0:
+            context.matchdf = pd.DataFrame(matchedpoints)
+        context.path = self._rows_path(matchedpoints)
+        context.pathcount = Counter(item["edge"] for item in context.path)
+        context.elapsed = time.perf_counter() - start
+        return context
+
+
+    def _join_window(self, matchedpoints, rows, cut):
+        """Appends the rows of the next window to matchedpoints, replacing the overlap."""
+        if len(rows) == 0:
+            return
+        last = matchedpoints[-1]["index"] if len(matchedpoints) > 0 else -1
+        before = {}
+        for row in reversed(matchedpoints):
+            if row["index"] < rows[0]["index"]:
+                break
+            before[row["index"]] = row
+        # join at the common point closest to the cut, at the cut (or after the last row) otherwise
+        join = min(cut, last + 1)
+        common = [row["index"] for row in rows if row["index"] in before
+                  and before[row["index"]]["edgeid"] == row["edgeid"]
+                  and before[row["index"]]["edge_reverse"] == row["edge_reverse"]]
+        if len(common) > 0:
+            join = min(common, key=lambda index: abs(index - cut))
+        while len(matchedpoints) > 0 and matchedpoints[-1]["index"] >= join:
+            matchedpoints.pop()
+        joined = before.get(join)
+        for row in rows:
+            if row["index"] < join:
+                continue
+            if joined is not None:
+                # the window may have started on this edge: keep the edge it was entered from
+                if row["edgeid"] != joined["edgeid"]:
+                    joined = None
+                else:
+                    row["from_edge"] = joined["from_edge"]
+                    row["from_edge_reverse"] = joined["from_edge_reverse"]
+            matchedpoints.append(row)
+
+
+    def _backtrack_match(self, points, deadline=None):
         #initialpoint
-        p = sample_gps.iloc[0]
-        matchedpoints = []
-        edges, reversedict = self.first_point_matching(p["x"],p["y"])
-        #print(reversedict)
+        p = points[0]
+        edges, reversedict = self.first_point_matching(p["x"], p["y"], p["bearing"], p["speed"])
+        cache = ProjectionCache(self.PROJECTION_CACHE_SIZE) if self.PROJECTION_CACHE_SIZE > 0 else None
+        context = self.new_context(0, edges, reversedict, cache, self.new_stats())
+        stats = context.stats
         myindex = 0
-        last_edge = None
-        last_offset = None
-        #current_time = sample_gps.iloc[0]["timestamp"]
-        #next_time = sample_gps.iloc[1]["timestamp"]
-        decisionlist = []
-        decisionlist.append({"index":0, "result":set(edges), "last_edge":None, "offset":None ,"reversedict":reversedict})
-        includeJunctions = False
-  
-        last_edge_reverse = None
-        
-        start_time = time.time()
+        # points and path matched before the last restart, and where and how it started
+        donepoints = []
+        donepath = []
+        seedindex = 0
+        seedfull = False
 
+        # other point matching
+        while(myindex <len(points)):
+            if deadline is not None and time.perf_counter() > deadline:
+                if stats is not None:
+                    stats.event("timeout", index=myindex)
+                context.status = "timeout"
+                break
+            context.steps += 1
+            myindex, backtrack = self.match_point(context, myindex, points[myindex])
+            if myindex is None:
+                # no decision left. With ADAPTIVE_RADIUS keep the points matched so far and
+                # start again from this point, with all the edges of the full radius if that
+                # already failed; without it the match fails as it always did
+                index = context.index
+                full = index == seedindex
+                edges = ()
+                if self.ADAPTIVE_RADIUS and not (full and seedfull):
+                    row = points[index]
+                    edges, reversedict = self.first_point_matching(row["x"], row["y"], row["bearing"], row["speed"],
+                                                                   adaptive=False if full else None)
+                if len(edges) == 0:
+                    if stats is not None:
+                        stats.event("failed", index=index)
+                    context.status = "failed"
+                    return context
+                if stats is not None:
+                    stats.event("restart", index=index)
+                kept = [item for item in context.matchedpoints if item["index"] < index]
+                donepoints.extend(kept)
+                donepath.extend(self._rows_path(kept))
+                restarted = self.new_context(index, edges, reversedict, cache, stats)
+                restarted.steps, restarted.backtracks = context.steps, context.backtracks
+                restarted.restarts = context.restarts + 1
+                context = restarted
+                myindex = seedindex = index
+                seedfull = full
+                continue
+            if backtrack:
+                context.backtracks += 1
+                if context.index == len(points) - 1:
+                    break
+        if context.status is None:
+            context.status = "ok"
+        if len(donepoints) > 0:
+            context.matchedpoints = donepoints + context.matchedpoints
+            context.path = donepath + context.path
+            context.pathcount = Counter(item["edge"] for item in context.path)
+        return context
+
+
+    def _rows_path(self, rows):
+        """The path items of the edges of consecutive matchdf rows, as match_point appends them."""
+        path = []
+        for row in rows:
+            if len(path) > 0 and path[-1]["edge"].getID() == row["edgeid"] \
+                    and path[-1]["reverse"] == row["edge_reverse"]:
+                continue
+            edge = self.net.getEdge(row["edgeid"])
+            from_edge = path[-1]["edge"] if len(path) > 0 else None
+            from_reverse = path[-1]["reverse"] if len(path) > 0 else False
+            path.append({"edge":edge, "reverse":row["edge_reverse"],
+                         "length":self.net.combinedShapeLength(edge, from_edge, row["edge_reverse"], from_reverse)})
+        return path
+
+
+    def new_stats(self):
+        """A MatchStats for a trajectory or session, None unless INSTRUMENT is set."""
+        return MatchStats(self.EVENT_SINK) if self.INSTRUMENT else None
+
+
+    def new_context(self, index, edges, reversedict, cache=None, stats=None):
+        """
+        Creates the matching context of a trajectory starting at a point.
 
-        current_time = time.time()
+        Args:
+            index (int): Index of the first point.
+            edges (set): Candidate edges of the first point.
+            reversedict (dict): Candidate edge -> reverse flag.
+            cache (ProjectionCache): Projection cache of the trajectory (optional).
+            stats (MatchStats): Instrumentation of the trajectory (optional).
 
-        # other point matching
-        while(myindex <len(sample_gps)):
-      
-            for index,row in sample_gps.iloc[myindex:].iterrows():
-                if last_edge!= decisionlist[-1]["last_edge"]:
-                    raise ValueError("error in the algorithm")
-
-                check=False
-                if last_edge!=None:
-                    remind_offset = self.path[-1]["length"]-last_offset
-                    #print(f"index = {index}, edge={last_edge.getID()} , last_offset = {last_offset},remind_offset = {remind_offset}")
-                    decision = self.decision_stay_change_nodecide(remind_offset,
-                                                             row.speed,last_edge.getSpeed(), 1)
-                    check =True
-                else:
-                    decision = "CHANGE"
-                    edges = decisionlist[-1]["result"]
-                    reversedict = decisionlist[-1]["reversedict"]
-                    #reversedict remove lastedge
+        Returns:
+            MatchContext: Context passed to match_point.
+
+        """
+        return MatchContext(index, edges, reversedict, cache=cache, stats=stats)
+
+
+    def match_point(self, context, index, row):
+        """
+        Matches one GPS point, the step of match and MatchSession.
+
+        Args:
+            context (MatchContext): Matching context from new_context, updated in place.
+            index (int): Index of the point.
+            row (dict): Point with x, y, timestamp, speed, bearing and type.
+
+        Returns:
+            tuple: (next index, backtrack). After a rejected match the next index
+            is the point of the decision to resume from and backtrack is True.
+            The next index is None when no decision is left.
+
+        """
+        decisionlist = context.decisionlist
+        matchedpoints = context.matchedpoints
+        path = context.path
+        last_edge = context.last_edge
+        last_offset = context.last_offset
+        last_edge_reverse = context.last_edge_reverse
+        context.index = index
+        stats = context.stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        if last_edge!= decisionlist[-1]["last_edge"]:
+            raise ValueError("error in the algorithm")
+
+        if last_edge!=None:
+            remind_offset = path[-1]["length"]-last_offset
+            decision = self.decision_stay_change_nodecide(remind_offset,
+                                                     row["speed"],last_edge.getSpeed(), 1)
+        else:
+            decision = "CHANGE"
+            edges = decisionlist[-1]["result"]
+            reversedict = decisionlist[-1]["reversedict"]
+
+
+        if decision == "STAY":
+            edges = {last_edge}
+            reversedict = {last_edge:last_edge_reverse}
+
+        elif decision == "CHANGE" and last_edge!=None:
+            edges, reversedict = self.next_edges(context, last_edge, last_edge_reverse)
 
+        elif decision == "NODECISION":
+            edges, reversedict = self.next_edges(context, last_edge, last_edge_reverse)
+            edges.add(last_edge)
+            if reversedict.get(last_edge) != last_edge_reverse:
+                reversedict = dict(reversedict)
+                reversedict[last_edge] = last_edge_reverse
+
+        if len(edges) == 0:
+            raise ValueError("error in the algorithm. ln(edges)==0")
+
+        edgelist = list(edges)
+        reverses = [reversedict[edge] for edge in edgelist]
+        from_edges = []
+        from_reverses = []
+        for edge in edgelist:
+
+            if (edge!=last_edge and last_edge!=None):
+                temp_edge = last_edge
+                temp_reverse = last_edge_reverse
+
+            elif len(path)<2:
+                temp_edge = None
+                temp_reverse = False
+            else:
+                temp_edge = path[-2]["edge"]
+                temp_reverse = path[-2]["reverse"]
+            from_edges.append(temp_edge)
+            from_reverses.append(temp_reverse)
+
+        if stats is not None:
+            start = stats.add_time("candidates", start)
+        lastedgeinfo = matchedpoints[-1] if len(matchedpoints)>0 else context.lastpoint
+        last = None
+        if lastedgeinfo is not None:
+            last = (self.net.getEdge(lastedgeinfo["edgeid"]), lastedgeinfo["offset"], lastedgeinfo["edge_length"],
+                    (lastedgeinfo["x_sample"],lastedgeinfo["y_sample"]), (lastedgeinfo["x"],lastedgeinfo["y"]))
+        count = len(edgelist)
+        if self.PRUNE_CANDIDATES:
+            scores, kept = self.score_candidates_pruned(row, edgelist, reverses, from_edges, from_reverses, last,
+                                                        index, context.cache)
+            if len(kept) < count:
+                # only the scored candidates can be the best
+                edgelist = [edgelist[k] for k in kept]
+                from_edges = [from_edges[k] for k in kept]
+                from_reverses = [from_reverses[k] for k in kept]
+        else:
+            scores = self.score_candidates(row, edgelist, reverses, from_edges, from_reverses, last,
+                                           index, context.cache)
+        if stats is not None:
+            start = stats.add_time("scoring", start)
+            counters = stats.counters
+            counters["points"] += 1
+            counters["candidates"] += count
+            counters["pruned"] += count - len(edgelist)
+
+        best = int(np.argmin(scores["cost"]))
+        bestedge = edgelist[best]
+        offset = float(scores["offset"][best])
+
+        if (scores["dist"][best] >  self.radius): # back to first changing edge and start on that point as initial point
+            if bestedge in decisionlist[-1]["result"]:
+                decisionlist[-1]["result"].remove(bestedge)
+
+            counter = 0
+            while len(decisionlist)>0 and len(decisionlist[-1]["result"])==0:
+                counter+=1
+                decisionlist.pop()
+                self._path_pop(context)
+
+            if counter == 0:
+                self._path_pop(context)
+
+            if len(decisionlist)==0:
+                return None, True
+
+            decisionlist[-1]["offset"] = None
+
+            decisionlist[-1]["last_edge"] = None
+            decisionlist[-1]["last_edge_reverse"] = None
+            myindex = decisionlist[-1]["index"]
+
+            while len(matchedpoints) > 0 and matchedpoints[-1]["index"]>=myindex :
+                matchedpoints.pop()
+
+            context.last_offset = None
+            context.last_edge = None
+            context.last_edge_reverse = None
+            if stats is not None:
+                counters["backtracks"] += 1
+                counters["max_backtrack_depth"] = max(counters["max_backtrack_depth"], index - myindex)
+                stats.event("backtrack", index=index, resume=myindex, depth=index - myindex)
+                stats.add_time("update", start)
+            return myindex, True
+
+        last_offset = offset
+
+        matchedpoints.append(self.match_record(index, row, scores, best, bestedge, reversedict[bestedge],
+                                               from_edges[best], from_reverses[best], decision))
+
+
+        if last_edge==None:   # first iteration after initial point or back to change path
+            decisionlist[-1]["last_edge"]=bestedge
+            decisionlist[-1]["last_edge_reverse"]=reversedict[bestedge]
+
+            decisionlist[-1]["offset"]=offset
+            decisionlist[-1]["result"].remove(bestedge)
+            decisionlist[-1]["reversedict"] = reversedict
+
+            if len(path)>0:
+                from_edge = path[-1]["edge"]
+                from_reverse = path[-1]["reverse"]
+            else:
+                from_edge = None
+                from_reverse = False
 
-                if decision == "STAY":
-                    edges = {last_edge}
-                    reversedict = {last_edge:last_edge_reverse}
+            edgelength = self.net.combinedShapeLength(bestedge, from_edge,
+                                                      reversedict[bestedge], from_reverse)
 
-                elif decision == "CHANGE" and last_edge!=None:
-                    edges, reversedict = self.outgoinglist(last_edge, last_edge_reverse)
+            self._path_append(context, {"edge":bestedge, "reverse":reversedict[bestedge],
+                                      "length":edgelength})
 
-                elif decision == "NODECISION":
-                    edges, reversedict = self.outgoinglist(last_edge, last_edge_reverse)    
-                    edges.add(last_edge)
-                    reversedict[last_edge] = last_edge_reverse
-                
+            last_edge = bestedge
+            last_edge_reverse = reversedict[bestedge]
 
+            if stats is not None:
+                stats.event("start", index=index, edge=bestedge.getID(), reverse=last_edge_reverse)
 
-                #print(f"index = {index}, decision = {decision}")
-                #print(decisionlist[-1]["result"])
-                #if index+1 < len(sample_gps):
-                #    next_time = sample_gps.iloc[index+1]["timestamp"]
-                x, y = row.x, row.y
-                edgesinfo = []
-                
 
+        elif bestedge==last_edge: # stay on edge
+            decisionlist[-1]["offset"]=offset
+
+
+        else: # changing edge
+
+            if last_edge in edges:
+                edges.remove(last_edge)
+
+            edges.remove(bestedge)
+
+            if len(path)>0:
+                from_edge = path[-1]["edge"]
+                from_reverse = path[-1]["reverse"]
+            else:
+                from_edge = None
+                from_reverse = False
+
+            edgelength = self.net.combinedShapeLength(bestedge, from_edge,
+                                                      reversedict[bestedge], from_reverse)
+
+            self._path_append(context, {"edge":bestedge, "reverse":reversedict[bestedge],
+                                      "length":edgelength})
+
+            last_edge = bestedge
+            last_edge_reverse = reversedict[bestedge]
+
+            decisionlist.append({"index":index, "result":edges, "last_edge":bestedge,
+                                 "offset":last_offset, "last_edge_reverse":reversedict[bestedge],
+                                "reversedict":reversedict})
+
+            if stats is not None:
+                stats.event("change", index=index, edge=bestedge.getID(), reverse=last_edge_reverse)
+
+
+        if last_edge!= decisionlist[-1]["last_edge"]:
+            raise ValueError("error 2 in the algorithm.")
+
+        context.last_edge = last_edge
+        context.last_offset = last_offset
+        context.last_edge_reverse = last_edge_reverse
+        if stats is not None:
+            stats.add_time("update", start)
+        return index + 1, False
+
+
+
+
+    def match_viterbi(self, sample_gps, budget=None):
+        """
+        Matches GPS observations with a beam-limited Viterbi search.
+
+        Every point keeps at most BEAM_WIDTH candidate states (edge, reverse),
+        each with the cheapest chain of cost_calculate costs leading to it.
+        Transitions follow the same stay/change decision and outgoinglist as
+        match, and candidates farther than the search radius are discarded.
+        There is no backtracking, so the work is bounded by
+        points x BEAM_WIDTH x transitions.
+
+        Args:
+            sample_gps: GPS observations, as in match.
+            budget (float): Time limit in seconds, as in match_trajectory.
+
+        Returns:
+            int: 1 if successful (result in self.matchdf), 0 otherwise.
+
+        """
+        return self._keep(self._timed_match(self._viterbi_match, sample_gps, budget))
+
+
+    def _viterbi_match(self, points, deadline=None):
+        """MatchContext with the cheapest Viterbi chain of points in matchedpoints."""
+        context = MatchContext(stats=self.new_stats())
+        context.status = "ok"
+        stats = context.stats
+        layer = []
+        for index, row in enumerate(points):
+            if deadline is not None and time.perf_counter() > deadline:
+                # the cheapest chain up to the last point of the lattice
+                if stats is not None:
+                    stats.event("timeout", index=index)
+                context.status = "timeout"
+                break
+            context.steps += 1
+            if stats is not None:
+                stats.counters["points"] += 1
+            states = {}
+            if len(layer) > 0:
+                self._viterbi_states(states, index, row, layer, stats=stats)
+            if len(states) == 0:
+                # first point, or no transition fits: start again from the edges around the point
+                prev = min(layer, key=lambda state:state["cost"]) if len(layer) > 0 else None
+                if stats is not None and prev is not None:
+                    stats.event("restart", index=index)
+                edges, reversedict = self.first_point_matching(row["x"], row["y"], row["bearing"], row["speed"])
                 if len(edges) > 0:
-                    for edge in edges:
-
-                       
-                        if (edge!=last_edge and last_edge!=None):
-                            temp_edge = last_edge
-                            #print(f"last_edge = {last_edge}, reversedict = {reversedict}")
-                            temp_reverse = last_edge_reverse
-                            #print(f"{index} , last_edge_reverse = {last_edge_reverse}")
-
-                        elif len(self.path)<2:
-                            temp_edge = None
-                            temp_reverse = False
-                        else:
-                            temp_edge = self.path[-2]["edge"]
-                            temp_reverse = self.path[-2]["reverse"]
-                            #print(f"{index} , from_reverse = {from_reverse}")
-
-                        currentedge_shape = combineShapesSumo(edge,temp_edge, reversedict[edge],temp_reverse)
-                        #print(f"index = {index}, edge = {edge.getID()}, temp_edge={temp_edge}")
-                        #print(f" reverseedge={reversedict[edge]}, temp_reverse = {temp_reverse}")
-
-                        currentedge_length = polyLength(currentedge_shape)
-                        #print(currentedge_length)
-                        tempedge_length = polyLength(currentedge_shape)
-                        offset , matchpoint= polygonOffsetWithMinimumDistanceToPoint([x,y], currentedge_shape)
-                        #if(len(matchedpoints)>0):
-                        #    if(last_edge!=None):
-                        #        if(edge==last_edge):
-                        #            offset = max(offset, last_offset)
-
-                        #matchpoint = geomhelper.positionAtShapeOffset(currentedge_shape, offset)
-
-                        dist = distance2d(matchpoint, (x,y))
-
-                        matched_bearing = offsetBearing(currentedge_shape, offset)
-                        dist_bearing = min(abs(row.bearing - matched_bearing), 360-abs(row.bearing - matched_bearing))
-
-                        if(len(matchedpoints)>0):
-                            lastedgeinfo = matchedpoints[-1]
-                            last_edge_length = lastedgeinfo["edge_length"]
-                            lastedge = self.net.getEdge(lastedgeinfo["edgeid"])
-                            lastoffset = lastedgeinfo["offset"]
-                            lasttimestamp = lastedgeinfo["timestamp"]
-                            last_sample =(lastedgeinfo["x_sample"],lastedgeinfo["y_sample"])
-                            last_matched= (lastedgeinfo["x"],lastedgeinfo["y"])
-
-                        else:
-                            lastedge = edge
-                            lastoffset = offset
-                            lasttimestamp = row.timestamp
-                            last_sample = (x,y)
-                            last_matched= matchpoint
-                            last_edge_length = 0
-
-                        air_sample_distance = distance2d(last_sample, (x,y)) #row.distance 
-                        air_matched_distance = distance2d(last_matched, matchpoint)
-                        cost_air = abs(air_sample_distance - air_matched_distance)
-
-                        speed = row.speed
-                        deltaTime = 1 #(int(row.timestamp) - int(lasttimestamp))
-
-                        #print(f"lattimestamp = {int(lasttimestamp)}, currenttimestamp = {int(row.timestamp)}, delta = {deltaTime}")
-                        predict_distance = float(speed) * deltaTime
-                        matched_road_distance =  road_distance(edge, offset, lastedge , lastoffset, last_edge_length)
-                        #print(f"index = {index}, edge = {edge.getID()}, offset={offset} lastoffset={lastoffset}")
-                        #print(f"lastge={lastedge.getID()}, lastedgelen = {last_edge_length} roaddistance = {matched_road_distance}")
-
-                        # rd is based on speed
-                        rd = abs(matched_road_distance - predict_distance)
-
-                        #if matched_road_distance == 0 and predict_distance > 3 and offset!=0:
-                        #    rd = rd*50
-                        cost = 1*dist_bearing + 10*dist  + 10*cost_air  +10*rd
-                        cost = self.cost_calculate(dist_bearing, dist, cost_air, rd, reversedict[edge])
-
-                        edgesinfo.append({"edge":edge, "dist":dist, "matchbearing":matched_bearing, "timestamp":row.timestamp,
-                                          "predict_distance":predict_distance, "matched_road_distance": matched_road_distance,
-                                          "speed":speed, "cost_air":cost_air,"from_edge":temp_edge.getID() if temp_edge!=None else None,
-                                         "cost":cost, "matchpoint":matchpoint, "offset":offset, "distbearing":dist_bearing, "rd":rd,
-                                         "edge_length":currentedge_length, "from_edge_reverse":temp_reverse})
-
-
-                    bestedgeinfo = min(edgesinfo, key=lambda item:item["cost"])
-
-                    matchpoint = bestedgeinfo["matchpoint"]
-                    matchbearing = bestedgeinfo["matchbearing"]
-                    bestedge = bestedgeinfo["edge"]
-                    offset = bestedgeinfo["offset"]
-                    distbearing = bestedgeinfo["distbearing"]
-                    x,y = matchpoint
-                    #if index==176:
-                            #display(pd.DataFrame(edgesinfo))
-           
-                    if (bestedgeinfo["dist"] >  self.radius): # back to first changing edge and start on that point as initial point
-                        if bestedge in decisionlist[-1]["result"]:
-                            decisionlist[-1]["result"].remove(bestedge)
-
-                        counter = 0
-                        while len(decisionlist)>0 and len(decisionlist[-1]["result"])==0:
-                            counter+=1
-                            decisionlist.pop()
-                            #print(f"befor pop = {len(self.path)}")
-                            self.path.pop()
-                            #print(f"after pop = {len(self.path)}")
-                        
-                        if counter == 0:
-                            self.path.pop()
-                            
-                        if len(decisionlist)==0:
-                            print("error: decision list is empty!")
-                            return 0
-                       #if counter > 5:
-                       #     print(f"map error in index {index} and timestamp {row.timestamp} ...")
-                       #     return 0
-                        decisionlist[-1]["offset"] = None
-
-                        decisionlist[-1]["last_edge"] = None
-                        decisionlist[-1]["last_edge_reverse"] = None
-                        #print(decisionlist[-1]["result"])
-                        myindex = decisionlist[-1]["index"]
-                        #print(f"len(decision) = {len(decisionlist)}")
-                        print(f"decision back index = {myindex}")
-                        self.show_path()
-                       
-                        try:
-                            while len(matchedpoints) > 0 and matchedpoints[-1]["index"]>=myindex :
-                                    matchedpoints.pop()
-                        except IndexError:
-                            print("indexError")
-                            return 0
-                        
-                        #ttt = [len(item["result"]) for item in decisionlist]
-                        #edgename = [e.getID() for e in decisionlist[-1]["result"]]
-                        #print(f"{ttt}, edges = {edgename}")
-
-                        last_offset = None
-                        last_edge = None
-                        last_edge_reverse = None
-
-
-                        break
-
-                    else:
-                        last_offset = offset
-
-                        matchedpoints.append({"index":index, "timestamp":row.timestamp, "x":x, "y":y,"bearing":row.bearing,
-                                              "rd":bestedgeinfo["rd"],"dist":bestedgeinfo["dist"],"from_edge":bestedgeinfo["from_edge"],
-                                              "predict_distance":bestedgeinfo["predict_distance"],"speed":bestedgeinfo["speed"],
-                                              "matched_road_distance": bestedgeinfo["matched_road_distance"],"y_sample":row.y,
-                                              "x_sample":row.x, "cost_air": bestedgeinfo["cost_air"],"decitsion":decision,
-                                              "matchbearing":matchbearing, "edgeid":bestedge.getID(), "offset":offset, "distbearing":distbearing,
-                                             "edge_length":bestedgeinfo["edge_length"],"type":row["type"], "edge_reverse":reversedict[bestedge],
-                                            "from_edge_reverse":bestedgeinfo["from_edge_reverse"]})
- 
-                        
-                        if last_edge==None:   # first iteration after initial point or back to change path
-                            decisionlist[-1]["last_edge"]=bestedge
-                            decisionlist[-1]["last_edge_reverse"]=reversedict[bestedge]
-
-                            decisionlist[-1]["offset"]=offset
-                            decisionlist[-1]["result"].remove(bestedge)
-                            decisionlist[-1]["reversedict"] = reversedict
-                        
-                            
-                            if len(self.path)>0:
-                                from_edge = self.path[-1]["edge"]
-                                from_reverse = self.path[-1]["reverse"]
-                            else:
-                                from_edge = None
-                                from_reverse = False
-                                
-                            edgelength = polyLength(combineShapesSumo(bestedge,from_edge,
-                                                                                   reversedict[bestedge], from_reverse))
-                            
-                            self.path.append({"edge":bestedge, "reverse":reversedict[bestedge],
-                                             "length":edgelength})
-                            
-                    
-                            last_offset = offset
-                            last_edge = bestedge
-                            last_edge_reverse = reversedict[bestedge]
-                                #print(f"len(decision) = {len(decisionlist)}")
-
-                            print(f"decision index start = {index}")
-                            self.show_path()
-
-
-                        elif bestedge==last_edge: # stay on edge
-                            decisionlist[-1]["offset"]=offset
-                            last_offset = offset
-
-
-
-
-                        elif bestedge!=last_edge :#and last_edge!=None: # changing edge
-
-                            if last_edge in edges:
-                                edges.remove(last_edge)
-
-                            edges.remove(bestedge)
-                           
-                            if len(self.path)>0:
-                                from_edge = self.path[-1]["edge"]
-                                from_reverse = self.path[-1]["reverse"]
-                            else:
-                                from_edge = None
-                                from_reverse = False
-                                
-                            edgelength = polyLength(combineShapesSumo(bestedge,from_edge,
-                                                                                   reversedict[bestedge], from_reverse))
-                            
-                            self.path.append({"edge":bestedge, "reverse":reversedict[bestedge],
-                                             "length":edgelength})
-
-                            last_edge = bestedge
-                            last_offset = offset
-                            last_edge_reverse = reversedict[bestedge]
-
-                            if(len(edges)>=0): 
-                                decisionlist.append({"index":index, "result":edges, "last_edge":bestedge,
-                                                     "offset":last_offset, "last_edge_reverse":reversedict[bestedge],
-                                                    "reversedict":reversedict})
-                                
-                                #ttt = [len(item["result"]) for item in decisionlist]
-                                #index_list = [item["index"] for item in decisionlist]
-                                #mpath = [item["last_edge"].getID() for item in decisionlist]
-                                #print(f"len(decision) = {len(decisionlist)}")
-
-                                print(f"decision index = {index}")
-                                self.show_path()
-
-                                #print(f"path = {mpath}")
-
-
-                        if last_edge!= decisionlist[-1]["last_edge"]:
-                            raise ValueError("error 2 in the algorithm.")
-                        
-                        myindex = index
-            
+                    self._viterbi_states(states, index, row, [None], [(edges, reversedict, "CHANGE")], prev, stats)
+                if len(states) == 0:
+                    continue
+            layer = heapq.nsmallest(self.BEAM_WIDTH, states.values(), key=lambda state:state["cost"])
+
+        if len(layer) == 0:
+            if context.status == "ok":
+                if stats is not None:
+                    stats.event("failed", index=len(points) - 1)
+                context.status = "failed"
+            return context
+        state = min(layer, key=lambda state:state["cost"])
+        matchedpoints = context.matchedpoints
+        while state is not None:
+            matchedpoints.append(self.match_record(state["index"], state["row"], state["scores"], state["k"],
+                                                   state["edge"], state["reverse"], state["from_edge"],
+                                                   state["from_reverse"], state["decision"]))
+            state = state["prev"]
+        matchedpoints.reverse()
+        return context
+
+
+    def _viterbi_candidates(self, link, row):
+        """Candidate edges of the point after the state link, with the decision of match_point."""
+        edge, reverse = link["edge"], link["reverse"]
+        decision = self.decision_stay_change_nodecide(link["edge_length"] - link["offset"],
+                                                      row["speed"], edge.getSpeed(), 1)
+        if decision == "STAY":
+            return (edge,), {edge:reverse}, decision
+        edges, reversedict = self.transitiontable.get(edge, reverse)
+        if not self.LOOP:
+            visited = link["visited"]
+            edges = tuple(edge for edge in edges if edge not in visited)
+        if decision == "NODECISION":
+            if edge not in edges:
+                edges = edges + (edge,)
+            if reversedict.get(edge) != reverse:
+                reversedict = dict(reversedict)
+                reversedict[edge] = reverse
+        return edges, reversedict, decision
+
+
+    def _viterbi_states(self, states, index, row, layer, candidates=None, prev=None, stats=None):
+        """
+        Scores the transitions from the states of the previous point in one
+        call and keeps the cheapest state per (edge, reverse).
+
+        Args:
+            states (dict): (edge, reverse) -> state of the point, updated in place.
+            layer (list): States of the previous point, or [None] when the chain
+                (re)starts at this point.
+            candidates (list): (edges, reversedict, decision) of each state,
+                from _viterbi_candidates by default.
+            prev (dict): State a restarted chain continues from.
+            stats (MatchStats): Instrumentation of the match (optional).
+
+        """
+        if stats is not None:
+            start = time.perf_counter()
+        if candidates is None:
+            candidates = [self._viterbi_candidates(link, row) for link in layer]
+        edgelist = []
+        reverses = []
+        from_edges = []
+        from_reverses = []
+        last = []
+        owners = []
+        for n, (link, (edges, reversedict, decision)) in enumerate(zip(layer, candidates)):
+            if link is not None:
+                linklast = (link["edge"], link["offset"], link["edge_length"], (link["row"]["x"], link["row"]["y"]),
+                            (link["x"], link["y"]))
+            for edge in edges:
+                edgelist.append(edge)
+                reverses.append(reversedict[edge])
+                owners.append(n)
+                if link is None:
+                    from_edges.append(None)
+                    from_reverses.append(False)
+                    last.append(None)
+                elif edge != link["edge"]:
+                    from_edges.append(link["edge"])
+                    from_reverses.append(link["reverse"])
+                    last.append(linklast)
                 else:
-                    raise ValueError("error in the algorithm. ln(edges)==0")
-            if index== len(sample_gps) - 1:
-                myindex = index+1
-            current_time = time.time()
-
-            # Calculate the elapsed time
-            if(current_time - start_time) > 10:
-                print(f"runnig time is more than {self.MAX_RUNNING_TIME} seconds.")
-                return 0
-        self.matchdf = pd.DataFrame(matchedpoints)
-
-        return 1
-    
-    
-    
-        
+                    from_edges.append(link["from_edge"])
+                    from_reverses.append(link["from_reverse"])
+                    last.append(linklast)
+        if len(edgelist) == 0:
+            return
+        if stats is not None:
+            start = stats.add_time("candidates", start)
+        scores = self.score_candidates(row, edgelist, reverses, from_edges, from_reverses, last)
+        if stats is not None:
+            start = stats.add_time("scoring", start)
+            counters = stats.counters
+            counters["candidates"] += len(edgelist)
+        for k in np.flatnonzero(scores["dist"] <= self.radius).tolist():
+            link = layer[owners[k]]
+            before = link if link is not None else prev
+            cost = float(scores["cost"][k]) + (before["cost"] if before is not None else 0)
+            key = (edgelist[k], reverses[k])
+            if key in states and states[key]["cost"] <= cost:
+                continue
+            visited = None
+            if not self.LOOP:
+                # edges of the chain up to this state, shared with the parent while the edge stays
+                visited = before["visited"] if before is not None else frozenset()
+                if edgelist[k] not in visited:
+                    visited = visited | {edgelist[k]}
+            states[key] = {"edge":edgelist[k], "reverse":reverses[k], "from_edge":from_edges[k],
+                           "from_reverse":from_reverses[k], "offset":float(scores["offset"][k]),
+                           "edge_length":float(scores["edge_length"][k]), "x":float(scores["x"][k]),
+                           "y":float(scores["y"][k]), "cost":cost, "prev":before, "index":index,
+                           "row":row, "scores":scores, "k":k, "decision":candidates[owners[k]][2],
+                           "visited":visited}
+        if stats is not None:
+            stats.add_time("update", start)
+
+
+    def _sparse_match(self, points, deadline=None):
+        """
+        MatchContext of ENGINE="sparse": a beam-limited Viterbi search over the
+        edges around every point, with transitions scored by the network
+        distance between the matched positions over the real time between
+        the fixes. The path holds the complete route, including the edges
+        between the matched ones.
+        """
+        context = MatchContext(stats=self.new_stats())
+        context.status = "ok"
+        stats = context.stats
+        net = self.net
+        router = net.getRouter("length")
+        pointindex, edgeindex, _ = net.getNeighboringEdgesBatch([point["x"] for point in points],
+                                                                [point["y"] for point in points], self.radius)
+        bounds = np.searchsorted(pointindex, np.arange(len(points) + 1))
+        layer = []
+        lastrow = None
+        for index, row in enumerate(points):
+            if deadline is not None and time.perf_counter() > deadline:
+                if stats is not None:
+                    stats.event("timeout", index=index)
+                context.status = "timeout"
+                break
+            context.steps += 1
+            if stats is not None:
+                stats.counters["points"] += 1
+            edges = [net.getEdgeByIndex(i) for i in edgeindex[bounds[index]:bounds[index + 1]].tolist()]
+            if len(edges) == 0:
+                continue
+            states = {}
+            if len(layer) > 0:
+                self._sparse_states(states, router, layer, lastrow, index, row, edges, stats)
+            if len(states) == 0:
+                # first point, or no route fits: start again at this point
+                prev = min(layer, key=lambda state:state["cost"]) if len(layer) > 0 else None
+                if stats is not None and prev is not None:
+                    stats.event("restart", index=index)
+                self._sparse_states(states, router, [None], row, index, row, edges, stats, prev)
+            layer = heapq.nsmallest(self.BEAM_WIDTH, states.values(), key=lambda state:state["cost"])
+            lastrow = row
+
+        if len(layer) == 0:
+            if context.status == "ok":
+                if stats is not None:
+                    stats.event("failed", index=len(points) - 1)
+                context.status = "failed"
+            return context
+        chain = []
+        state = min(layer, key=lambda state:state["cost"])
+        while state is not None:
+            chain.append(state)
+            state = state["prev"]
+        chain.reverse()
+        from_edge = None
+        for n, state in enumerate(chain):
+            route = []
+            if n == 0 or state["edge"] != chain[n - 1]["edge"]:
+                route = [state["edge"]]
+                from_edge = None
+                if n > 0 and state["routed"]:
+                    # the edge before this one is the last hop of the route, not the last matched edge
+                    route = router.shortestPath(chain[n - 1]["edge"], state["edge"])[0]
+                    from_edge = route[-2]
+                    route = route[1:]
+            context.matchedpoints.append(self.match_record(state["index"], state["row"], state["scores"], state["k"],
+                                                           state["edge"], False, from_edge, False,
+                                                           state["decision"]))
+            for edge in route:
+                context.path.append({"edge":edge, "reverse":False, "length":edge.getLength()})
+        return context
+
+
+    def _sparse_states(self, states, router, layer, lastrow, index, row, edges, stats=None, prev=None):
+        """
+        Scores the transitions from the states of the previous fix to the
+        candidate edges of a fix and keeps the cheapest state per edge.
+
+        Args:
+            states (dict): edge -> state of the fix, updated in place.
+            router (routing.Router): Length router of the network.
+            layer (list): States of the previous fix, or [None] when the chain
+                (re)starts at this fix.
+            lastrow (dict): The previous fix.
+            edges (list): Candidate edges of the fix.
+            stats (MatchStats): Instrumentation of the match (optional).
+            prev (dict): State a restarted chain continues from.
+
+        """
+        if stats is not None:
+            start = time.perf_counter()
+        count = len(edges)
+        x, y = row["x"], row["y"]
+        offset, mx, my, shapelength, matchbearing = self.net.projectOnEdges(edges, x, y, [None] * count,
+                                                                            [False] * count, [False] * count)
+        dist = ((mx - x) ** 2 + (my - y) ** 2) ** 0.5
+        distbearing = np.abs(row["bearing"] - matchbearing)
+        distbearing = np.minimum(distbearing, 360 - distbearing)
+        # positions in the edge lengths of the router
+        length = np.array([edge.getLength() for edge in edges])
+        position = offset * np.divide(length, shapelength, out=np.ones(count), where=shapelength > 0)
+        if stats is not None:
+            start = stats.add_time("candidates", start)
+            stats.counters["candidates"] += count
+
+        if layer[0] is None:
+            # start of a chain: the fix itself is the previous one
+            road = np.zeros((1, count))
+            air = np.zeros((1, count))
+            predict_distance = 0.0
+        else:
+            deltatime = max(float(row["timestamp"]) - float(lastrow["timestamp"]), 1.0)
+            predict_distance = (float(lastrow["speed"]) + float(row["speed"])) / 2 * deltatime
+            sample_distance = distance2d((lastrow["x"], lastrow["y"]), (x, y))
+            limit = min(self.MAX_SPEED * deltatime,
+                        2 * max(sample_distance, predict_distance) + 2 * self.radius) + self.DIFF_GPS_ERROR
+            targets = [edge.getIndex() for edge in edges]
+            trees = {}
+            road = np.full((len(layer), count), np.inf)
+            for i, link in enumerate(layer):
+                source = link["edge"]
+                tree = trees.get(source)
+                if tree is None:
+                    maxposition = max(state["position"] for state in layer if state["edge"] == source)
+                    tree = trees[source] = router.distancesFrom(source.getIndex(), limit + maxposition, targets)
+                for j, edge in enumerate(edges):
+                    if edge == source:
+                        if position[j] >= link["position"] - self.DIFF_GPS_ERROR:
+                            road[i, j] = max(0.0, position[j] - link["position"])
+                    elif targets[j] in tree:
+                        road[i, j] = tree[targets[j]] - link["position"] + position[j]
+            road[road > limit] = np.inf
+            lastx = np.array([link["x"] for link in layer])
+            lasty = np.array([link["y"] for link in layer])
+            air = np.abs(sample_distance - np.hypot(lastx[:, None] - mx, lasty[:, None] - my))
+        rd = np.abs(road - predict_distance)
+        cost = self.cost_calculate(distbearing, dist, air, rd, False)
+        if layer[0] is None:
+            cost = cost + (prev["cost"] if prev is not None else 0)
+        else:
+            cost = cost + np.array([link["cost"] for link in layer])[:, None]
+        cost[~np.isfinite(road)] = np.inf
+        best = np.argmin(cost, axis=0)
+        columns = np.arange(count)
+        scores = {"offset":offset, "x":mx, "y":my, "edge_length":shapelength, "matchbearing":matchbearing,
+                  "dist":dist, "distbearing":distbearing, "cost_air":air[best, columns],
+                  "predict_distance":predict_distance, "matched_road_distance":road[best, columns],
+                  "rd":rd[best, columns], "cost":cost[best, columns]}
+        if stats is not None:
+            start = stats.add_time("scoring", start)
+        for k in np.flatnonzero(np.isfinite(scores["cost"])).tolist():
+            link = layer[best[k]]
+            edge = edges[k]
+            if link is None:
+                before, decision = prev, "CHANGE"
+            else:
+                before = link
+                decision = "STAY" if edge == link["edge"] else "CHANGE"
+            cost = float(scores["cost"][k])
+            if edge in states and states[edge]["cost"] <= cost:
+                continue
+            states[edge] = {"edge":edge, "position":float(position[k]),
+                            "x":float(mx[k]), "y":float(my[k]), "cost":cost, "prev":before,
+                            "routed":link is not None, "index":index, "row":row, "scores":scores, "k":k,
+                            "decision":decision}
+        if stats is not None:
+            stats.add_time("update", start)
+
+
     def save_routematch(self, routematchfile=None):
         """
         Saves the route matching results to a file and returns the route dataframe.
@@ -546,8 +1640,188 @@ class MapMatcher:
             self.matchdf.to_csv(pointmatchfile, index=False)
         return self.matchdf
 
-    def show_path(self):
-        print([item["edge"].getID() for item in self.path])
+    def show_path(self, path=None):
+        print([item["edge"].getID() for item in (self.path if path is None else path)])
+
+
+class MatchSession:
+    """
+    Online map matching of one vehicle's GPS feed.
+
+    Points are pushed as they arrive and matched with the same steps as
+    MapMatcher.match. Only the last `window` points can still be revised by
+    backtracking; older alternatives are dropped and their points finalized,
+    so the state and the latency per point stay bounded for feeds of any
+    length. When no alternative is left the session starts over at the point
+    that could not be matched (counted in `breaks`).
+
+    Example:
+
+        session = MatchSession(MapMatcher(net), window=120)
+        for point in feed:
+            for matched in session.push(point):
+                publish(matched)
+        remaining = session.close()
+    """
+
+    def __init__(self, matcher, window=120):
+        """
+        Args:
+            matcher (MapMatcher): Matcher providing the network and parameters.
+            window (int): Number of recent points that can still be revised.
+
+        """
+        if not isinstance(matcher, MapMatcher):
+            raise ValueError("MapMatcher expected")
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        self.matcher = matcher
+        self.window = window
+        self.breaks = 0       # restarts after no alternative was left
+        self.unmatched = 0    # points without a candidate edge
+        self.finalized = 0
+        self._points = []     # points from index self._base on
+        self._base = 0
+        self._next = 0        # next point to match
+        self._start = None    # first point of the current context
+        self._context = None
+        self._ready = []
+        self.projectioncache = (ProjectionCache(matcher.PROJECTION_CACHE_SIZE)
+                                if matcher.PROJECTION_CACHE_SIZE > 0 else None)
+        self.stats = matcher.new_stats()  # MatchStats of the whole feed, or None
+
+
+    def push(self, point):
+        """
+        Adds a GPS point and matches it.
+
+        Args:
+            point (dict): Point with x, y, timestamp, speed, bearing and type
+                (a pandas row or namedtuple also works).
+
+        Returns:
+            list: Point matches finalized by this point, as rows of matchdf.
+
+        """
+        self._points.append(self._point(point))
+        self._advance()
+        return self._finalize()
+
+
+    def push_batch(self, points):
+        """
+        Adds several GPS points and matches them.
+
+        Args:
+            points: DataFrame, dict of column arrays or structured array
+                (see gps_points), or an iterable of points as in push.
+
+        Returns:
+            list: Point matches finalized by these points, as rows of matchdf.
+
+        """
+        columns = gps_points(points)
+        if columns is not None:
+            self._points.extend(columns)
+        else:
+            self._points.extend(self._point(point) for point in points)
+        self._advance()
+        return self._finalize()
+
+
+    def close(self):
+        """
+        Finalizes all pending matches and ends the session.
+
+        Returns:
+            list: The remaining point matches, as rows of matchdf.
+
+        """
+        if self._context is not None:
+            self._ready.extend(self._context.matchedpoints)
+            self._context = None
+        self._points = []
+        self._base = self._next
+        ready, self._ready = self._ready, []
+        self.finalized += len(ready)
+        if self.stats is not None:
+            self.stats.count_decisions(ready)
+        return ready
+
+
+    def pending(self):
+        """Number of matched points that can still be revised."""
+        return 0 if self._context is None else len(self._context.matchedpoints)
+
+
+    def _point(self, point):
+        if hasattr(point, "_asdict"):
+            return point._asdict()
+        return dict(point)
+
+
+    def _advance(self):
+        matcher = self.matcher
+        while self._next < self._base + len(self._points):
+            row = self._points[self._next - self._base]
+            if self._context is None:
+                edges, reversedict = matcher.first_point_matching(row["x"], row["y"], row["bearing"], row["speed"])
+                if len(edges) == 0:
+                    self.unmatched += 1
+                    self._next += 1
+                    continue
+                self._context = matcher.new_context(self._next, edges, reversedict, self.projectioncache, self.stats)
+                self._start = self._next
+            index, backtrack = matcher.match_point(self._context, self._next, row)
+            if index is None:
+                # nothing left to revise: keep the matches so far and start over
+                self.breaks += 1
+                if self.stats is not None:
+                    self.stats.event("restart", index=self._next)
+                self._ready.extend(self._context.matchedpoints)
+                self._context = None
+                if self._next == self._start:
+                    self.unmatched += 1
+                    self._next += 1
+                continue
+            self._next = index
+
+
+    def _finalize(self):
+        keep = self._next
+        context = self._context
+        if context is not None:
+            decisionlist = context.decisionlist
+            for decision in decisionlist:
+                if self._next - 1 - decision["index"] >= self.window:
+                    decision["result"] = set()
+            while len(decisionlist) > 1 and len(decisionlist[0]["result"]) == 0:
+                decisionlist.pop(0)
+            # a backtrack pops at most one path item per decision, plus one
+            path = context.path
+            while len(path) > len(decisionlist) + 2:
+                self.matcher._path_pop(context, 0)
+            # the earliest decision with an alternative is the furthest a backtrack can go
+            for decision in decisionlist:
+                if len(decision["result"]) > 0:
+                    keep = decision["index"]
+                    break
+            matchedpoints = context.matchedpoints
+            count = 0
+            while count < len(matchedpoints) and matchedpoints[count]["index"] < keep:
+                count += 1
+            if count > 0:
+                self._ready.extend(matchedpoints[:count])
+                context.lastpoint = matchedpoints[count - 1]
+                del matchedpoints[:count]
+        if keep > self._base:
+            del self._points[:keep - self._base]
+            self._base = keep
+        ready, self._ready = self._ready, []
+        self.finalized += len(ready)
+        if self.stats is not None:
+            self.stats.count_decisions(ready)
+        return ready
 
 
 # Example usage
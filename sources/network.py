@@ -5,8 +5,10 @@ import math
 from shapely.geometry import LineString
 import time
 import numpy as np
+import json
+import struct
 import geotools
-import rtree
+import spatialindex
 import pyproj
 import osmnx as ox
 
@@ -17,6 +19,7 @@ class Node:
     def __init__(self, coord=None, id=None):
         self.coord = coord
         self.id = id
+        self.index = None  # position in Net._nodeidlist
         self.outgoing = []  # list of edges
         self.incoming = []  # list of edges
 
@@ -29,6 +32,9 @@ class Node:
 
     def getID(self):
         return self.id
+
+    def getIndex(self):
+        return self.index
     
     def getIncoming(self):
         return self.incoming.copy()
@@ -50,6 +56,7 @@ class Edge:
         self.length = length
         self.shape = shape
         self.id = id
+        self.index = None  # position in Net._edgeidlist
         self.incoming = []  # list of edges
         self.outgoing = []  # list of edges
 
@@ -67,6 +74,9 @@ class Edge:
 
     def getID(self):
         return self.id
+
+    def getIndex(self):
+        return self.index
     
     def getShape(self):
         return self.shape.copy()
@@ -85,20 +95,170 @@ class Edge:
     
     def getBoundingBox(self):
         return geotools.getBoundingBox(self.shape)
-    
 
 
 
+#########  compact backend  #####################
+# The compact backend keeps the whole network in the flat arrays built by
+# Net._buildArrays. CompactNode/CompactEdge are small handles (one per
+# node/edge, created once) that read from those arrays, so the accessors
+# return views instead of copying lists.
+
+class EdgeView:
+    """
+    Read-only sequence of edges backed by a slice of a CSR index array.
+
+    Supports len(), indexing, iteration, membership and concatenation
+    with another sequence (which returns a new list).
+    """
+    __slots__ = ("_net", "_idx")
+
+    def __init__(self, net, idx):
+        self._net = net
+        self._idx = idx
+
+    def __len__(self):
+        return len(self._idx)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return EdgeView(self._net, self._idx[i])
+        return self._net._edgeobjs[self._idx[i]]
+
+    def __iter__(self):
+        edgeobjs = self._net._edgeobjs
+        return (edgeobjs[i] for i in self._idx.tolist())
+
+    def __contains__(self, edge):
+        index = getattr(edge, "index", None)
+        return index is not None and bool((self._idx == index).any())
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return f"EdgeView({[e.getID() for e in self]})"
+
+    def indices(self):
+        """Edge indices of the view (zero-copy)."""
+        return self._idx
+
+
+class CompactNode:
+    __slots__ = ("_net", "index")
+
+    def __init__(self, net, index):
+        self._net = net
+        self.index = index
+
+    def getID(self):
+        return self._net._nodeidlist[self.index]
+
+    def getIndex(self):
+        return self.index
+
+    def getIncoming(self):
+        net = self._net
+        return EdgeView(net, net._nodeInIdx[net._nodeInPtr[self.index]:net._nodeInPtr[self.index + 1]])
+
+    def getOutgoing(self):
+        net = self._net
+        return EdgeView(net, net._nodeOutIdx[net._nodeOutPtr[self.index]:net._nodeOutPtr[self.index + 1]])
+
+    def getCoord(self):
+        return self._net._nodeCoords[self.index]
+
+    def __repr__(self):
+        return f"<CompactNode {self.getID()}>"
+
+
+class CompactEdge:
+    __slots__ = ("_net", "index")
+
+    def __init__(self, net, index):
+        self._net = net
+        self.index = index
+
+    def getID(self):
+        return self._net._edgeidlist[self.index]
+
+    def getIndex(self):
+        return self.index
+
+    def getIncoming(self):
+        net = self._net
+        return EdgeView(net, net._edgeInIdx[net._edgeInPtr[self.index]:net._edgeInPtr[self.index + 1]])
+
+    def getOutgoing(self):
+        net = self._net
+        return EdgeView(net, net._edgeOutIdx[net._edgeOutPtr[self.index]:net._edgeOutPtr[self.index + 1]])
+
+    def getShape(self):
+        net = self._net
+        return net._shapeCoords[net._shapeOffsets[self.index]:net._shapeOffsets[self.index + 1]]
+
+    def getSpeed(self):
+        return float(self._net._edgeSpeed[self.index])
+
+    def getLength(self):
+        return float(self._net._edgeLength[self.index])
+
+    def getToNode(self):
+        return self._net._nodeobjs[self._net._edgeTo[self.index]]
+
+    def getFromNode(self):
+        return self._net._nodeobjs[self._net._edgeFrom[self.index]]
+
+    def getBoundingBox(self):
+        return tuple(self._net._edgeBBox[self.index].tolist())
+
+    def __repr__(self):
+        return f"<CompactEdge {self.getID()}>"
+
+
+def _csr(lists):
+    """Pack a list of integer lists into CSR (pointer, index) arrays."""
+    ptr = np.zeros(len(lists) + 1, dtype=np.int64)
+    ptr[1:] = np.cumsum([len(item) for item in lists])
+    idx = np.fromiter((i for item in lists for i in item), dtype=np.int32, count=int(ptr[-1]))
+    return ptr, idx
+
+
 class Net:
-    def __init__(self):
+    def __init__(self, compact=False, spatialindex="rtree", cellsize=100.0):
+        """
+        Args:
+            compact (bool): keep the network only in flat arrays (CSR adjacency,
+                one coordinate buffer for all shapes) and hand out lightweight
+                CompactEdge/CompactNode handles instead of Edge/Node objects.
+            spatialindex (str or type): spatial index backend used by
+                getNeighboringEdges: "rtree" (one box per edge), "segment"
+                (one box per shape segment), "grid" (uniform grid hash, no
+                rtree dependency) or a spatialindex.SpatialIndex subclass.
+            cellsize (float): cell size of the grid backend (meters), best
+                close to the query radius.
+        """
         self.outgoing = dict()
         self.incoming = dict()
         self.edges = dict()
         self.nodes = dict()
         self.geoproj = None
         self._location = dict()
+        self._offsetcache = None
+        self._transformers = None
         self._rtree = None
+        self._spatialindex = None
+        self._querycache = None
+        self.spatialindex = spatialindex
+        self.cellsize = cellsize
         self._edgeidlist = []
+        self._nodeidlist = []
+        self._edgeindex = dict()
+        self._routers = dict()
+        self.compact = compact
 
     def getNodes(self):
         return list(self.nodes.values())
@@ -112,6 +272,12 @@ class Net:
     def getEdge(self, n):
         return self.edges[n]
 
+    def getEdgeIndex(self, n):
+        return self._edgeindex[n]
+
+    def getEdgeByIndex(self, i):
+        return self.edges[self._edgeidlist[i]]
+
     def importFromSumoNet(self, snet):
 
         #set geoproj
@@ -157,7 +323,8 @@ class Net:
 
         
         self._edgeidlist = list(self.edges.keys())
-        self._rtree = self._initRTree()
+        self._buildArrays()
+        self._initSpatialIndex()
 
 
     def importFromOSM(self, osmfile):
@@ -218,9 +385,9 @@ class Net:
             etonode   = self.nodes[edge[1]]
             espeed    = G.edges[edge]["speed_kph"]*1000/3600 #km/h to m/s
             geometry = G.edges[edge]["geometry"]
-            eshape = []
-            for point in geometry.coords:
-                eshape.append(self.convertLonLat2XY(*point))   
+            lons, lats = np.asarray(geometry.coords, dtype=np.float64)[:, :2].T
+            xs, ys = self.convertLonLat2XYArray(lons, lats)
+            eshape = list(zip(xs.tolist(), ys.tolist()))
             elength = geotools.polyLength(eshape)
             e  = Edge(id=eid, fromnode=efromnode, tonode=etonode,
                             speed=espeed, length=elength, shape=eshape)
@@ -249,15 +416,119 @@ class Net:
                 edge.addIncoming(self.edges[item.getID()])
 
         self._edgeidlist = list(self.edges.keys())
-        self._rtree = self._initRTree()
+        self._buildArrays()
+        self._initSpatialIndex()
 
         self.G = G
 
 
 
+    def _buildArrays(self):
+        """
+        Packs topology and geometry into flat numpy arrays indexed by edge/node index.
+
+        Edge i is self._edgeidlist[i]; its shape is
+        self._shapeCoords[self._shapeOffsets[i]:self._shapeOffsets[i+1]].
+        Adjacency is stored as CSR (pointer, index) pairs. With compact=True the
+        Edge/Node objects are then replaced by CompactEdge/CompactNode handles.
+        """
+        edges = [self.edges[eid] for eid in self._edgeidlist]
+        self._nodeidlist = list(self.nodes.keys())
+        self._edgeindex = {eid: i for i, eid in enumerate(self._edgeidlist)}
+        nodeindex = {nid: i for i, nid in enumerate(self._nodeidlist)}
+        for i, e in enumerate(edges):
+            e.index = i
+        for nid, n in self.nodes.items():
+            n.index = nodeindex[nid]
+        nodes = [self.nodes[nid] for nid in self._nodeidlist]
+
+        self._shapeOffsets = np.zeros(len(edges) + 1, dtype=np.int64)
+        self._shapeOffsets[1:] = np.cumsum([len(e.shape) for e in edges])
+        self._shapeCoords = np.array([p[:2] for e in edges for p in e.shape],
+                                     dtype=np.float64).reshape(-1, 2)
+        self._edgeFrom = np.array([e.fromnode.index for e in edges], dtype=np.int32)
+        self._edgeTo = np.array([e.tonode.index for e in edges], dtype=np.int32)
+        self._edgeSpeed = np.array([np.nan if e.speed is None else e.speed for e in edges], dtype=np.float64)
+        self._edgeLength = np.array([e.length for e in edges], dtype=np.float64)
+        self._edgeBBox = np.array([e.getBoundingBox() for e in edges], dtype=np.float64).reshape(-1, 4)
+        self._nodeCoords = np.array([n.coord[:2] for n in nodes], dtype=np.float64).reshape(-1, 2)
+
+        self._edgeOutPtr, self._edgeOutIdx = _csr([[o.index for o in e.outgoing] for e in edges])
+        self._edgeInPtr, self._edgeInIdx = _csr([[o.index for o in e.incoming] for e in edges])
+        self._nodeOutPtr, self._nodeOutIdx = _csr([[o.index for o in n.outgoing] for n in nodes])
+        self._nodeInPtr, self._nodeInIdx = _csr([[o.index for o in n.incoming] for n in nodes])
+
+        self._buildSegments()
+        if self.compact:
+            self._initCompact()
+
+    def _buildSegments(self):
+        """
+        Derives the segment table from the shape buffer.
+
+        Segment s runs from point self._segStart[s] to self._segStart[s]+1 of
+        self._shapeCoords and belongs to edge self._segEdge[s]; the segments of
+        edge i are self._segOffsets[i]:self._segOffsets[i+1]. A shape with a
+        single point gets one zero-length segment.
+        """
+        npoints = np.diff(self._shapeOffsets)
+        nsegs = np.maximum(npoints - 1, 1)
+        self._segOffsets = np.zeros(len(npoints) + 1, dtype=np.int64)
+        self._segOffsets[1:] = np.cumsum(nsegs)
+        self._segEdge = np.repeat(np.arange(len(npoints), dtype=np.int32), nsegs)
+        local = np.arange(self._segOffsets[-1], dtype=np.int64) - np.repeat(self._segOffsets[:-1], nsegs)
+        self._segStart = np.repeat(self._shapeOffsets[:-1], nsegs) + local
+        # the end point of a single-point shape is its start point
+        self._segEnd = np.minimum(self._segStart + 1, np.repeat(self._shapeOffsets[1:], nsegs) - 1)
+
+        # geometry tables: length, unit vector and bearing of every segment,
+        # and the offset of its start along the edge shape
+        d = self._shapeCoords[self._segEnd] - self._shapeCoords[self._segStart]
+        self._segLength = np.sqrt(d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self._segUnit = np.where(self._segLength[:, None] > 0, d / self._segLength[:, None], 0.0)
+        bearing = np.degrees(np.arctan2(d[:, 0], d[:, 1]))
+        self._segBearing = np.where(bearing < 0, bearing + 360, bearing)
+        # the offsets are summed per edge, so they do not depend on the edges
+        # stored before it (a Tile and the Net agree) and the last segment ends
+        # exactly at the shape length: step k adds segment k-1 of every edge
+        # with more than k segments, edges sorted by descending segment count
+        self._segCumLength = np.zeros(len(self._segLength))
+        order = np.argsort(-nsegs, kind="stable")
+        counts = nsegs[order]
+        starts = self._segOffsets[:-1][order]
+        for k in range(1, int(counts[0]) if len(counts) else 0):
+            s = starts[:np.searchsorted(-counts, -k, side="left")] + k
+            self._segCumLength[s] = self._segCumLength[s - 1] + self._segLength[s - 1]
+        last = self._segOffsets[1:] - 1
+        self._shapeLength = self._segCumLength[last] + self._segLength[last]
+
+    def _initCompact(self):
+        """Replaces Edge/Node objects by handles onto the flat arrays."""
+        for a in (self._shapeCoords, self._nodeCoords, self._edgeBBox,
+                  self._edgeOutIdx, self._edgeInIdx, self._nodeOutIdx, self._nodeInIdx):
+            a.flags.writeable = False
+        self._nodeobjs = [CompactNode(self, i) for i in range(len(self._nodeidlist))]
+        self._edgeobjs = [CompactEdge(self, i) for i in range(len(self._edgeidlist))]
+        self.nodes = dict(zip(self._nodeidlist, self._nodeobjs))
+        self.edges = dict(zip(self._edgeidlist, self._edgeobjs))
+
     def getLocationOffset(self):
         """ offset to be added after converting from geo-coordinates to UTM"""
-        return list(map(float, self._location["netOffset"].split(",")))
+        # parsed once per netOffset string instead of on every conversion
+        netoffset = self._location["netOffset"]
+        if self._offsetcache is None or self._offsetcache[0] != netoffset:
+            self._offsetcache = (netoffset, tuple(map(float, netoffset.split(","))))
+        return list(self._offsetcache[1])
+
+    def _getTransformers(self):
+        """Cached (forward, inverse) pyproj.Transformer pair equivalent to self.geoproj."""
+        if self._transformers is None or self._transformers[0] is not self.geoproj:
+            crs = self.geoproj.crs
+            self._transformers = (self.geoproj,
+                                  pyproj.Transformer.from_crs(crs.geodetic_crs, crs, always_xy=True),
+                                  pyproj.Transformer.from_crs(crs, crs.geodetic_crs, always_xy=True))
+        return self._transformers[1:]
 
     def convertLonLat2XY(self, lon, lat, rawUTM=False):
         x, y = self.geoproj(lon, lat)
@@ -276,31 +547,523 @@ class Net:
         return self.geoproj(x, y, inverse=True)
 
 
-    def _initRTree(self):
-        result = rtree.index.Index()
-        result.interleaved = True
-        for ri in range(len(self._edgeidlist)):
-            edge = self.edges[self._edgeidlist[ri]]
-            result.add(ri, edge.getBoundingBox())
-        return result
+    def convertLonLat2XYArray(self, lon, lat, rawUTM=False):
+        """
+        Vectorized convertLonLat2XY.
+
+        Args:
+            lon, lat (array-like): geographic coordinates in degrees.
+            rawUTM (bool): return projected coordinates without the net offset.
+
+        Returns:
+            tuple: (x, y) numpy arrays.
+        """
+        forward, _ = self._getTransformers()
+        x, y = forward.transform(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        if rawUTM:
+            return x, y
+        x_off, y_off = self.getLocationOffset()
+        return x + x_off, y + y_off
+
+
+    def convertXY2LonLatArray(self, x, y, rawUTM=False):
+        """
+        Vectorized convertXY2LonLat.
+
+        Args:
+            x, y (array-like): network coordinates.
+            rawUTM (bool): the coordinates are projected ones without the net offset.
+
+        Returns:
+            tuple: (lon, lat) numpy arrays.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if not rawUTM:
+            x_off, y_off = self.getLocationOffset()
+            x = x - x_off
+            y = y - y_off
+        _, inverse = self._getTransformers()
+        return inverse.transform(x, y)
+
+
+    def _initSpatialIndex(self, state=None):
+        self._spatialindex = spatialindex.createSpatialIndex(self, self.spatialindex,
+                                                             cellsize=self.cellsize, state=state)
+        # kept for code that used the per-edge R-tree directly: the rtree.index.Index
+        # itself, whose queries are not serialized by the lock of the backend
+        queries = getattr(self._spatialindex, "_rtree", None)
+        self._rtree = None if queries is None else queries.index
+        if self._querycache is not None:
+            self.setQueryCache(self._querycache.cellsize, self._querycache.maxbytes)
+
+
+    def setQueryCache(self, cellsize=20.0, maxbytes=16 * 2**20):
+        """
+        Puts a spatialindex.QueryCache in front of getNeighboringEdges.
+
+        Useful when many queries repeat nearly the same locations, e.g. fleets
+        on the same corridors or the restarts of matching. The results are
+        the same as without the cache.
+
+        Args:
+            cellsize (float): side of the grid cells that share cached
+                candidates (meters). Larger cells hit more often but keep
+                more candidates to refine per query.
+            maxbytes (int): bound of the cached candidate arrays in bytes;
+                0 or None removes the cache.
+        """
+        if not maxbytes:
+            self._querycache = None
+            return
+        if self._spatialindex is None:
+            raise ValueError("the network has no spatial index yet")
+        self._querycache = spatialindex.QueryCache(self._spatialindex, cellsize, maxbytes)
+
+
+    def queryCacheStats(self):
+        """QueryCache.stats of the query cache, None without a cache."""
+        return None if self._querycache is None else self._querycache.stats()
+
+
+    def save(self, path):
+        """
+        Writes the network to a single versioned binary snapshot.
+
+        The snapshot holds the packed arrays of _buildArrays (topology, shapes,
+        speeds, lengths, bounding boxes), the edge/node IDs and _location. The
+        spatial index backend is always recorded; its arrays are stored if it
+        is kept in flat arrays (grid backend), R-tree backends are bulk loaded
+        again from the stored boxes on load.
+
+        Args:
+            path (str): output file.
+        """
+        header = {"location": self._location,
+                  "edgeids": self._edgeidlist,
+                  "nodeids": self._nodeidlist}
+        arrays = {name: getattr(self, name) for name in _SNAPSHOT_ARRAYS}
+        # the backend is always recorded, a custom SpatialIndex class loads as "rtree"
+        name = self._spatialindex.name if self._spatialindex.name in spatialindex.BACKENDS else "rtree"
+        header["spatialindex"] = {"type": name, "cellsize": float(self.cellsize)}
+        state = self._spatialindex.getState()
+        if state is not None:
+            header["spatialindex"] = state[0]
+            arrays.update({"_spatialindex_" + name: a for name, a in state[1].items()})
+        _writeSnapshot(path, header, arrays)
+
+    @classmethod
+    def load(cls, path, mmap=True, spatialindex=None, cellsize=None, querycache=None):
+        """
+        Loads a network written by Net.save.
+
+        With mmap=True the arrays are read-only views on a memory-mapped file,
+        so processes loading the same snapshot share the physical pages. The
+        loaded network always uses the compact backend.
+
+        Args:
+            path (str): snapshot file.
+            mmap (bool): memory-map the file instead of reading it.
+            spatialindex (str): spatial index backend, defaults to the stored one.
+            cellsize (float): grid cell size, defaults to the stored one.
+            querycache (dict): arguments of setQueryCache to add a query
+                cache, e.g. through the netkwargs of match_batch.
+
+        Returns:
+            Net: the loaded network.
+        """
+        header, arrays = _readSnapshot(path, mmap=mmap)
+        stored = header.get("spatialindex", {"type": "rtree", "cellsize": 100.0})
+        net = cls(compact=True,
+                  spatialindex=stored["type"] if spatialindex is None else spatialindex,
+                  cellsize=stored.get("cellsize", 100.0) if cellsize is None else cellsize)
+        net._location = header["location"]
+        if net._location.get("projParameter", "!") != "!":
+            net.geoproj = pyproj.Proj(projparams=net._location["projParameter"])
+        net._edgeidlist = header["edgeids"]
+        net._nodeidlist = header["nodeids"]
+        net._edgeindex = {eid: i for i, eid in enumerate(net._edgeidlist)}
+        for name in _SNAPSHOT_ARRAYS:
+            setattr(net, name, arrays[name])
+        net._buildSegments()
+        net._initCompact()
+        prefix = "_spatialindex_"
+        net._initSpatialIndex(state=(stored, {name[len(prefix):]: a for name, a in arrays.items()
+                                              if name.startswith(prefix)}))
+        if querycache is not None:
+            net.setQueryCache(**querycache)
+        return net
     
 
+    def _fromPoint(self, fromedge, edge_reverse, from_reverse):
+        """The point of fromedge that combineShapesSumo puts in front of the edge shape, or None."""
+        if fromedge is None:
+            return None
+        i = fromedge.getIndex()
+        if from_reverse==False or edge_reverse==False:
+            return self._shapeCoords[self._shapeOffsets[i + 1] - 1]
+        return self._shapeCoords[self._shapeOffsets[i]]
+
+
+    def _prefixPoint(self, i, p, edge_reverse):
+        """p if combineShapesSumo prepends it to the shape of edge i, else None."""
+        if p is None:
+            return None
+        first = self._shapeCoords[self._shapeOffsets[i + 1] - 1 if edge_reverse else self._shapeOffsets[i]]
+        if p[0] == first[0] and p[1] == first[1]:
+            return None
+        return p
+
+
+    def combinedShapeLength(self, edge, fromedge=None, edge_reverse=False, from_reverse=False):
+        """
+        Length of combineShapesSumo(edge, fromedge, edge_reverse, from_reverse),
+        taken from the precomputed shape lengths.
+        """
+        return self._combinedShapeLength(edge.getIndex(), self._fromPoint(fromedge, edge_reverse, from_reverse),
+                                         edge_reverse)
+
+
+    def _combinedShapeLength(self, i, p, edge_reverse):
+        length = float(self._shapeLength[i])
+        p = self._prefixPoint(i, p, edge_reverse)
+        if p is not None:
+            first = self._shapeCoords[self._shapeOffsets[i + 1] - 1 if edge_reverse else self._shapeOffsets[i]]
+            length += math.hypot(first[0] - p[0], first[1] - p[1])
+        return length
+
+
+    def projectOnEdge(self, edge, x, y, fromedge=None, edge_reverse=False, from_reverse=False):
+        """
+        Projects a point on the combined shape of an edge using the precomputed geometry tables.
+
+        Equivalent to running polygonOffsetWithMinimumDistanceToPoint, polyLength and
+        offsetBearing on combineShapesSumo(edge, fromedge, edge_reverse, from_reverse),
+        but as one vectorized projection over the edge's segments plus a binary
+        search for the bearing.
+
+        Args:
+            edge (Edge): edge to project on.
+            x, y (float): point.
+            fromedge (Edge, optional): previous edge, its end point is prepended to the shape.
+            edge_reverse (bool): the edge is driven against its direction.
+            from_reverse (bool): the previous edge was driven against its direction.
+
+        Returns:
+            tuple: (offset, matchpoint, length, bearing) where offset is the position of
+            the closest point along the combined shape, matchpoint its (x, y), length the
+            combined shape length and bearing the direction of the shape at offset.
+
+        """
+        return self._projectOnEdge(edge.getIndex(), x, y, self._fromPoint(fromedge, edge_reverse, from_reverse),
+                                   edge_reverse)
+
+
+    def _projectOnEdge(self, i, x, y, p, edge_reverse):
+        """projectOnEdge for edge index i and the end point p of the previous edge (or None)."""
+        s0 = self._segOffsets[i]
+        s1 = self._segOffsets[i + 1]
+        p0 = self._shapeOffsets[i]
+        a = self._shapeCoords[p0:p0 + (s1 - s0)]
+        unit = self._segUnit[s0:s1]
+        seglength = self._segLength[s0:s1]
+        segstart = self._segCumLength[s0:s1]
+        total = float(self._shapeLength[i])
+
+        # project on every segment of the edge, in the direction it is stored
+        dx = x - a[:, 0]
+        dy = y - a[:, 1]
+        along = np.minimum(np.maximum(dx * unit[:, 0] + dy * unit[:, 1], 0.0), seglength)
+        qx = dx - along * unit[:, 0]
+        qy = dy - along * unit[:, 1]
+        dist2 = qx * qx + qy * qy
+        if edge_reverse:
+            # the first minimum along the reversed shape is the last one here
+            k = len(dist2) - 1 - int(np.argmin(dist2[::-1]))
+        else:
+            k = int(np.argmin(dist2))
+        best = float(dist2[k])
+        offset = float(segstart[k] + along[k])
+        if edge_reverse:
+            offset = total - offset
+        matchpoint = (float(a[k, 0] + along[k] * unit[k, 0]), float(a[k, 1] + along[k] * unit[k, 1]))
+
+        prefix = 0.0
+        p = self._prefixPoint(i, p, edge_reverse)
+        if p is not None:
+            first = self._shapeCoords[self._shapeOffsets[i + 1] - 1 if edge_reverse else p0]
+            px, py = float(p[0]), float(p[1])
+            ux = float(first[0]) - px
+            uy = float(first[1]) - py
+            prefix = math.hypot(ux, uy)
+            ux /= prefix
+            uy /= prefix
+            al = min(max((x - px) * ux + (y - py) * uy, 0.0), prefix)
+            if (x - px - al * ux) ** 2 + (y - py - al * uy) ** 2 <= best:
+                matchpoint = (px + al * ux, py + al * uy)
+                if al < prefix:
+                    bearing = geotools.calculate_bearing_angle((px, py), (float(first[0]), float(first[1])))
+                    return al, matchpoint, total + prefix, bearing
+                # end of the prepended segment is the start of the edge
+                offset = 0.0
+
+        # bearing of the first segment whose end lies beyond the offset
+        if edge_reverse:
+            m = int(np.searchsorted(segstart, total - offset, side="left")) - 1
+            bearing = (float(self._segBearing[s0 + max(m, 0)]) + 180) % 360
+        else:
+            j = int(np.searchsorted(segstart + seglength, offset, side="right"))
+            bearing = float(self._segBearing[s0 + min(j, len(seglength) - 1)])
+        return offset + prefix, matchpoint, total + prefix, bearing
+
+
+    def projectOnEdges(self, edges, x, y, fromedges, edge_reverses, from_reverses):
+        """
+        projectOnEdge for several candidate edges of one point at once.
+
+        All segments of the candidates are projected in one vectorized pass and
+        reduced per edge, with the same results as calling projectOnEdge for
+        every edge.
+
+        Args:
+            edges (list): candidate edges.
+            x, y (float): point.
+            fromedges (list): previous edge of each candidate, or None.
+            edge_reverses (list): reverse flag of each candidate.
+            from_reverses (list): reverse flag of each previous edge.
+
+        Returns:
+            tuple: arrays (offset, x, y, length, bearing) with one item per edge.
+
+        """
+        idx = np.empty(len(edges), dtype=np.int64)
+        points = np.full((len(edges), 2), np.nan)
+        for k, (edge, fromedge, edge_reverse, from_reverse) in enumerate(zip(edges, fromedges, edge_reverses,
+                                                                             from_reverses)):
+            i = idx[k] = edge.getIndex()
+            p = self._prefixPoint(i, self._fromPoint(fromedge, edge_reverse, from_reverse), edge_reverse)
+            if p is not None:
+                points[k] = p
+        return self._projectOnEdges(idx, x, y, points, np.asarray(edge_reverses, dtype=bool))
+
+
+    def _projectOnEdges(self, idx, x, y, points, reverses):
+        """_projectOnEdge over edge indices idx; points holds the prefix point of each edge or NaN."""
+        nsegs = self._segOffsets[idx + 1] - self._segOffsets[idx]
+        segs, owner = spatialindex._expand(self._segOffsets[idx], nsegs)
+        first = np.zeros(len(idx), dtype=np.int64)
+        first[1:] = np.cumsum(nsegs)[:-1]
+        last = first + nsegs - 1
+        pos = np.arange(len(segs), dtype=np.int64)
+        a = self._shapeCoords[self._segStart[segs]]
+        unit = self._segUnit[segs]
+        seglength = self._segLength[segs]
+        segstart = self._segCumLength[segs]
+        total = self._shapeLength[idx]
+
+        dx = x - a[:, 0]
+        dy = y - a[:, 1]
+        along = np.minimum(np.maximum(dx * unit[:, 0] + dy * unit[:, 1], 0.0), seglength)
+        qx = dx - along * unit[:, 0]
+        qy = dy - along * unit[:, 1]
+        dist2 = qx * qx + qy * qy
+        # first minimum of every edge, the last one for reversed edges
+        isbest = dist2 == np.minimum.reduceat(dist2, first)[owner]
+        k = np.where(reverses, np.maximum.reduceat(np.where(isbest, pos, -1), first),
+                     np.minimum.reduceat(np.where(isbest, pos, len(pos)), first))
+        best = dist2[k]
+        offset = segstart[k] + along[k]
+        offset = np.where(reverses, total - offset, offset)
+        mx = a[k, 0] + along[k] * unit[k, 0]
+        my = a[k, 1] + along[k] * unit[k, 1]
+
+        # the segment from the end of the previous edge to the start of this one, in the
+        # scalar arithmetic of _projectOnEdge: on grids it often ties with the edge itself
+        prefix = np.zeros(len(idx))
+        inside = np.zeros(len(idx), dtype=bool)
+        prefixoffset = np.zeros(len(idx))
+        prefixbearing = np.zeros(len(idx))
+        starts = np.where(reverses, self._shapeOffsets[idx + 1] - 1, self._shapeOffsets[idx])
+        for k in np.flatnonzero(~np.isnan(points[:, 0])).tolist():
+            px, py = float(points[k, 0]), float(points[k, 1])
+            fx, fy = self._shapeCoords[starts[k]].tolist()
+            ux = fx - px
+            uy = fy - py
+            length = math.hypot(ux, uy)
+            ux /= length
+            uy /= length
+            al = min(max((x - px) * ux + (y - py) * uy, 0.0), length)
+            prefix[k] = length
+            if (x - px - al * ux) ** 2 + (y - py - al * uy) ** 2 <= best[k]:
+                mx[k] = px + al * ux
+                my[k] = py + al * uy
+                if al < length:
+                    inside[k] = True
+                    prefixoffset[k] = al
+                    prefixbearing[k] = geotools.calculate_bearing_angle((px, py), (fx, fy))
+                else:
+                    # end of the prepended segment is the start of the edge
+                    offset[k] = 0.0
+
+        # bearing of the first segment whose end lies beyond the offset
+        beyond = (segstart + seglength) > offset[owner]
+        j = np.minimum(np.minimum.reduceat(np.where(beyond, pos, len(pos)), first), last)
+        before = segstart < (total - offset)[owner]
+        m = np.maximum(np.maximum.reduceat(np.where(before, pos, -1), first), first)
+        bearing = np.where(reverses, (self._segBearing[segs[m]] + 180) % 360, self._segBearing[segs[j]])
+
+        offset = np.where(inside, prefixoffset, offset + prefix)
+        bearing = np.where(inside, prefixbearing, bearing)
+        return offset, mx, my, total + prefix, bearing
+
+
+    def getRouter(self, weight="length", landmarks=None):
+        """
+        Shortest-path engine on the edge graph (routing.Router), created once per weight.
+
+        Args:
+            weight (str): "length" or "time".
+            landmarks (str or routing.Landmarks, optional): landmark tables to
+                load into the router (see routing.Landmarks.save).
+
+        Returns:
+            routing.Router: the router.
+        """
+        import routing
+        router = self._routers.get(weight)
+        if router is None:
+            router = self._routers[weight] = routing.Router(self, weight=weight)
+        if landmarks is not None:
+            router.landmarks = (landmarks if isinstance(landmarks, routing.Landmarks)
+                                else routing.Landmarks.load(landmarks, router))
+        return router
+
+
+    def getShortestPath(self, fromedge, toedge, weight="length"):
+        """
+        Shortest path between two edges, see routing.Router.shortestPath.
+
+        Returns:
+            tuple: (edges, cost), (None, inf) if toedge is unreachable.
+        """
+        return self.getRouter(weight).shortestPath(fromedge, toedge)
+
+
+    def getBoundingBoxes(self, edges):
+        """
+        Bounding boxes of several edges at once, from the packed edge table.
+
+        Returns:
+            numpy.ndarray: (len(edges), 4) array of (xmin, ymin, xmax, ymax).
+        """
+        return self._edgeBBox[np.array([edge.getIndex() for edge in edges], dtype=np.int64)]
+
+
     def getNeighboringEdges(self, x, y, r=0.1):
         edges = []
-      
-        for i in self._rtree.intersection((x - r, y - r, x + r, y + r)):
-            e = self.edges[self._edgeidlist[i]]
-            d = sumolib.geomhelper.distancePointToPolygon(
-                (x, y), e.getShape())
-            if d < r:
-                edges.append((e, d))
+        index = self._spatialindex if self._querycache is None else self._querycache
+        edgeidx, dist, _ = index.query(x, y, r)
+        for i, d in zip(edgeidx.tolist(), dist.tolist()):
+            edges.append((self.edges[self._edgeidlist[i]], d))
         return edges
 
 
+    def getNeighboringEdgesBatch(self, xs, ys, r=0.1, chunksize=4096):
+        """
+        Finds the edges within distance r of many points at once.
+
+        Candidates come from the spatial index in one vectorized query per
+        chunk of points and the point-to-shape distances are computed with
+        numpy over the segment table, not per edge in Python.
+
+        Args:
+            xs, ys (array-like): point coordinates.
+            r (float): search radius.
+            chunksize (int): points per index query, bounds temporary memory.
+
+        Returns:
+            tuple: (pointindex, edgeindex, distance) numpy arrays, ordered by
+            point index; edgeindex refers to Net.getEdgeByIndex.
+
+        """
+        return self._spatialindex.queryBatch(xs, ys, r, chunksize=chunksize)[:3]
+
+
 ########################################################################
 #################3  end of the network class   #########################
 ########################################################################
 
+#########  binary snapshot  #####################
+# Layout: 8-byte magic, uint32 format version, uint32 header length, a JSON
+# header (metadata plus dtype/shape/offset of every array), then the raw
+# array data, each array aligned to _SNAPSHOT_ALIGN bytes so it can be used
+# in place from a memory map.
+
+_SNAPSHOT_MAGIC = b"NRTNET\x00\x00"
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_ALIGN = 64
+_SNAPSHOT_ARRAYS = ("_shapeOffsets", "_shapeCoords", "_edgeFrom", "_edgeTo",
+                    "_edgeSpeed", "_edgeLength", "_edgeBBox", "_nodeCoords",
+                    "_edgeOutPtr", "_edgeOutIdx", "_edgeInPtr", "_edgeInIdx",
+                    "_nodeOutPtr", "_nodeOutIdx", "_nodeInPtr", "_nodeInIdx")
+
+
+def _align(n):
+    return (n + _SNAPSHOT_ALIGN - 1) // _SNAPSHOT_ALIGN * _SNAPSHOT_ALIGN
+
+
+def _writeSnapshot(path, header, arrays):
+    """Writes a JSON-serializable header and a dict of numpy arrays to one file."""
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, a in arrays.items():
+        layout[name] = [a.dtype.str, list(a.shape), offset]
+        offset = _align(offset + a.nbytes)
+    meta = json.dumps(dict(header, arrays=layout)).encode("utf-8")
+    start = _align(16 + len(meta))
+    with open(path, "wb") as f:
+        f.write(_SNAPSHOT_MAGIC)
+        f.write(struct.pack("<II", _SNAPSHOT_VERSION, len(meta)))
+        f.write(meta)
+        for name, a in arrays.items():
+            f.seek(start + layout[name][2])
+            f.write(a.tobytes())
+        f.truncate(start + offset)
+
+
+def _readSnapshot(path, mmap=True):
+    """Reads a file written by _writeSnapshot, returns (header, arrays)."""
+    with open(path, "rb") as f:
+        magic = f.read(8)
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a network snapshot")
+        version, metalength = struct.unpack("<II", f.read(8))
+        if version != _SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {version} (expected {_SNAPSHOT_VERSION})")
+        header = json.loads(f.read(metalength).decode("utf-8"))
+    start = _align(16 + metalength)
+    if mmap:
+        buf = np.memmap(path, dtype=np.uint8, mode="r")
+    else:
+        buf = np.fromfile(path, dtype=np.uint8)
+    arrays = {}
+    for name, (dtype, shape, offset) in header.pop("arrays").items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        a = np.frombuffer(buf, dtype=dtype, count=count, offset=start + offset).reshape(shape)
+        if not mmap:
+            a.flags.writeable = False
+        arrays[name] = a
+    return header, arrays
+
+
+def _pointList(shape):
+    """Returns a shape as a new list of (x, y) tuples, whatever the backend."""
+    if isinstance(shape, np.ndarray):
+        return list(map(tuple, shape.tolist()))
+    return list(shape)
+
 def combineShapesSumo(edge, fromedge=None, edge_reverse=False, from_reverse =False):
     """
     Combines the raw shapes of Sumo edges, optionally considering the starting point from another edge.
@@ -314,16 +1077,17 @@ def combineShapesSumo(edge, fromedge=None, edge_reverse=False, from_reverse =Fal
 
     """
          
-    shape = edge.getShape()
+    shape = _pointList(edge.getShape())
     if edge_reverse==True:
         shape = list(reversed(shape))
 
 
     if fromedge is not None:
+        fromshape = _pointList(fromedge.getShape())
         if from_reverse==False or edge_reverse==False:
-            p = fromedge.getShape()[-1]
+            p = fromshape[-1]
         else:
-            p = fromedge.getShape()[0]
+            p = fromshape[0]
 
         if p != shape[0]:
             shape = [p] + shape
@@ -0,0 +1,437 @@
+"""
+Shortest paths on the edge graph of a network.Net.
+
+Routing runs on edges, not nodes: a vertex is an edge of the network and the
+arcs are the edge successors (Net._edgeOutPtr/_edgeOutIdx), so turn
+restrictions of the network are respected. Leaving edge u costs its weight,
+the edge length or its travel time, and the distance from edge a to edge b is
+measured from the start of a to the start of b:
+
+    distance(a, a) = 0
+    distance(a, b) = weight(a) + ... + weight(last edge before b)
+
+The distance between two positions (edge, offset) is therefore
+distance(a, b) - offset_a + offset_b.
+
+Router answers point-to-point queries with bidirectional Dijkstra or
+bidirectional A*. The A* lower bound is either the euclidean distance between
+node coordinates or, after the one-time Landmarks preprocessing (stored with
+save/load next to the network snapshot), the triangle inequality on
+precomputed distances to and from a few landmark edges (ALT). DistanceCache
+keeps the bounded-radius distances from recently used source edges for
+repeated candidate-pair lookups.
+"""
+import heapq
+import math
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+INF = math.inf
+
+
+def _view(array):
+    """1-d memoryview of an array, copied only if it is not contiguous."""
+    return memoryview(np.ascontiguousarray(array))
+
+
+class Router:
+    def __init__(self, net, weight="length", defaultspeed=13.89, landmarks=None):
+        """
+        Args:
+            net (network.Net): network with packed arrays.
+            weight (str): "length" (meters) or "time" (seconds, length / speed).
+            defaultspeed (float): speed (m/s) for edges without one when weight="time".
+            landmarks (Landmarks or str, optional): landmark distances, or the
+                path of a file written by Landmarks.save.
+        """
+        if weight not in ("length", "time"):
+            raise ValueError(f"unknown weight {weight!r}, expected 'length' or 'time'")
+        self.net = net
+        self.weight = weight
+        length = np.asarray(net._edgeLength, dtype=np.float64)
+        if weight == "time":
+            speed = np.where(np.isnan(net._edgeSpeed) | (net._edgeSpeed <= 0), defaultspeed, net._edgeSpeed)
+            self._weights = length / speed
+        else:
+            self._weights = length.copy()
+        # the searches below index element by element: memoryviews of the CSR
+        # arrays give python numbers without a per-process copy into lists
+        # (the arrays of a memory-mapped snapshot stay shared)
+        self._w = _view(self._weights)
+        self._outptr = _view(net._edgeOutPtr)
+        self._outidx = _view(net._edgeOutIdx)
+        self._inptr = _view(net._edgeInPtr)
+        self._inidx = _view(net._edgeInIdx)
+        # A*: every edge is placed at its from-node; scale keeps the euclidean
+        # distance a lower bound (consistent) for arcs u -> v of cost weight(u)
+        coords = net._nodeCoords[net._edgeFrom]
+        self._x = _view(coords[:, 0])
+        self._y = _view(coords[:, 1])
+        u = np.repeat(np.arange(len(self._w)), np.diff(net._edgeOutPtr))
+        chord = np.hypot(*(coords[net._edgeOutIdx] - coords[u]).T)
+        positive = chord > 0
+        self._hscale = float(np.min(self._weights[u][positive] / chord[positive])) if positive.any() else 0.0
+        self.landmarks = None
+        if landmarks is not None:
+            self.landmarks = landmarks if isinstance(landmarks, Landmarks) else Landmarks.load(landmarks, self)
+
+
+    def checksum(self):
+        """Identifies the edge graph and weights, stored with the landmark distances."""
+        crc = zlib.crc32(np.ascontiguousarray(self.net._edgeOutPtr, dtype=np.int64).tobytes())
+        crc = zlib.crc32(np.ascontiguousarray(self.net._edgeOutIdx, dtype=np.int64).tobytes(), crc)
+        return zlib.crc32(self._weights.tobytes(), crc)
+
+
+    def shortestPath(self, source, target, method=None):
+        """
+        Shortest path between two edges.
+
+        Args:
+            source, target (Edge): edges of the network.
+            method (str, optional): "dijkstra" (bidirectional), "astar"
+                (bidirectional A*, euclidean bound) or "alt" (bidirectional A*,
+                landmark bound). Defaults to "alt" if landmarks are loaded,
+                else "astar".
+
+        Returns:
+            tuple: (edges, cost) with the list of edges from source to target
+            (both included) and the distance from the start of source to the
+            start of target; (None, inf) if target is unreachable.
+
+        """
+        path, cost = self._route(source.getIndex(), target.getIndex(), method)
+        if path is None:
+            return None, INF
+        return [self.net.getEdgeByIndex(i) for i in path], cost
+
+
+    def distance(self, source, target, method=None):
+        """Distance from the start of source to the start of target (inf if unreachable)."""
+        return self._route(source.getIndex(), target.getIndex(), method)[1]
+
+
+    def _route(self, s, t, method):
+        if method is None:
+            method = "alt" if self.landmarks is not None else "astar"
+        if method == "alt":
+            if self.landmarks is None:
+                raise ValueError("no landmarks loaded, see Landmarks.build")
+            return self._bidirectional(s, t, self.landmarks.potential(s, t))
+        if method == "astar":
+            return self._bidirectional(s, t, self._euclideanPotential(s, t))
+        if method == "dijkstra":
+            return self._bidirectional(s, t, None)
+        raise ValueError(f"unknown routing method {method!r}")
+
+
+    def _euclideanPotential(self, s, t):
+        if self._hscale <= 0:
+            return None
+        xs, ys, scale = self._x, self._y, 0.5 * self._hscale
+        sx, sy, tx, ty = xs[s], ys[s], xs[t], ys[t]
+        def potential(v):
+            return scale * (math.hypot(xs[v] - tx, ys[v] - ty) - math.hypot(xs[v] - sx, ys[v] - sy))
+        return potential
+
+
+    def _bidirectional(self, s, t, potential):
+        """
+        Bidirectional Dijkstra; with a potential p (the average of a lower
+        bound to t and a lower bound from s, Ikeda et al.) it is bidirectional
+        A*. The forward key of v is d(s, v) + p(v), the backward key
+        d(v, t) - p(v), and the search stops once the two smallest keys add up
+        to the best path found.
+        """
+        if s == t:
+            return [s], 0.0
+        if potential is None:
+            def potential(v):
+                return 0.0
+        w, outptr, outidx, inptr, inidx = self._w, self._outptr, self._outidx, self._inptr, self._inidx
+        distf, distr = {s: 0.0}, {t: 0.0}
+        predf, predr = {s: -1}, {t: -1}
+        heapf, heapr = [(potential(s), s)], [(-potential(t), t)]
+        donef, doner = set(), set()
+        best, meet = INF, -1
+        while heapf and heapr:
+            if heapf[0][0] + heapr[0][0] >= best:
+                break
+            if heapf[0][0] <= heapr[0][0]:
+                _, u = heapq.heappop(heapf)
+                if u in donef:
+                    continue
+                donef.add(u)
+                nd = distf[u] + w[u]
+                for k in range(outptr[u], outptr[u + 1]):
+                    v = outidx[k]
+                    if nd < distf.get(v, INF):
+                        distf[v] = nd
+                        predf[v] = u
+                        heapq.heappush(heapf, (nd + potential(v), v))
+                        if v in distr and nd + distr[v] < best:
+                            best, meet = nd + distr[v], v
+            else:
+                _, v = heapq.heappop(heapr)
+                if v in doner:
+                    continue
+                doner.add(v)
+                for k in range(inptr[v], inptr[v + 1]):
+                    u = inidx[k]
+                    nd = distr[v] + w[u]
+                    if nd < distr.get(u, INF):
+                        distr[u] = nd
+                        predr[u] = v
+                        heapq.heappush(heapr, (nd - potential(u), u))
+                        if u in distf and distf[u] + nd < best:
+                            best, meet = distf[u] + nd, u
+        if meet < 0:
+            return None, INF
+        path = []
+        v = meet
+        while v >= 0:
+            path.append(v)
+            v = predf[v]
+        path.reverse()
+        v = predr[meet]
+        while v >= 0:
+            path.append(v)
+            v = predr[v]
+        return path, best
+
+
+    def distancesFrom(self, source, maxdist=INF, targets=None):
+        """
+        Distances from one edge to every edge within maxdist (one-to-many Dijkstra).
+
+        Args:
+            source (int): edge index.
+            maxdist (float): search radius in units of the weight.
+            targets (iterable of int, optional): stop as soon as all these
+                edges are settled, the result then holds the edges settled so far.
+
+        Returns:
+            dict: edge index -> distance from the start of source to its start.
+        """
+        w, outptr, outidx = self._w, self._outptr, self._outidx
+        dist = {source: 0.0}
+        done = {}
+        heap = [(0.0, source)]
+        remaining = set(targets) if targets is not None else None
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u in done:
+                continue
+            if d > maxdist:
+                break
+            done[u] = d
+            if remaining is not None:
+                remaining.discard(u)
+                if len(remaining) == 0:
+                    break
+            nd = d + w[u]
+            if nd > maxdist:
+                continue
+            for k in range(outptr[u], outptr[u + 1]):
+                v = outidx[k]
+                if nd < dist.get(v, INF):
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return done
+
+
+    def _allDistances(self, source, backward=False):
+        """Distances from source to every edge (to source from every edge if backward), inf if unreachable."""
+        w = self._w
+        ptr, idx = (self._inptr, self._inidx) if backward else (self._outptr, self._outidx)
+        dist = [INF] * len(w)
+        dist[source] = 0.0
+        heap = [(0.0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for k in range(ptr[u], ptr[u + 1]):
+                v = idx[k]
+                # backward the arc is v -> u and costs weight(v)
+                nd = d + (w[v] if backward else w[u])
+                if nd < dist[v]:
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return dist
+
+
+class Landmarks:
+    """
+    Landmark distances for the ALT lower bound.
+
+    For every landmark edge L the distances d(L, v) and d(v, L) to all edges
+    are precomputed; by the triangle inequality
+
+        d(v, t) >= max(d(L, t) - d(L, v), d(v, L) - d(t, L))
+
+    which is a consistent A* potential. A query only uses the few landmarks
+    that give the best bound between its source and target.
+    """
+
+    def __init__(self, landmarks, forward, backward, weight, checksum):
+        self.landmarks = landmarks
+        self.forward = forward    # (k, n): d(L, v)
+        self.backward = backward  # (k, n): d(v, L)
+        self.weight = weight
+        self.checksum = checksum
+
+
+    @classmethod
+    def build(cls, router, count=16):
+        """
+        Chooses landmarks far from each other (farthest selection) and
+        computes their distance tables: two full Dijkstra runs per landmark.
+
+        Args:
+            router (Router): weights and adjacency.
+            count (int): number of landmarks.
+
+        Returns:
+            Landmarks: the landmark tables.
+        """
+        n = len(router._w)
+        count = min(count, n)
+        forward = np.full((count, n), INF)
+        backward = np.full((count, n), INF)
+        landmarks = []
+        # the first landmark is the edge farthest from edge 0, every next one
+        # maximizes the smallest round-trip distance to the chosen ones
+        far = np.array(router._allDistances(0))
+        far[~np.isfinite(far)] = -1
+        nearest = np.full(n, INF)
+        current = int(np.argmax(far))
+        for k in range(count):
+            landmarks.append(current)
+            forward[k] = router._allDistances(current)
+            backward[k] = router._allDistances(current, backward=True)
+            roundtrip = np.where(np.isfinite(forward[k]), forward[k], 0) + np.where(np.isfinite(backward[k]), backward[k], 0)
+            nearest = np.minimum(nearest, roundtrip)
+            current = int(np.argmax(nearest))
+        return cls(np.array(landmarks, dtype=np.int64), forward, backward, router.weight, router.checksum())
+
+
+    def save(self, path):
+        """Writes the landmark tables as a snapshot file (see network.Net.save)."""
+        from network import _writeSnapshot
+        _writeSnapshot(path, {"landmarks": {"weight": self.weight, "checksum": self.checksum}},
+                       {"landmarks": self.landmarks, "forward": self.forward, "backward": self.backward})
+
+
+    @classmethod
+    def load(cls, path, router=None, mmap=True):
+        """
+        Loads landmark tables written by save.
+
+        Args:
+            path (str): landmark file.
+            router (Router, optional): if given, the tables must have been
+                built for the same graph and weight.
+            mmap (bool): memory-map the tables instead of reading them.
+        """
+        from network import _readSnapshot
+        header, arrays = _readSnapshot(path, mmap=mmap)
+        meta = header["landmarks"]
+        if router is not None and (meta["weight"] != router.weight or meta["checksum"] != router.checksum()):
+            raise ValueError(f"{path} was built for another network or weight")
+        return cls(arrays["landmarks"], arrays["forward"], arrays["backward"], meta["weight"], meta["checksum"])
+
+
+    def potential(self, s, t, active=8):
+        """
+        Average ALT potential for a query from s to t, using the active
+        landmarks with the best lower bound of d(s, t).
+        """
+        with np.errstate(invalid="ignore"):
+            bound = np.maximum(self.forward[:, t] - self.forward[:, s], self.backward[:, s] - self.backward[:, t])
+        bound[~np.isfinite(bound)] = -1
+        # memoryviews index to python floats without copying (also on a memory map)
+        terms = [(memoryview(self.forward[k]), memoryview(self.backward[k]))
+                 for k in np.argsort(-bound, kind="stable")[:active].tolist()]
+        terms = [(f, b, f[t], b[t], f[s], b[s]) for f, b in terms]
+        cache = {}
+
+        def potential(v):
+            p = cache.get(v)
+            if p is None:
+                tobound = frombound = 0.0
+                for f, b, ft, bt, fs, bs in terms:
+                    fv = f[v]
+                    bv = b[v]
+                    # inf - inf is nan and never wins a comparison
+                    x = ft - fv
+                    if x > tobound:
+                        tobound = x
+                    x = bv - bt
+                    if x > tobound:
+                        tobound = x
+                    x = fv - fs
+                    if x > frombound:
+                        frombound = x
+                    x = bs - bv
+                    if x > frombound:
+                        frombound = x
+                p = cache[v] = 0.5 * (tobound - frombound)
+            return p
+        return potential
+
+
+class DistanceCache:
+    """
+    Bounded-radius many-to-many distances between edges.
+
+    The first lookup from a source edge runs one Dijkstra up to maxdist and
+    keeps every distance it found; later lookups from that source, for any
+    target, are dictionary hits. At most maxsize source trees are kept, the
+    least recently used one is dropped first. Targets farther than maxdist
+    (or unreachable) get inf.
+    """
+
+    def __init__(self, router, maxdist, maxsize=1024):
+        self.router = router
+        self.maxdist = maxdist
+        self.maxsize = maxsize
+        self._trees = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def _tree(self, s):
+        tree = self._trees.get(s)
+        if tree is not None:
+            self._trees.move_to_end(s)
+            self.hits += 1
+            return tree
+        self.misses += 1
+        tree = self.router.distancesFrom(s, self.maxdist)
+        self._trees[s] = tree
+        if len(self._trees) > self.maxsize:
+            self._trees.popitem(last=False)
+        return tree
+
+
+    def distance(self, source, target):
+        """Distance from the start of source to the start of target, inf beyond maxdist."""
+        return self._tree(source.getIndex()).get(target.getIndex(), INF)
+
+
+    def distances(self, sources, targets):
+        """Matrix (len(sources), len(targets)) of distance(source, target)."""
+        result = np.full((len(sources), len(targets)), INF)
+        targetidx = [t.getIndex() for t in targets]
+        for i, source in enumerate(sources):
+            tree = self._tree(source.getIndex())
+            for j, t in enumerate(targetidx):
+                result[i, j] = tree.get(t, INF)
+        return result
+
+
+    def clear(self):
+        self._trees.clear()
@@ -0,0 +1,434 @@
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from geotools import pointsToSegmentsDistance
+
+# rtree (libspatialindex) is only imported by the R-tree backends, so workers
+# using the grid backend do not need it installed.
+
+
+class SpatialIndex:
+    """
+    Interface of the spatial indexes used by network.Net.
+
+    A backend is built from a Net whose packed arrays exist (see
+    Net._buildArrays) and answers fixed-radius queries with the nearest
+    segment of every edge within the radius. Backends only implement
+    _candidateSegments; the exact distance check is shared.
+    """
+    name = None
+
+    def __init__(self, net):
+        self.net = net
+
+
+    def candidates(self, x, y, r):
+        """Edge indices returned by the filter stage, before the exact distance check."""
+        points, seg = self._candidateSegments(np.array([x], dtype=np.float64),
+                                              np.array([y], dtype=np.float64), r)
+        return np.unique(self.net._segEdge[seg])
+
+
+    def query(self, x, y, r):
+        """
+        Finds the edges within distance r of (x, y).
+
+        Args:
+            x, y (float): query point.
+            r (float): search radius.
+
+        Returns:
+            tuple: (edgeindex, distance, segmentindex) arrays with one entry per
+            edge: the nearest segment of that edge and its distance.
+
+        """
+        return self._refine(self._pointCandidates(x, y, r), x, y, r)
+
+
+    def _refine(self, seg, x, y, r):
+        """query on the candidate segments seg: the nearest segment of every edge within r."""
+        net = self.net
+        a = net._shapeCoords[net._segStart[seg]]
+        b = net._shapeCoords[net._segEnd[seg]]
+        dist, _ = pointsToSegmentsDistance(x, y, a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+        keep = dist < r
+        seg, dist = seg[keep], dist[keep]
+        edge = net._segEdge[seg].astype(np.int64)
+        order = np.lexsort((dist, edge))
+        edge, dist, seg = edge[order], dist[order], seg[order]
+        first = np.ones(len(edge), dtype=bool)
+        first[1:] = edge[1:] != edge[:-1]
+        return edge[first], dist[first], seg[first]
+
+
+    def queryBatch(self, xs, ys, r, chunksize=4096):
+        """
+        Batch version of query.
+
+        Returns:
+            tuple: (pointindex, edgeindex, distance, segmentindex) arrays
+            ordered by point index.
+
+        """
+        xs = np.asarray(xs, dtype=np.float64).ravel()
+        ys = np.asarray(ys, dtype=np.float64).ravel()
+        if not xs.size:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                    np.zeros(0), np.zeros(0, dtype=np.int64))
+        result = ([], [], [], [])
+        for start in range(0, len(xs), chunksize):
+            cx = xs[start:start + chunksize]
+            cy = ys[start:start + chunksize]
+            points, seg = self._candidateSegments(cx, cy, r)
+            found = self._nearestPerEdge(points, cx[points], cy[points], seg, r)
+            result[0].append(found[0] + start)
+            for item, values in zip(result[1:], found[1:]):
+                item.append(values)
+        return tuple(np.concatenate(item) for item in result)
+
+
+    def _candidateSegments(self, xs, ys, r):
+        """Returns (pointindex, segmentindex) candidate pairs for the query boxes."""
+        raise NotImplementedError
+
+
+    def _pointCandidates(self, x, y, r):
+        """Candidate segment indices for a single query box (backends may specialize)."""
+        return self._candidateSegments(np.array([x], dtype=np.float64), np.array([y], dtype=np.float64), r)[1]
+
+
+    def getState(self):
+        """(header, arrays) to store the index in a snapshot, or None if it is rebuilt on load."""
+        return None
+
+
+    def _nearestPerEdge(self, points, px, py, seg, r):
+        net = self.net
+        a = net._shapeCoords[net._segStart[seg]]
+        b = net._shapeCoords[net._segEnd[seg]]
+        dist, _ = pointsToSegmentsDistance(px, py, a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+        keep = dist < r
+        points, seg, dist = points[keep], seg[keep], dist[keep]
+        edge = net._segEdge[seg].astype(np.int64)
+        # sort by (point, edge, distance) and keep the first row of every (point, edge)
+        order = np.lexsort((dist, edge, points))
+        points, edge, dist, seg = points[order], edge[order], dist[order], seg[order]
+        first = np.ones(len(points), dtype=bool)
+        first[1:] = (points[1:] != points[:-1]) | (edge[1:] != edge[:-1])
+        return points[first], edge[first], dist[first], seg[first]
+
+
+def _expand(starts, counts):
+    """Concatenation of arange(starts[k], starts[k] + counts[k]) and the owner k of every item."""
+    counts = np.asarray(counts, dtype=np.int64)
+    owner = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+    first = np.zeros(len(counts), dtype=np.int64)
+    first[1:] = np.cumsum(counts)[:-1]
+    return np.asarray(starts, dtype=np.int64)[owner] + (np.arange(int(counts.sum()), dtype=np.int64) - first[owner]), owner
+
+
+def _bulkRTree(boxes):
+    import rtree
+    if len(boxes) == 0:
+        return rtree.index.Index()
+    stream = ((i, tuple(bbox), None) for i, bbox in enumerate(boxes.tolist()))
+    result = rtree.index.Index(stream)
+    result.interleaved = True
+    return result
+
+
+class _RTreeQueries:
+    """
+    R-tree queries of one libspatialindex handle serialized by a lock: the
+    queries release the GIL and the handle must not be used by two threads at
+    once, while the rest of the index is read-only and shared by all threads.
+    """
+
+    def __init__(self, tree):
+        self._tree = tree
+        self._lock = threading.Lock()
+
+
+    @property
+    def index(self):
+        """The rtree.index.Index itself, for callers that serialize their own queries."""
+        return self._tree
+
+
+    def intersection(self, box):
+        with self._lock:
+            return np.fromiter(self._tree.intersection(box), dtype=np.int64)
+
+
+    def intersection_v(self, mins, maxs):
+        with self._lock:
+            return self._tree.intersection_v(mins, maxs)
+
+
+class EdgeRTreeIndex(SpatialIndex):
+    """
+    R-tree with one bounding box per edge (the original index of network.Net),
+    bulk loaded from Net._edgeBBox.
+    """
+    name = "rtree"
+
+    def __init__(self, net):
+        super().__init__(net)
+        self._rtree = _RTreeQueries(_bulkRTree(net._edgeBBox))
+
+
+    def candidates(self, x, y, r):
+        return self._rtree.intersection((x - r, y - r, x + r, y + r))
+
+
+    def _pointCandidates(self, x, y, r):
+        net = self.net
+        edges = self.candidates(x, y, r)
+        return _expand(net._segOffsets[edges], net._segOffsets[edges + 1] - net._segOffsets[edges])[0]
+
+
+    def _candidateSegments(self, xs, ys, r):
+        net = self.net
+        edges, counts = self._rtree.intersection_v(np.column_stack([xs - r, ys - r]),
+                                                   np.column_stack([xs + r, ys + r]))
+        edges = edges.astype(np.int64)
+        points = np.repeat(np.arange(len(xs), dtype=np.int64), counts.astype(np.int64))
+        seg, owner = _expand(net._segOffsets[edges], net._segOffsets[edges + 1] - net._segOffsets[edges])
+        return points[owner], seg
+
+
+class SegmentIndex(SpatialIndex):
+    """
+    R-tree over the individual shape segments of a network.Net.
+
+    Long or curvy edges get one small box per segment instead of one large box
+    per edge, so a query returns far fewer candidates that are then rejected by
+    the exact distance check. The tree is bulk loaded (stream/STR loading) from
+    the net's segment table.
+    """
+    name = "segment"
+
+    def __init__(self, net):
+        super().__init__(net)
+        a = net._shapeCoords[net._segStart]
+        b = net._shapeCoords[net._segEnd]
+        self._rtree = _RTreeQueries(_bulkRTree(np.column_stack([np.minimum(a, b), np.maximum(a, b)])))
+
+
+    def _candidateSegments(self, xs, ys, r):
+        seg, counts = self._rtree.intersection_v(np.column_stack([xs - r, ys - r]),
+                                                 np.column_stack([xs + r, ys + r]))
+        points = np.repeat(np.arange(len(xs), dtype=np.int64), counts.astype(np.int64))
+        return points, seg.astype(np.int64)
+
+
+    def _pointCandidates(self, x, y, r):
+        return self._rtree.intersection((x - r, y - r, x + r, y + r))
+
+
+class GridIndex(SpatialIndex):
+    """
+    Uniform grid of segment IDs stored in flat arrays.
+
+    Every segment is bucketed into the square cells its bounding box overlaps.
+    Only non-empty cells are stored: sorted cell keys, a CSR pointer array and
+    the segment IDs. With cellsize close to the query radius a query touches at
+    most 3x3 cells, which is much cheaper than a general R-tree for the fixed
+    radius the matcher uses. Needs nothing beyond numpy.
+    """
+    name = "grid"
+
+    def __init__(self, net, cellsize=100.0, state=None):
+        super().__init__(net)
+        if state is not None:
+            header, arrays = state
+            self.cellsize = header["cellsize"]
+            self._origin = tuple(header["origin"])
+            self._ny = header["ny"]
+            self._cellKeys = arrays["cellKeys"]
+            self._cellStart = arrays["cellStart"]
+            self._cellSegs = arrays["cellSegs"]
+            return
+
+        self.cellsize = float(cellsize)
+        a = net._shapeCoords[net._segStart]
+        b = net._shapeCoords[net._segEnd]
+        lo = np.minimum(a, b)
+        hi = np.maximum(a, b)
+        self._origin = (float(lo[:, 0].min()), float(lo[:, 1].min())) if len(lo) else (0.0, 0.0)
+        c0 = self._cell(lo[:, 0], lo[:, 1])
+        c1 = self._cell(hi[:, 0], hi[:, 1])
+        self._ny = int(c1[1].max()) + 1 if len(lo) else 1
+        ix, iy, seg = self._cellRanges(c0, c1)
+        keys = ix * self._ny + iy
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        self._cellSegs = seg[order].astype(np.int32)
+        self._cellKeys, start = np.unique(keys, return_index=True)
+        self._cellStart = np.append(start, len(keys)).astype(np.int64)
+
+
+    def _cell(self, x, y):
+        return (np.floor((x - self._origin[0]) / self.cellsize).astype(np.int64),
+                np.floor((y - self._origin[1]) / self.cellsize).astype(np.int64))
+
+
+    def _cellRanges(self, c0, c1):
+        """All cells (ix, iy) of the rectangles c0..c1 and the rectangle each belongs to."""
+        nx = c1[0] - c0[0] + 1
+        ny = c1[1] - c0[1] + 1
+        local, owner = _expand(np.zeros(len(nx), dtype=np.int64), nx * ny)
+        return c0[0][owner] + local // ny[owner], c0[1][owner] + local % ny[owner], owner
+
+
+    def _candidateSegments(self, xs, ys, r):
+        c0 = self._cell(xs - r, ys - r)
+        c1 = self._cell(xs + r, ys + r)
+        # clip iy to the grid so that keys cannot alias across columns;
+        # a box outside the grid gets an empty range
+        ix0 = np.maximum(c0[0], 0)
+        iy0 = np.maximum(c0[1], 0)
+        ix1 = np.maximum(c1[0], ix0 - 1)
+        iy1 = np.maximum(np.minimum(c1[1], self._ny - 1), iy0 - 1)
+        ix, iy, points = self._cellRanges((ix0, iy0), (ix1, iy1))
+        keys = ix * self._ny + iy
+        pos = np.searchsorted(self._cellKeys, keys)
+        pos = np.minimum(pos, len(self._cellKeys) - 1)
+        found = self._cellKeys[pos] == keys if len(self._cellKeys) else np.zeros(len(keys), dtype=bool)
+        pos, points = pos[found], points[found]
+        items, owner = _expand(self._cellStart[pos], self._cellStart[pos + 1] - self._cellStart[pos])
+        return points[owner], self._cellSegs[items].astype(np.int64)
+
+
+    def _pointCandidates(self, x, y, r):
+        # the cells of one grid column ix are consecutive keys, so each column
+        # of the query box is a single slice of _cellSegs
+        ox, oy = self._origin
+        c = self.cellsize
+        ix0 = max(math.floor((x - r - ox) / c), 0)
+        ix1 = math.floor((x + r - ox) / c)
+        iy0 = max(math.floor((y - r - oy) / c), 0)
+        iy1 = min(math.floor((y + r - oy) / c), self._ny - 1)
+        if ix1 < ix0 or iy1 < iy0:
+            return np.zeros(0, dtype=np.int64)
+        columns = np.arange(ix0, ix1 + 1, dtype=np.int64) * self._ny
+        lo = np.searchsorted(self._cellKeys, columns + iy0, side="left")
+        hi = np.searchsorted(self._cellKeys, columns + iy1, side="right")
+        start = self._cellStart[lo]
+        return self._cellSegs[_expand(start, self._cellStart[hi] - start)[0]].astype(np.int64)
+
+
+    def getState(self):
+        header = {"type": self.name, "cellsize": self.cellsize,
+                  "origin": list(self._origin), "ny": self._ny}
+        arrays = {"cellKeys": self._cellKeys, "cellStart": self._cellStart, "cellSegs": self._cellSegs}
+        return header, arrays
+
+
+class QueryCache:
+    """
+    LRU cache of fixed-radius queries in front of a SpatialIndex.
+
+    Queries are grouped by the cell of a square grid with side cellsize that
+    holds the query point, and by the radius. The first query of a (cell,
+    radius) key collects the candidate segments within radius plus half the
+    cell diagonal of the cell center, which covers the radius around every
+    point of the cell. Later queries of the key only refine the exact
+    distances on those segments, so they return the same edges and distances
+    as the index itself. The least recently used keys are dropped when the
+    stored segment arrays take more than maxbytes.
+
+    Queries may come from several threads, like the index itself.
+    """
+
+    # estimated bytes of a key, its dict slot and the array header
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, index, cellsize=20.0, maxbytes=16 * 2**20):
+        self.index = index
+        self.cellsize = float(cellsize)
+        self.maxbytes = maxbytes
+        self._cells = OrderedDict()  # (cx, cy, r) -> segment indices, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def query(self, x, y, r):
+        """Same as SpatialIndex.query."""
+        key = (math.floor(x / self.cellsize), math.floor(y / self.cellsize), r)
+        with self._lock:
+            seg = self._cells.get(key)
+            if seg is not None:
+                self._cells.move_to_end(key)
+                self.hits += 1
+        if seg is None:
+            seg = self._collect(key)
+        return self.index._refine(seg, x, y, r)
+
+
+    def _collect(self, key):
+        cx = (key[0] + 0.5) * self.cellsize
+        cy = (key[1] + 0.5) * self.cellsize
+        # the 1e-6 keeps rounding from dropping a segment at the corner of the cell
+        pad = key[2] + self.cellsize * math.sqrt(0.5) + 1e-6
+        net = self.index.net
+        seg = self.index._pointCandidates(cx, cy, pad)
+        a = net._shapeCoords[net._segStart[seg]]
+        b = net._shapeCoords[net._segEnd[seg]]
+        dist, _ = pointsToSegmentsDistance(cx, cy, a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+        seg = np.ascontiguousarray(seg[dist < pad])
+        with self._lock:
+            self.misses += 1
+            if key not in self._cells:
+                self._cells[key] = seg
+                self._bytes += seg.nbytes + self.ENTRY_OVERHEAD
+                while self._bytes > self.maxbytes and len(self._cells) > 0:
+                    _, old = self._cells.popitem(last=False)
+                    self._bytes -= old.nbytes + self.ENTRY_OVERHEAD
+                    self.evictions += 1
+        return seg
+
+
+    def stats(self):
+        """Hit and miss counters, hit rate, stored keys and their estimated bytes."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hitrate": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions, "entries": len(self._cells), "bytes": self._bytes,
+                    "maxbytes": self.maxbytes}
+
+
+    def clear(self):
+        with self._lock:
+            self._cells.clear()
+            self._bytes = 0
+
+
+BACKENDS = {cls.name: cls for cls in (EdgeRTreeIndex, SegmentIndex, GridIndex)}
+
+
+def createSpatialIndex(net, spatialindex="rtree", cellsize=100.0, state=None):
+    """
+    Builds the spatial index selected by name (see BACKENDS) or by class.
+
+    Args:
+        net (network.Net): network with packed arrays.
+        spatialindex (str or type): "rtree", "segment", "grid" or a SpatialIndex subclass.
+        cellsize (float): cell size of the grid backend (meters).
+        state (tuple): (header, arrays) from a snapshot, reused if it matches the backend.
+
+    Returns:
+        SpatialIndex: the index.
+    """
+    cls = BACKENDS[spatialindex] if isinstance(spatialindex, str) else spatialindex
+    if cls is GridIndex:
+        if state is not None and state[0].get("type") == cls.name and state[0]["cellsize"] == float(cellsize):
+            return GridIndex(net, state=state)
+        return GridIndex(net, cellsize=cellsize)
+    return cls(net)
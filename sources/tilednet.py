@@ -0,0 +1,522 @@
+"""
+Tiled network: a network.Net split into square tiles on disk, loaded on demand.
+
+writeTiles partitions a network into tiles of tilesize x tilesize meters. A tile
+holds every edge whose bounding box intersects it (shape, speed, length and
+adjacency, so spatial queries and projections inside the tile need no other
+tile) and the nodes whose coordinate lies in it. TiledNet opens such a
+directory and loads a tile the first time getNeighboringEdges, getEdge or the
+adjacency of an edge/node needs it; the least recently used tiles are evicted
+when the loaded tiles exceed the memory budget.
+
+Edges and nodes are identified by a global index (their position in the
+sorted ID tables of the index file), so an edge crossing tile borders is the
+same edge whichever tile it was reached from: the TiledEdge/TiledNode handles
+compare equal and hash by that index, and adjacency is stored with global
+indices.
+
+Directory layout (every file is written with network._writeSnapshot):
+
+    index.nrt       location, tile grid, sorted edge/node IDs with the home
+                    tile and local index of every edge/node
+    tile_<key>.nrt  arrays of one tile
+"""
+import math
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pyproj
+
+import network
+from network import _readSnapshot, _writeSnapshot
+from spatialindex import _expand
+
+_INDEX_FILE = "index.nrt"
+
+
+def _tileFile(path, key):
+    return os.path.join(path, f"tile_{key}.nrt")
+
+
+def _keys(ids):
+    """IDs as a fixed-width byte array (the sort order of the global index)."""
+    return np.array([str(i).encode("utf-8") for i in ids], dtype=np.bytes_)
+
+
+def _globalOrder(ids):
+    """(sorted keys, global index of every item of ids)."""
+    keys = _keys(ids)
+    order = np.argsort(keys, kind="stable")
+    globalindex = np.empty(len(order), dtype=np.int64)
+    globalindex[order] = np.arange(len(order))
+    return keys[order], globalindex
+
+
+def _gather(ptr, values, items):
+    """CSR (ptr, values) restricted to the rows items."""
+    counts = ptr[items + 1] - ptr[items]
+    newptr = np.zeros(len(items) + 1, dtype=np.int64)
+    newptr[1:] = np.cumsum(counts)
+    return newptr, values[_expand(ptr[items], counts)[0]]
+
+
+def writeTiles(net, path, tilesize=2000.0):
+    """
+    Splits a network into square tiles stored in a directory.
+
+    Args:
+        net (network.Net): network with packed arrays (any backend).
+        path (str): output directory, created if needed.
+        tilesize (float): side of a tile in meters.
+    """
+    os.makedirs(path, exist_ok=True)
+    edgekeys, edgeglobal = _globalOrder(net._edgeidlist)
+    nodekeys, nodeglobal = _globalOrder(net._nodeidlist)
+    edgeorder = np.argsort(edgeglobal)
+    nodeorder = np.argsort(nodeglobal)
+
+    bbox = net._edgeBBox
+    points = np.vstack([net._nodeCoords, bbox[:, :2], bbox[:, 2:]])
+    origin = points.min(axis=0) if len(points) else np.zeros(2)
+    ntx, nty = (np.floor((points.max(axis=0) - origin) / tilesize).astype(np.int64) + 1
+                if len(points) else (1, 1))
+
+    # every (tile, edge) pair of the tiles an edge bounding box intersects
+    t0 = np.floor((bbox[:, :2] - origin) / tilesize).astype(np.int64)
+    t1 = np.floor((bbox[:, 2:] - origin) / tilesize).astype(np.int64)
+    ny = t1[:, 1] - t0[:, 1] + 1
+    cells, owner = _expand(np.zeros(len(bbox), dtype=np.int64), (t1[:, 0] - t0[:, 0] + 1) * ny)
+    tilekey = (t0[owner, 0] + cells // ny[owner]) * nty + t0[owner, 1] + cells % ny[owner]
+    order = np.lexsort((edgeglobal[owner], tilekey))
+    tilekey, tileedge = tilekey[order], owner[order]
+
+    # home tile of an edge: the tile of its first shape point; of a node: its coordinate
+    first = np.floor((net._shapeCoords[net._shapeOffsets[:-1]] - origin) / tilesize).astype(np.int64)
+    edgehome = first[:, 0] * nty + first[:, 1]
+    nodetile = np.floor((net._nodeCoords - origin) / tilesize).astype(np.int64)
+    nodehome = nodetile[:, 0] * nty + nodetile[:, 1]
+
+    tiles = np.union1d(tilekey, nodehome)
+    edgestart = np.searchsorted(tilekey, tiles, side="left")
+    edgeend = np.searchsorted(tilekey, tiles, side="right")
+    nodes = np.lexsort((nodeglobal, nodehome))
+    nodestart = np.searchsorted(nodehome[nodes], tiles, side="left")
+    nodeend = np.searchsorted(nodehome[nodes], tiles, side="right")
+
+    edgelocal = np.empty(len(edgeglobal), dtype=np.int64)
+    nodelocal = np.empty(len(nodeglobal), dtype=np.int64)
+    for t, key in enumerate(tiles.tolist()):
+        edges = tileedge[edgestart[t]:edgeend[t]]
+        local = np.arange(len(edges))
+        home = edgehome[edges] == key
+        edgelocal[edges[home]] = local[home]
+        tilenodes = nodes[nodestart[t]:nodeend[t]]
+        nodelocal[tilenodes] = np.arange(len(tilenodes))
+
+        shapeoffsets, coords = _gather(net._shapeOffsets, net._shapeCoords, edges)
+        arrays = {"_edgeGlobal": edgeglobal[edges],
+                  "_shapeOffsets": shapeoffsets,
+                  "_shapeCoords": coords,
+                  "_edgeFrom": nodeglobal[net._edgeFrom[edges]],
+                  "_edgeTo": nodeglobal[net._edgeTo[edges]],
+                  "_edgeSpeed": net._edgeSpeed[edges],
+                  "_edgeLength": net._edgeLength[edges],
+                  "_edgeBBox": bbox[edges],
+                  "_nodeGlobal": nodeglobal[tilenodes],
+                  "_nodeCoords": net._nodeCoords[tilenodes]}
+        for name, ptr, idx, items in (("_edgeOut", net._edgeOutPtr, net._edgeOutIdx, edges),
+                                      ("_edgeIn", net._edgeInPtr, net._edgeInIdx, edges),
+                                      ("_nodeOut", net._nodeOutPtr, net._nodeOutIdx, tilenodes),
+                                      ("_nodeIn", net._nodeInPtr, net._nodeInIdx, tilenodes)):
+            arrays[name + "Ptr"], arrays[name + "Idx"] = _gather(ptr, edgeglobal[idx], items)
+        _writeSnapshot(_tileFile(path, key), {"tile": key}, arrays)
+
+    nodeids = net._nodeidlist
+    header = {"location": net._location,
+              "tilesize": float(tilesize),
+              "origin": [float(origin[0]), float(origin[1])],
+              "tiles": [int(ntx), int(nty)],
+              "nodeidtype": "int" if nodeids and all(isinstance(n, (int, np.integer)) for n in nodeids) else "str",
+              "spatialindex": {"type": net.spatialindex if isinstance(net.spatialindex, str) else "rtree",
+                               "cellsize": net.cellsize}}
+    _writeSnapshot(os.path.join(path, _INDEX_FILE), header,
+                   {"tileKeys": tiles,
+                    "edgeKeys": edgekeys, "edgeHome": edgehome[edgeorder], "edgeLocal": edgelocal[edgeorder],
+                    "nodeKeys": nodekeys, "nodeHome": nodehome[nodeorder], "nodeLocal": nodelocal[nodeorder]})
+
+
+class Tile(network.Net):
+    """
+    One loaded tile: a network.Net holding the geometry arrays of the tile's
+    edges (local indices, so spatial index and projection code are shared
+    with Net) plus the global index tables of TiledNet.
+    """
+
+    def __init__(self, key, arrays, spatialindex="rtree", cellsize=100.0):
+        super().__init__(compact=True, spatialindex=spatialindex, cellsize=cellsize)
+        self.key = key
+        self.resident = True
+        for name, a in arrays.items():
+            setattr(self, name, a)
+        self._buildSegments()
+        self._initSpatialIndex()
+        self.nbytes = sum(a.nbytes for a in vars(self).values() if isinstance(a, np.ndarray))
+        self.nbytes += sum(a.nbytes for a in vars(self._spatialindex).values() if isinstance(a, np.ndarray))
+
+    def localEdge(self, g):
+        """Local index of global edge g, or -1 if the tile does not hold it."""
+        i = int(np.searchsorted(self._edgeGlobal, g))
+        return i if i < len(self._edgeGlobal) and self._edgeGlobal[i] == g else -1
+
+    def release(self):
+        """Drops the arrays; handles still pointing here relocate their edge."""
+        self.resident = False
+        for name, value in list(vars(self).items()):
+            if isinstance(value, np.ndarray):
+                setattr(self, name, None)
+        self._spatialindex = None
+        self._rtree = None
+
+
+class TiledEdge:
+    """Edge handle of a TiledNet; equal to every other handle of the same edge."""
+    __slots__ = ("_net", "index", "_tile", "_local")
+
+    def __init__(self, net, index, tile=None, local=-1):
+        self._net = net
+        self.index = index
+        self._tile = tile
+        self._local = local
+
+    def _data(self):
+        """(tile, local index) holding this edge, loading a tile if needed."""
+        tile = self._tile
+        if tile is not None and tile.resident and self._local >= 0:
+            self._net._touch(tile)
+        else:
+            tile, self._local = self._net._locateEdge(self.index, tile)
+            self._tile = tile
+        return tile, self._local
+
+    def getID(self):
+        return self._net._edgeKeys[self.index].decode("utf-8")
+
+    def getIndex(self):
+        return self.index
+
+    def getIncoming(self):
+        tile, i = self._data()
+        return self._net._edgeList(tile._edgeInIdx[tile._edgeInPtr[i]:tile._edgeInPtr[i + 1]], tile)
+
+    def getOutgoing(self):
+        tile, i = self._data()
+        return self._net._edgeList(tile._edgeOutIdx[tile._edgeOutPtr[i]:tile._edgeOutPtr[i + 1]], tile)
+
+    def getShape(self):
+        tile, i = self._data()
+        return tile._shapeCoords[tile._shapeOffsets[i]:tile._shapeOffsets[i + 1]]
+
+    def getSpeed(self):
+        tile, i = self._data()
+        return float(tile._edgeSpeed[i])
+
+    def getLength(self):
+        tile, i = self._data()
+        return float(tile._edgeLength[i])
+
+    def getToNode(self):
+        tile, i = self._data()
+        return TiledNode(self._net, int(tile._edgeTo[i]))
+
+    def getFromNode(self):
+        tile, i = self._data()
+        return TiledNode(self._net, int(tile._edgeFrom[i]))
+
+    def getBoundingBox(self):
+        tile, i = self._data()
+        return tuple(tile._edgeBBox[i].tolist())
+
+    def __eq__(self, other):
+        return isinstance(other, TiledEdge) and other.index == self.index and other._net is self._net
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __repr__(self):
+        return f"<TiledEdge {self.getID()}>"
+
+
+class TiledNode:
+    """Node handle of a TiledNet; node data lives in the node's home tile."""
+    __slots__ = ("_net", "index")
+
+    def __init__(self, net, index):
+        self._net = net
+        self.index = index
+
+    def _data(self):
+        return self._net._locateNode(self.index)
+
+    def getID(self):
+        nid = self._net._nodeKeys[self.index].decode("utf-8")
+        return int(nid) if self._net._nodeidtype == "int" else nid
+
+    def getIndex(self):
+        return self.index
+
+    def getIncoming(self):
+        tile, i = self._data()
+        return self._net._edgeList(tile._nodeInIdx[tile._nodeInPtr[i]:tile._nodeInPtr[i + 1]], tile)
+
+    def getOutgoing(self):
+        tile, i = self._data()
+        return self._net._edgeList(tile._nodeOutIdx[tile._nodeOutPtr[i]:tile._nodeOutPtr[i + 1]], tile)
+
+    def getCoord(self):
+        tile, i = self._data()
+        return tile._nodeCoords[i]
+
+    def __eq__(self, other):
+        return isinstance(other, TiledNode) and other.index == self.index and other._net is self._net
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __repr__(self):
+        return f"<TiledNode {self.getID()}>"
+
+
+class TiledNet(network.Net):
+    def __init__(self, path, memory=512 * 2**20, spatialindex=None, cellsize=None, mmap=False):
+        """
+        Opens a directory written by writeTiles.
+
+        Args:
+            path (str): tile directory.
+            memory (int): budget in bytes for the arrays of the loaded tiles;
+                least recently used tiles are evicted above it (the tile in
+                use is always kept). R-tree memory is not counted.
+            spatialindex (str): spatial index backend of the tiles, defaults
+                to the backend of the tiled network.
+            cellsize (float): grid cell size, defaults to the stored one.
+            mmap (bool): memory-map tile files instead of reading them.
+        """
+        header, arrays = _readSnapshot(os.path.join(path, _INDEX_FILE), mmap=True)
+        stored = header["spatialindex"]
+        super().__init__(compact=True,
+                         spatialindex=stored["type"] if spatialindex is None else spatialindex,
+                         cellsize=stored["cellsize"] if cellsize is None else cellsize)
+        self.path = path
+        self.memory = memory
+        self.mmap = mmap
+        self._location = header["location"]
+        if self._location.get("projParameter", "!") != "!":
+            self.geoproj = pyproj.Proj(projparams=self._location["projParameter"])
+        self.tilesize = header["tilesize"]
+        self._origin = tuple(header["origin"])
+        self._ntx, self._nty = header["tiles"]
+        self._nodeidtype = header["nodeidtype"]
+        self._tileKeys = arrays["tileKeys"]
+        self._edgeKeys = arrays["edgeKeys"]
+        self._edgeHome = arrays["edgeHome"]
+        self._edgeLocal = arrays["edgeLocal"]
+        self._nodeKeys = arrays["nodeKeys"]
+        self._nodeHome = arrays["nodeHome"]
+        self._nodeLocal = arrays["nodeLocal"]
+        self._tiles = OrderedDict()  # key -> Tile, least recently used first
+        self._tilebytes = 0
+        self._tilestats = {"loads": 0, "evictions": 0}
+
+    #########  tile cache  #####################
+
+    def _touch(self, tile):
+        self._tiles.move_to_end(tile.key)
+
+    def _tile(self, key):
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            return tile
+        header, arrays = _readSnapshot(_tileFile(self.path, key), mmap=self.mmap)
+        tile = Tile(key, arrays, spatialindex=self.spatialindex, cellsize=self.cellsize)
+        self._tiles[key] = tile
+        self._tilebytes += tile.nbytes
+        self._tilestats["loads"] += 1
+        while self._tilebytes > self.memory and len(self._tiles) > 1:
+            _, old = self._tiles.popitem(last=False)
+            self._tilebytes -= old.nbytes
+            old.release()
+            self._tilestats["evictions"] += 1
+        return tile
+
+    def _locateEdge(self, g, hint=None):
+        """(tile, local index) of global edge g: its home tile if loaded, else hint, else load the home tile."""
+        home = int(self._edgeHome[g])
+        tile = self._tiles.get(home)
+        if tile is None and hint is not None and hint.resident:
+            i = hint.localEdge(g)
+            if i >= 0:
+                self._touch(hint)
+                return hint, i
+        return self._tile(home), int(self._edgeLocal[g])
+
+    def _locateNode(self, g):
+        return self._tile(int(self._nodeHome[g])), int(self._nodeLocal[g])
+
+    def _edgeList(self, globalidx, tile):
+        return [TiledEdge(self, g, tile) for g in globalidx.tolist()]
+
+    def _tilesAround(self, x, y, r):
+        """Keys of the existing tiles intersecting the square of half side r around (x, y)."""
+        ox, oy = self._origin
+        tx0 = max(math.floor((x - r - ox) / self.tilesize), 0)
+        tx1 = min(math.floor((x + r - ox) / self.tilesize), self._ntx - 1)
+        ty0 = max(math.floor((y - r - oy) / self.tilesize), 0)
+        ty1 = min(math.floor((y + r - oy) / self.tilesize), self._nty - 1)
+        keys = [tx * self._nty + ty for tx in range(tx0, tx1 + 1) for ty in range(ty0, ty1 + 1)]
+        return [k for k in keys if self._hasTile(k)]
+
+    def _hasTile(self, key):
+        i = int(np.searchsorted(self._tileKeys, key))
+        return i < len(self._tileKeys) and self._tileKeys[i] == key
+
+    def tileStats(self):
+        """Number of loaded tiles, their bytes, and the load/eviction counters."""
+        return dict(self._tilestats, resident=len(self._tiles), bytes=self._tilebytes)
+
+    #########  Net interface  #####################
+
+    def _find(self, keys, n):
+        key = str(n).encode("utf-8")
+        i = int(np.searchsorted(keys, key))
+        if i == len(keys) or keys[i] != key:
+            raise KeyError(n)
+        return i
+
+    def getEdge(self, n):
+        return TiledEdge(self, self._find(self._edgeKeys, n))
+
+    def getNode(self, n):
+        return TiledNode(self, self._find(self._nodeKeys, n))
+
+    def getEdgeIndex(self, n):
+        return self._find(self._edgeKeys, n)
+
+    def getEdgeByIndex(self, i):
+        return TiledEdge(self, int(i))
+
+    def getEdges(self):
+        """Handles of all edges; their data is only loaded when used."""
+        return [TiledEdge(self, g) for g in range(len(self._edgeKeys))]
+
+    def getNodes(self):
+        return [TiledNode(self, g) for g in range(len(self._nodeKeys))]
+
+    def save(self, path):
+        # callers that store a network check for TiledNet and use self.path instead
+        raise TypeError(f"a TiledNet is already stored in the tile directory {self.path!r}; "
+                        "write a Net with writeTiles or Net.save instead")
+
+    def setQueryCache(self, cellsize=20.0, maxbytes=16 * 2**20):
+        # the tile indexes come and go with the tiles, a cache could not keep its memory bound
+        raise ValueError("query caches are not supported on a TiledNet, use a Net (Net.load) instead")
+
+    def _fromPoint(self, fromedge, edge_reverse, from_reverse):
+        if fromedge is None:
+            return None
+        shape = fromedge.getShape()
+        p = shape[-1] if from_reverse==False or edge_reverse==False else shape[0]
+        return float(p[0]), float(p[1])
+
+    def combinedShapeLength(self, edge, fromedge=None, edge_reverse=False, from_reverse=False):
+        # the previous edge may live in another tile: take its end point first,
+        # then the tile of edge (the most recently used one is never evicted)
+        p = self._fromPoint(fromedge, edge_reverse, from_reverse)
+        tile, i = edge._data()
+        return tile._combinedShapeLength(i, p, edge_reverse)
+
+    def projectOnEdge(self, edge, x, y, fromedge=None, edge_reverse=False, from_reverse=False):
+        p = self._fromPoint(fromedge, edge_reverse, from_reverse)
+        tile, i = edge._data()
+        return tile._projectOnEdge(i, x, y, p, edge_reverse)
+
+    def projectOnEdges(self, edges, x, y, fromedges, edge_reverses, from_reverses):
+        # one vectorized projection per tile holding candidates
+        groups = {}
+        for k, (edge, fromedge, edge_reverse, from_reverse) in enumerate(zip(edges, fromedges, edge_reverses,
+                                                                             from_reverses)):
+            p = self._fromPoint(fromedge, edge_reverse, from_reverse)
+            tile, i = edge._data()
+            groups.setdefault(id(tile), (tile, []))[1].append((k, i, tile._prefixPoint(i, p, edge_reverse),
+                                                              bool(edge_reverse)))
+        result = [np.empty(len(edges)) for _ in range(5)]
+        for tile, items in groups.values():
+            if not tile.resident:
+                # evicted while locating later candidates
+                for k, _, _, _ in items:
+                    offset, matchpoint, length, bearing = self.projectOnEdge(edges[k], x, y, fromedges[k],
+                                                                             edge_reverses[k], from_reverses[k])
+                    for a, value in zip(result, (offset, matchpoint[0], matchpoint[1], length, bearing)):
+                        a[k] = value
+                continue
+            ks = [item[0] for item in items]
+            points = np.full((len(items), 2), np.nan)
+            for n, item in enumerate(items):
+                if item[2] is not None:
+                    points[n] = item[2]
+            values = tile._projectOnEdges(np.array([item[1] for item in items], dtype=np.int64), x, y, points,
+                                          np.array([item[3] for item in items], dtype=bool))
+            for a, value in zip(result, values):
+                a[ks] = value
+        return tuple(result)
+
+    def getBoundingBoxes(self, edges):
+        return np.array([edge.getBoundingBox() for edge in edges], dtype=np.float64).reshape(-1, 4)
+
+    def getNeighboringEdges(self, x, y, r=0.1):
+        # an edge crossing tile borders is found in each tile, with the same distance
+        found = {}
+        for key in self._tilesAround(x, y, r):
+            tile = self._tile(key)
+            edgeidx, dist, _ = tile._spatialindex.query(x, y, r)
+            for i, d in zip(edgeidx.tolist(), dist.tolist()):
+                g = int(tile._edgeGlobal[i])
+                if g not in found:
+                    found[g] = (TiledEdge(self, g, tile, i), d)
+        return [found[g] for g in sorted(found)]
+
+    def getNeighboringEdgesBatch(self, xs, ys, r=0.1, chunksize=4096):
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        ox, oy = self._origin
+        tx0 = np.maximum(np.floor((xs - r - ox) / self.tilesize).astype(np.int64), 0)
+        tx1 = np.minimum(np.floor((xs + r - ox) / self.tilesize).astype(np.int64), self._ntx - 1)
+        ty0 = np.maximum(np.floor((ys - r - oy) / self.tilesize).astype(np.int64), 0)
+        ty1 = np.minimum(np.floor((ys + r - oy) / self.tilesize).astype(np.int64), self._nty - 1)
+        ny = np.maximum(ty1 - ty0 + 1, 0)
+        cells, owner = _expand(np.zeros(len(xs), dtype=np.int64), np.maximum(tx1 - tx0 + 1, 0) * ny)
+        keys = (tx0[owner] + cells // ny[owner]) * self._nty + ty0[owner] + cells % ny[owner]
+
+        points, edges, dists = [], [], []
+        order = np.argsort(keys, kind="stable")
+        keys, owner = keys[order], owner[order]
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+        for start, end in zip(np.r_[0, bounds].tolist(), np.r_[bounds, len(keys)].tolist()):
+            key = int(keys[start])
+            if start == end or not self._hasTile(key):
+                continue
+            tile = self._tile(key)
+            pts = owner[start:end]
+            pi, ei, d, _ = tile._spatialindex.queryBatch(xs[pts], ys[pts], r, chunksize=chunksize)
+            points.append(pts[pi])
+            edges.append(tile._edgeGlobal[ei].astype(np.int64))
+            dists.append(d)
+        if not points:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        points, edges, dists = np.concatenate(points), np.concatenate(edges), np.concatenate(dists)
+        order = np.lexsort((edges, points))
+        points, edges, dists = points[order], edges[order], dists[order]
+        first = np.ones(len(points), dtype=bool)
+        first[1:] = (points[1:] != points[:-1]) | (edges[1:] != edges[:-1])
+        return points[first], edges[first], dists[first]
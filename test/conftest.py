@@ -0,0 +1,110 @@
+import math
+import os
+import random
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sources"))
+import network
+
+
+def gridNet(nx=6, ny=6, spacing=200.0, seed=1, **kwargs):
+    """
+    Synthetic network: an nx x ny grid of nodes joined by edges in both
+    directions, half of them bent with a few intermediate points. Built
+    through the Node/Edge API, so no SUMO file is needed.
+    """
+    rnd = random.Random(seed)
+    net = network.Net(**kwargs)
+    net._location = {"netOffset": "0.00,0.00", "projParameter": "!"}
+    for i in range(nx):
+        for j in range(ny):
+            nid = f"n{i}_{j}"
+            net.nodes[nid] = network.Node(id=nid, coord=(i * spacing + 100.0, j * spacing + 100.0))
+
+    def add(a, b):
+        (x1, y1), (x2, y2) = net.nodes[a].getCoord(), net.nodes[b].getCoord()
+        shape = [(x1, y1)]
+        if rnd.random() < 0.5:
+            k = rnd.randint(1, 3)
+            for t in range(1, k + 1):
+                f = t / (k + 1)
+                off = rnd.uniform(-20, 20) / spacing
+                shape.append((x1 + f * (x2 - x1) - off * (y2 - y1), y1 + f * (y2 - y1) + off * (x2 - x1)))
+        shape.append((x2, y2))
+        eid = f"{a}to{b}"
+        length = sum(math.dist(p, q) for p, q in zip(shape[:-1], shape[1:]))
+        net.edges[eid] = network.Edge(id=eid, fromnode=net.nodes[a], tonode=net.nodes[b],
+                                      speed=13.89, length=length, shape=shape)
+
+    for i in range(nx):
+        for j in range(ny):
+            if i + 1 < nx:
+                add(f"n{i}_{j}", f"n{i + 1}_{j}")
+                add(f"n{i + 1}_{j}", f"n{i}_{j}")
+            if j + 1 < ny:
+                add(f"n{i}_{j}", f"n{i}_{j + 1}")
+                add(f"n{i}_{j + 1}", f"n{i}_{j}")
+    for edge in net.edges.values():
+        edge.getFromNode().addOutgoing(edge)
+        edge.getToNode().addIncoming(edge)
+    for edge in net.edges.values():
+        for item in edge.getToNode().getOutgoing():
+            edge.addOutgoing(item)
+        for item in edge.getFromNode().getIncoming():
+            edge.addIncoming(item)
+    net._edgeidlist = list(net.edges.keys())
+    net._buildArrays()
+    net._initSpatialIndex()
+    return net
+
+
+def trajectory(net, edges=12, seed=0, noise=3.0, speed=10.0):
+    """
+    GPS points every second along a random route without U-turns, with
+    gaussian noise on the position and the bearing. true_edge holds the edge
+    a point was sampled on.
+    """
+    rnd = random.Random(seed)
+    edge = rnd.choice(sorted(net.getEdges(), key=lambda e: e.getID()))
+    route = [edge]
+    while len(route) < edges:
+        outgoing = [o for o in edge.getOutgoing() if o.getToNode() != edge.getFromNode()]
+        edge = rnd.choice(sorted(outgoing, key=lambda e: e.getID()))
+        route.append(edge)
+    points, owner = [], []
+    for edge in route:
+        shape = [tuple(p) for p in edge.getShape()]
+        start = 1 if points else 0
+        points += shape[start:]
+        owner += [edge.getID()] * (len(shape) - start)
+    seglength = [math.dist(a, b) for a, b in zip(points[:-1], points[1:])]
+    cumlength = np.concatenate([[0.0], np.cumsum(seglength)])
+    rows = []
+    d, timestamp = 0.0, 1000
+    while d < cumlength[-1]:
+        j = min(int(np.searchsorted(cumlength, d, side="right")) - 1, len(seglength) - 1)
+        (ax, ay), (bx, by) = points[j], points[j + 1]
+        f = (d - cumlength[j]) / seglength[j]
+        bearing = (math.degrees(math.atan2(bx - ax, by - ay)) + 360) % 360
+        rows.append({"x":ax + f * (bx - ax) + rnd.gauss(0, noise), "y":ay + f * (by - ay) + rnd.gauss(0, noise),
+                     "timestamp":timestamp, "speed":speed, "bearing":(bearing + rnd.gauss(0, 3)) % 360,
+                     "type":"origin", "stopindex":0, "true_edge":owner[j + 1]})
+        d += speed
+        timestamp += 1
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture(scope="session")
+def net():
+    return gridNet()
+
+
+@pytest.fixture(scope="session")
+def snapshot(net, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("snapshot") / "grid.nrt")
+    net.save(path)
+    return path
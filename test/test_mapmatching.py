@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+
+import batchmatching
+from conftest import trajectory
+from mapmatching import MapMatcher, MatchSession
+
+SEEDS = range(4)
+
+
+def accuracy(matchdf, df):
+    return (matchdf["edgeid"].values == df["true_edge"].values[matchdf["index"].values]).mean()
+
+
+def edges(context):
+    return context.matchdf["edgeid"].tolist()
+
+
+@pytest.fixture(scope="module")
+def trajectories(net):
+    return {seed: trajectory(net, seed=seed) for seed in SEEDS}
+
+
+@pytest.fixture(scope="module")
+def serial(net, trajectories):
+    return {seed: MapMatcher(net, MAX_RUNNING_TIME=None).match_trajectory(df) for seed, df in trajectories.items()}
+
+
+def test_backtrack_follows_the_route(trajectories, serial):
+    for seed, context in serial.items():
+        assert context.status == "ok"
+        assert len(context.matchdf) == len(trajectories[seed])
+        assert accuracy(context.matchdf, trajectories[seed]) > 0.9
+
+
+def test_decisions_count_every_row(net, trajectories):
+    for engine in ("backtrack", "viterbi", "sparse"):
+        context = MapMatcher(net, ENGINE=engine, INSTRUMENT=True, MAX_RUNNING_TIME=None) \
+            .match_trajectory(trajectories[0])
+        counters = context.stats.counters
+        assert counters["stay"] + counters["change"] + counters["nodecision"] == len(context.matchdf), engine
+
+
+def test_pruning_keeps_the_matches(net, trajectories, serial):
+    for seed, df in trajectories.items():
+        context = MapMatcher(net, PRUNE_CANDIDATES=True, MAX_RUNNING_TIME=None).match_trajectory(df)
+        assert edges(context) == edges(serial[seed])
+        assert np.allclose(context.matchdf["offset"], serial[seed].matchdf["offset"])
+
+
+def test_loop_filter_keeps_the_route(net, trajectories, serial):
+    for seed, df in trajectories.items():
+        if len(set(serial[seed].matchdf["edgeid"])) < len(serial[seed].path):
+            # the route comes back to an edge, which LOOP=False forbids
+            continue
+        context = MapMatcher(net, LOOP=False, MAX_RUNNING_TIME=None).match_trajectory(df)
+        assert context.status == "ok"
+        # backtracking may take other turns, the route is the same
+        assert [item["edge"] for item in context.path] == [item["edge"] for item in serial[seed].path]
+
+
+@pytest.mark.parametrize("engine", ["viterbi", "sparse"])
+def test_engines_agree_with_backtrack(net, trajectories, serial, engine):
+    for seed, df in trajectories.items():
+        context = MapMatcher(net, ENGINE=engine, MAX_RUNNING_TIME=None).match_trajectory(df)
+        assert context.status == "ok"
+        assert list(context.matchdf["index"]) == list(range(len(df)))
+        agree = np.mean(np.array(edges(context)) == np.array(edges(serial[seed])))
+        assert agree > 0.9, (seed, agree)
+
+
+def test_sparse_path_is_connected(net, trajectories):
+    df = trajectories[1].iloc[::10].reset_index(drop=True)
+    context = MapMatcher(net, ENGINE="sparse", MAX_RUNNING_TIME=None).match_trajectory(df)
+    assert context.status == "ok"
+    path = [item["edge"] for item in context.path]
+    for a, b in zip(path[:-1], path[1:]):
+        assert b in a.getOutgoing()
+    position = {edge.getID(): k for k, edge in enumerate(path)}
+    for row in context.matchedpoints:
+        if row["from_edge"] is not None and row["from_edge"] != row["edgeid"]:
+            assert path[position[row["edgeid"]] - 1].getID() == row["from_edge"]
+
+
+def test_chunked_matches_whole_trajectory(net, trajectories, serial):
+    for seed, df in trajectories.items():
+        context = MapMatcher(net, MAX_RUNNING_TIME=None).match_chunked(df, window=40, overlap=15)
+        assert context.status == "ok"
+        assert len(context.windows) > 1
+        assert list(context.matchdf["index"]) == list(range(len(df)))
+        assert edges(context) == edges(serial[seed])
+        assert [item["edge"] for item in context.path] == [item["edge"] for item in serial[seed].path]
+
+
+def test_session_matches_match(net, trajectories, serial):
+    for seed, df in trajectories.items():
+        session = MatchSession(MapMatcher(net, MAX_RUNNING_TIME=None), window=len(df))
+        rows = session.push_batch(df) + session.close()
+        assert [row["edgeid"] for row in rows] == edges(serial[seed])
+        assert session.breaks == 0 and session.pending() == 0
+
+
+def test_session_point_by_point(net, trajectories, serial):
+    for seed, df in trajectories.items():
+        session = MatchSession(MapMatcher(net, MAX_RUNNING_TIME=None), window=30)
+        rows = []
+        for point in df.to_dict("records"):
+            rows += session.push(point)
+            assert session.pending() <= 30
+        rows += session.close()
+        assert [row["index"] for row in rows] == list(range(len(df)))
+        assert np.mean([row["edgeid"] == df["true_edge"][row["index"]] for row in rows]) == \
+            pytest.approx(accuracy(serial[seed].matchdf, df), abs=0.02)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_batch_matches_serial(net, trajectories, serial, processes):
+    results = {result.id: result for result in batchmatching.match_batch(net, trajectories, processes=processes,
+                                                                          MAX_RUNNING_TIME=None)}
+    assert sorted(results) == sorted(trajectories)
+    for seed, result in results.items():
+        assert result.status == "ok" and result.error is None
+        assert result.matchdf["edgeid"].tolist() == edges(serial[seed])
+
+
+def test_batch_on_snapshot_path(snapshot, trajectories, serial):
+    results = list(batchmatching.match_batch(snapshot, trajectories, processes=1, MAX_RUNNING_TIME=None))
+    for result in results:
+        assert result.matchdf["edgeid"].tolist() == edges(serial[result.id])
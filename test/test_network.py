@@ -0,0 +1,135 @@
+import math
+
+import numpy as np
+import pytest
+
+import geotools
+import network
+from conftest import gridNet
+
+
+def randomPoints(net, n=300, seed=0):
+    bb = net._edgeBBox
+    rnd = np.random.default_rng(seed)
+    return rnd.uniform(bb[:, 0].min() - 50, bb[:, 2].max() + 50, n), \
+        rnd.uniform(bb[:, 1].min() - 50, bb[:, 3].max() + 50, n)
+
+
+def neighbors(net, xs, ys, r):
+    return [sorted((e.getID(), round(d, 9)) for e, d in net.getNeighboringEdges(x, y, r)) for x, y in zip(xs, ys)]
+
+
+def test_segment_offsets_end_at_shape_length(net):
+    last = net._segOffsets[1:] - 1
+    assert np.array_equal(net._segCumLength[last] + net._segLength[last], net._shapeLength)
+    for i in range(len(net._edgeidlist)):
+        seg = net._segLength[net._segOffsets[i]:net._segOffsets[i + 1]]
+        assert np.array_equal(net._segCumLength[net._segOffsets[i]:net._segOffsets[i + 1]],
+                              np.concatenate([[0.0], np.cumsum(seg)[:-1]]))
+
+
+@pytest.mark.parametrize("edge_reverse,from_reverse", [(False, False), (True, False), (True, True)])
+def test_projection_matches_shape_walk(net, edge_reverse, from_reverse):
+    rnd = np.random.default_rng(1)
+    edges = net.getEdges()
+    for _ in range(200):
+        edge = edges[rnd.integers(len(edges))]
+        incoming = edge.getIncoming()
+        fromedge = incoming[rnd.integers(len(incoming))] if rnd.random() < 0.5 else None
+        shape = [tuple(p) for p in edge.getShape()]
+        x, y = np.array(shape[rnd.integers(len(shape))]) + rnd.normal(0, 30, 2)
+        offset, matchpoint, length, bearing = net.projectOnEdge(edge, x, y, fromedge, edge_reverse, from_reverse)
+
+        combined = network.combineShapesSumo(edge, fromedge, edge_reverse, from_reverse)
+        expected, point = geotools.polygonOffsetWithMinimumDistanceToPoint((x, y), combined)
+        assert offset == pytest.approx(expected, abs=1e-6)
+        assert matchpoint == pytest.approx(point, abs=1e-6)
+        assert length == pytest.approx(geotools.polyLength(combined), abs=1e-6)
+        # at a shape point the bearing of either segment is right, rounding decides
+        if min(math.dist(matchpoint, p) for p in combined) > 1e-6:
+            assert bearing == pytest.approx(geotools.offsetBearing(combined, offset), abs=1e-6)
+
+
+def test_projectOnEdges_matches_projectOnEdge(net):
+    rnd = np.random.default_rng(2)
+    xs, ys = randomPoints(net, 50, seed=2)
+    for x, y in zip(xs, ys):
+        edges = [e for e, _ in net.getNeighboringEdges(x, y, 150)]
+        if len(edges) == 0:
+            continue
+        fromedges = [e.getIncoming()[0] if rnd.random() < 0.5 else None for e in edges]
+        reverses = [bool(rnd.random() < 0.3) for _ in edges]
+        from_reverses = [False] * len(edges)
+        offset, mx, my, length, bearing = net.projectOnEdges(edges, x, y, fromedges, reverses, from_reverses)
+        for k, edge in enumerate(edges):
+            single, (sx, sy), singlelength, singlebearing = net.projectOnEdge(edge, x, y, fromedges[k], reverses[k],
+                                                                              from_reverses[k])
+            assert (offset[k], mx[k], my[k], length[k]) == pytest.approx((single, sx, sy, singlelength))
+            assert bearing[k] == pytest.approx(singlebearing)
+
+
+@pytest.mark.parametrize("backend", ["rtree", "segment", "grid"])
+def test_batch_neighbors_match_single_queries(backend):
+    net = gridNet(spatialindex=backend)
+    xs, ys = randomPoints(net)
+    single = neighbors(net, xs, ys, 100)
+    pointindex, edgeindex, distance = net.getNeighboringEdgesBatch(xs, ys, 100, chunksize=64)
+    batch = [[] for _ in xs]
+    for p, e, d in zip(pointindex.tolist(), edgeindex.tolist(), distance.tolist()):
+        batch[p].append((net.getEdgeByIndex(e).getID(), round(d, 9)))
+    assert [sorted(item) for item in batch] == single
+
+
+@pytest.mark.parametrize("backend", ["rtree", "segment", "grid"])
+def test_backends_agree(net, backend):
+    xs, ys = randomPoints(net, seed=3)
+    assert neighbors(gridNet(spatialindex=backend), xs, ys, 80) == neighbors(net, xs, ys, 80)
+
+
+def test_query_cache_matches_index(net):
+    cached = gridNet()
+    cached.setQueryCache(cellsize=20.0, maxbytes=2**16)
+    xs, ys = randomPoints(net, seed=4)
+    assert neighbors(cached, xs, ys, 100) == neighbors(net, xs, ys, 100)
+    assert neighbors(cached, xs, ys, 100) == neighbors(net, xs, ys, 100)
+    assert cached.queryCacheStats()["hits"] > 0
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_snapshot_round_trip(net, snapshot, mmap):
+    loaded = network.Net.load(snapshot, mmap=mmap)
+    assert loaded._edgeidlist == net._edgeidlist
+    assert loaded._nodeidlist == net._nodeidlist
+    for name in network._SNAPSHOT_ARRAYS + ("_segCumLength", "_shapeLength"):
+        assert np.array_equal(getattr(loaded, name), getattr(net, name)), name
+    for edge in net.getEdges()[::7]:
+        other = loaded.getEdge(edge.getID())
+        assert sorted(o.getID() for o in other.getOutgoing()) == sorted(o.getID() for o in edge.getOutgoing())
+        assert other.getFromNode().getID() == edge.getFromNode().getID()
+    xs, ys = randomPoints(net, seed=5)
+    assert neighbors(loaded, xs, ys, 100) == neighbors(net, xs, ys, 100)
+
+
+def test_snapshot_keeps_grid_backend(tmp_path):
+    net = gridNet(spatialindex="grid", cellsize=50.0)
+    net.save(str(tmp_path / "grid.nrt"))
+    loaded = network.Net.load(str(tmp_path / "grid.nrt"))
+    assert loaded._spatialindex.name == "grid"
+    assert loaded.cellsize == 50.0
+    xs, ys = randomPoints(net, seed=6)
+    assert neighbors(loaded, xs, ys, 100) == neighbors(net, xs, ys, 100)
+
+
+def test_shortest_path_matches_dijkstra(net):
+    rnd = np.random.default_rng(7)
+    n = len(net._edgeidlist)
+    router = net.getRouter("length")
+    for method in ("dijkstra", "astar"):
+        for a, b in rnd.integers(0, n, (30, 2)).tolist():
+            source, target = net.getEdgeByIndex(a), net.getEdgeByIndex(b)
+            path, cost = router.shortestPath(source, target, method)
+            assert cost == pytest.approx(router.distancesFrom(a)[b])
+            assert path[0] == source and path[-1] == target
+            assert cost == pytest.approx(sum(e.getLength() for e in path[:-1]))
+            for u, v in zip(path[:-1], path[1:]):
+                assert v in u.getOutgoing()
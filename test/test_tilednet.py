@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+import mapmatching
+import tilednet
+from conftest import trajectory
+from mapmatching import MapMatcher
+
+
+@pytest.fixture(scope="module")
+def tiles(net, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("tiles"))
+    tilednet.writeTiles(net, path, tilesize=300.0)
+    return path
+
+
+@pytest.fixture
+def tiled(tiles):
+    # a budget of a few tiles, so that queries load and evict
+    return tilednet.TiledNet(tiles, memory=60000)
+
+
+def test_neighbors_match_net(net, tiled):
+    rnd = np.random.default_rng(0)
+    bb = net._edgeBBox
+    xs = rnd.uniform(bb[:, 0].min() - 50, bb[:, 2].max() + 50, 300)
+    ys = rnd.uniform(bb[:, 1].min() - 50, bb[:, 3].max() + 50, 300)
+    for x, y in zip(xs, ys):
+        assert sorted((e.getID(), round(d, 9)) for e, d in tiled.getNeighboringEdges(x, y, 100)) == \
+            sorted((e.getID(), round(d, 9)) for e, d in net.getNeighboringEdges(x, y, 100))
+    pa, ea, da = net.getNeighboringEdgesBatch(xs, ys, 100)
+    pb, eb, db = tiled.getNeighboringEdgesBatch(xs, ys, 100)
+    assert sorted(zip(pa.tolist(), [net._edgeidlist[i] for i in ea], np.round(da, 9))) == \
+        sorted(zip(pb.tolist(), [tiled.getEdgeByIndex(i).getID() for i in eb], np.round(db, 9)))
+    assert tiled.tileStats()["evictions"] > 0
+
+
+def test_topology_and_geometry_match_net(net, tiled):
+    for edge in net.getEdges():
+        other = tiled.getEdge(edge.getID())
+        assert sorted(o.getID() for o in other.getOutgoing()) == sorted(o.getID() for o in edge.getOutgoing())
+        assert sorted(o.getID() for o in other.getIncoming()) == sorted(o.getID() for o in edge.getIncoming())
+        assert other.getFromNode().getID() == edge.getFromNode().getID()
+        assert np.array_equal(other.getShape(), edge.getShape())
+        tile, local = other._data()
+        i = edge.getIndex()
+        assert np.array_equal(tile._segCumLength[tile._segOffsets[local]:tile._segOffsets[local + 1]],
+                              net._segCumLength[net._segOffsets[i]:net._segOffsets[i + 1]])
+        assert tile._shapeLength[local] == net._shapeLength[i]
+
+
+@pytest.mark.parametrize("engine", ["backtrack", "viterbi"])
+def test_matching_matches_net(net, tiled, engine):
+    for seed in range(3):
+        df = trajectory(net, seed=seed)
+        expected = MapMatcher(net, ENGINE=engine, MAX_RUNNING_TIME=None).match_trajectory(df)
+        result = MapMatcher(tiled, ENGINE=engine, MAX_RUNNING_TIME=None).match_trajectory(df)
+        assert result.status == expected.status == "ok"
+        assert result.matchdf["edgeid"].tolist() == expected.matchdf["edgeid"].tolist()
+        assert np.allclose(result.matchdf["offset"], expected.matchdf["offset"])
+
+
+def test_limits(net, tiled, tmp_path):
+    with pytest.raises(TypeError):
+        tiled.save(str(tmp_path / "tiled.nrt"))
+    with pytest.raises(ValueError):
+        tiled.setQueryCache()
+    with pytest.raises(ValueError):
+        MapMatcher(tiled, ENGINE="sparse")
+
+
+def test_transition_table_is_bounded(net, tiled, monkeypatch):
+    monkeypatch.setattr(mapmatching, "TILED_TRANSITION_TABLE_SIZE", 8)
+    expected = MapMatcher(net, MAX_RUNNING_TIME=None).match_trajectory(trajectory(net, seed=4))
+    result = MapMatcher(tiled, MAX_RUNNING_TIME=None).match_trajectory(trajectory(net, seed=4))
+    table = mapmatching.transition_table(tiled, True, False)
+    assert table.maxsize == 8 and len(table) == 8
+    assert mapmatching.transition_table(net, True, False).maxsize is None
+    assert result.matchdf["edgeid"].tolist() == expected.matchdf["edgeid"].tolist()